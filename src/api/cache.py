@@ -0,0 +1,102 @@
+'''Shared response cache for anonymous catalog reads.
+
+Entries are keyed on the request path and sorted query parameters plus
+generation counters: one for every list page and one per movie for its
+detail page. Invalidation bumps the relevant counters (see api.signals)
+so stale entries are never read again and simply expire, which works the
+same on every cache backend, including ones without key patterns.
+'''
+import hashlib
+import threading
+import time
+from urllib.parse import urlencode
+
+from django.core.cache import caches
+
+CACHE_ALIAS = 'catalog'
+LIST_GENERATION = 'movies:list:generation'
+DETAIL_GENERATION = 'movies:detail:generation'
+
+
+class CacheStats(object):
+    '''Hit/miss counters of this worker process'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def as_dict(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+            }
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def _generations(*keys):
+    '''Current value of each generation counter, created on first use.
+
+    Fresh counters start from a clock value so a counter evicted by the
+    backend can't come back with a number older entries were stored under.
+    '''
+    cache = get_cache()
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            cache.add(key, time.time_ns(), None)
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+
+def _bump(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def _params_digest(request):
+    params = sorted(request.query_params.lists())
+    return hashlib.md5(urlencode(params, doseq=True).encode()).hexdigest()
+
+
+def list_key(request):
+    generation, = _generations(LIST_GENERATION)
+    return f'movies:list:{generation}:{_params_digest(request)}'
+
+
+def detail_key(request, pk):
+    generations = _generations(DETAIL_GENERATION, f'movies:{pk}:generation')
+    return 'movies:detail:{}:{}:{}:{}'.format(
+        pk, *generations, _params_digest(request))
+
+
+def invalidate_movie(pk=None):
+    '''Forget every list page and the detail of movie pk.
+
+    Without pk (bulk writes) every detail page is dropped as well.
+    '''
+    _bump(LIST_GENERATION)
+    if pk is None:
+        _bump(DETAIL_GENERATION)
+    else:
+        _bump(f'movies:{pk}:generation')
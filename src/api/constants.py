@@ -10,5 +10,21 @@ class Messages(object):
     RENT_QUANTITY_LOW = _("Rent quantity too low")
     RENT_QUANTITY_NOT_AVAI = _("Rent quantity not available")
     RENT_SUCCESSFULLY = _("Rent successfully")
+    RENT_CHECKOUT_PENDING = _(
+        "Rent successfully, poll status_url for the payment url")
+    RENT_CHECKOUT_NOT_READY = _(
+        "The payment of this rent is still being set up")
     MOVIE_BUYED = _("Movie buyed successfully")
+    ORDER_SUCCESSFULLY = _("Order successfully")
+    MOVIE_NOT_AVAILABLE = _("Movie not available")
+    CART_TOO_MANY_LINES = _("A cart holds at most {} lines")
     DUE_DATE_TOO_LOW = _("Due date too low")
+    DUE_DATE_REQUIRED = _("Rents need a due date")
+    IMPORT_FILE_REQUIRED = _("Upload a CSV or JSON Lines file")
+    IMPORT_FORMAT_UNKNOWN = _("Unknown format, expected one of: {}")
+    IMPORT_NOT_UTF8 = _("The file must be UTF-8 encoded")
+    BULK_SELECTION_REQUIRED = _("Send either ids or filter")
+    BULK_FILTER_UNKNOWN = _("Unknown filter parameters: {}")
+    BULK_FILTER_EMPTY = _("The filter must select movies by some value")
+    BULK_CHANGES_REQUIRED = _(
+        "Send at least one of availability, rental_price, sale_price")
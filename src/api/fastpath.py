@@ -0,0 +1,156 @@
+'''Read path for list endpoints that skips model instantiation.
+
+A FieldPlan is compiled once per request from a bound serializer: it
+records which columns to fetch with ``values()`` and, per output field,
+the conversion to apply. Conversions for the stock DRF field classes are
+specialized once per plan (timezone, decimal context, media URL prefix)
+and produce the same values as their ``to_representation``; any other
+field falls back to its own ``to_representation``. What is saved is the
+model instance per row and DRF's per-field attribute lookup.
+'''
+import decimal
+from collections import OrderedDict
+from urllib.parse import quote
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+
+from rest_framework import ISO_8601, serializers
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.settings import api_settings
+
+
+def _datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return field.to_representation
+    field_timezone = getattr(field, 'timezone', field.default_timezone())
+    if field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if value.tzinfo is None or isinstance(value, str):
+            return field.to_representation(value)
+        value = value.astimezone(field_timezone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return convert
+
+
+def _decimal_converter(field):
+    coerce_to_string = getattr(
+        field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.decimal_places is None:
+        return field.to_representation
+    quantum = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            return field.to_representation(value)
+        return '{:f}'.format(
+            value.quantize(quantum, rounding=rounding, context=context))
+    return convert
+
+
+def _file_converter(field, model_field):
+    '''values() only returns the stored name of a FileField/ImageField'''
+    def fallback(name):
+        return field.to_representation(FieldFile(None, model_field, name))
+
+    storage = model_field.storage
+    # Resolve DefaultStorage and other lazy wrappers
+    storage.base_url
+    storage = getattr(storage, '_wrapped', storage)
+    request = field.context.get('request')
+    use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+    if (not use_url or request is None
+            or type(storage).url is not FileSystemStorage.url
+            or not storage.base_url.startswith('/')):
+        return fallback
+    # FileSystemStorage.url + request.build_absolute_uri, resolved once
+    prefix = request.build_absolute_uri(storage.base_url)
+
+    def convert(name):
+        if not name:
+            return None
+        return prefix + quote(
+            name.replace('\\', '/').lstrip('/'), safe="/~!*()'")
+    return convert
+
+
+def compile_converter(field, model):
+    '''Return the function turning a column value into the field output,
+    None meaning the value is used as it comes from the database.'''
+    field_class = type(field)
+    if isinstance(field, PrimaryKeyRelatedField):
+        # values() already returns the foreign key value
+        return None
+    if field_class in (serializers.CharField, serializers.IntegerField):
+        return str if field_class is serializers.CharField else int
+    if field_class is serializers.BooleanField:
+        return bool
+    if field_class is serializers.DateField and (
+            getattr(field, 'format', api_settings.DATE_FORMAT) or ''
+    ).lower() == ISO_8601:
+        return field.to_representation
+    if field_class is serializers.DateTimeField:
+        return _datetime_converter(field)
+    if field_class is serializers.DecimalField:
+        return _decimal_converter(field)
+    if isinstance(field, serializers.FileField):
+        return _file_converter(field, model._meta.get_field(field.source))
+    return field.to_representation
+
+
+class FieldPlan(object):
+    '''Precompiled serializer field plan over ``values()`` rows.
+
+    overrides maps a field name to ``(columns, function(row))`` for fields
+    that don't read a single column, like nested serializers or
+    SerializerMethodField.
+    '''
+
+    def __init__(self, serializer, overrides=None):
+        overrides = overrides or {}
+        model = serializer.Meta.model
+        self.columns = []
+        self.steps = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if name in overrides:
+                columns, function = overrides[name]
+                self.columns.extend(columns)
+                self.steps.append((name, None, function))
+                continue
+            if isinstance(field, (
+                    serializers.BaseSerializer,
+                    serializers.SerializerMethodField)) or '.' in field.source:
+                raise ImproperlyConfigured(
+                    f'{type(serializer).__name__}.{name} needs an override '
+                    'to be used in a FieldPlan.')
+            self.columns.append(field.source)
+            self.steps.append(
+                (name, field.source, compile_converter(field, model)))
+
+    def render(self, rows):
+        steps = self.steps
+        data = []
+        for row in rows:
+            item = OrderedDict()
+            for name, column, convert in steps:
+                if column is None:
+                    item[name] = convert(row)
+                    continue
+                value = row[column]
+                if value is not None and convert is not None:
+                    value = convert(value)
+                item[name] = value
+            data.append(item)
+        return data
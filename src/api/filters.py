@@ -1,9 +1,154 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import (
+    Count, F, FilteredRelation, OuterRef, Q, Subquery, Sum)
+from django.utils import timezone
 from django_filters import rest_framework as filters
-from core.models import Movie
+from rest_framework.filters import OrderingFilter
+from core.models import CheckoutStatus, ExtraCharge, Movie, Rent
+from core.search import search_movies
 
 
 class MovieFilterSet(filters.FilterSet):
+    '''Catalog filters, ?search= ranks by full-text relevance.
+
+    Ranges use <field>_min/<field>_max, e.g. ?rental_price_max=3&in_stock=1
+    '''
+    search = filters.CharFilter(method='filter_search')
+    rental_price = filters.RangeFilter()
+    sale_price = filters.RangeFilter()
+    stock = filters.RangeFilter()
+    in_stock = filters.BooleanFilter(method='filter_in_stock')
 
     class Meta:
         model = Movie
         fields = ('title', 'availability')
+
+    def filter_search(self, queryset, name, value):
+        '''Rank movies by relevance of title and description to value'''
+        return search_movies(queryset, value)
+
+    def filter_in_stock(self, queryset, name, value):
+        if value:
+            return queryset.filter(stock__gt=0)
+        return queryset.filter(stock__lte=0)
+
+
+def filter_params(filterset):
+    '''Parameters a filterset reads, e.g. rental_price_min and
+    rental_price_max for the rental_price range'''
+    params = set()
+    for name, field in filterset.form.fields.items():
+        suffixes = getattr(field.widget, 'suffixes', None)
+        if suffixes:
+            params.update(
+                field.widget.suffixed(name, suffix) for suffix in suffixes)
+        else:
+            params.add(name)
+    return params
+
+
+class RentFilterSet(filters.FilterSet):
+    '''Rental history filters, e.g. ?returned=false&is_paid=true'''
+
+    class Meta:
+        model = Rent
+        fields = ('returned', 'is_paid')
+
+
+class MovieOrderingFilter(OrderingFilter):
+    '''?ordering=popularity ranks by the trending score of
+    core.popularity, most popular first, through one indexed join'''
+    aliases = {
+        'popularity': '-popularity_score',
+        '-popularity': 'popularity_score',
+    }
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        return [self.aliases.get(term, term) for term in ordering or ()]
+
+    def filter_queryset(self, request, queryset, view):
+        ordering = self.get_ordering(request, queryset, view)
+        if any(term.lstrip('-') == 'popularity_score' for term in ordering):
+            queryset = queryset.filter(popularity__isnull=False).annotate(
+                popularity_score=F('popularity__score'))
+        return super().filter_queryset(request, queryset, view)
+
+
+def price_buckets(edges):
+    '''[(min, max)] ranges between ascending edges, the last one open'''
+    edges = [Decimal(edge) for edge in edges]
+    return list(zip(edges, edges[1:] + [None]))
+
+
+def facet_counts(queryset, edges=None):
+    '''Counts per availability, stock and price bucket of the movies in
+    queryset, computed by a single aggregate query'''
+    buckets = price_buckets(edges or settings.MOVIE_PRICE_BUCKETS)
+    counts = {
+        'count': Count('pk'),
+        'available': Count('pk', filter=Q(availability=True)),
+        'in_stock': Count('pk', filter=Q(stock__gt=0)),
+    }
+    for field in ('rental_price', 'sale_price'):
+        for i, (low, high) in enumerate(buckets):
+            condition = Q(**{f'{field}__gte': low})
+            if high is not None:
+                condition &= Q(**{f'{field}__lt': high})
+            counts[f'{field}_{i}'] = Count('pk', filter=condition)
+    totals = queryset.order_by().aggregate(**counts)
+    return {
+        'count': totals['count'],
+        'availability': {
+            'true': totals['available'],
+            'false': totals['count'] - totals['available'],
+        },
+        'in_stock': {
+            'true': totals['in_stock'],
+            'false': totals['count'] - totals['in_stock'],
+        },
+        **{
+            field: [{
+                'min': f'{low:.2f}',
+                'max': None if high is None else f'{high:.2f}',
+                'count': totals[f'{field}_{i}'],
+            } for i, (low, high) in enumerate(buckets)]
+            for field in ('rental_price', 'sale_price')
+        },
+    }
+
+
+def rent_summary(queryset, today=None):
+    '''Open and overdue counts, total spent and unpaid extra charges of
+    the rents in queryset, computed by a single aggregate query.
+
+    A rent has at most one unpaid charge (extracharge_one_unpaid_per_rent)
+    so joining it doesn't repeat rents, the paid ones are summed by a
+    correlated subquery instead.
+    '''
+    today = today or timezone.localdate()
+    paid_fees = ExtraCharge.objects.filter(
+        rent=OuterRef('pk'), is_paid=True).order_by().values(
+        'rent').annotate(total=Sum('amount')).values('total')
+    # Rents whose checkout failed were never handed over
+    out = Q(returned=False) & ~Q(checkout_status=CheckoutStatus.FAILED)
+    totals = queryset.order_by().annotate(
+        unpaid_charge=FilteredRelation(
+            'extracharge', condition=Q(extracharge__is_paid=False)),
+        paid_fees=Subquery(paid_fees),
+    ).aggregate(
+        open=Count('pk', filter=out),
+        overdue=Count('pk', filter=out & Q(due_date__lt=today)),
+        rents_paid=Sum('amount', filter=Q(is_paid=True)),
+        fees_paid=Sum('paid_fees'),
+        unpaid=Sum('unpaid_charge__amount'),
+    )
+    spent = (totals['rents_paid'] or 0) + (totals['fees_paid'] or 0)
+    return {
+        'open': totals['open'],
+        'overdue': totals['overdue'],
+        'total_spent': f'{spent:.2f}',
+        'unpaid_extra_charges': f'{totals["unpaid"] or 0:.2f}',
+    }
@@ -0,0 +1,85 @@
+'''Data shared by the bench_* commands that need a large rents table.
+
+BenchData creates a user and some movies named after the benchmark and
+lets the database generate the rents with one INSERT ... SELECT over a
+number sequence, so a million rows take seconds instead of a million
+round trips. delete() removes all of it again.
+'''
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import Movie
+
+# n = 1..count, one row per rent to create
+SEQUENCE = {
+    'postgresql': 'SELECT n FROM generate_series(1, %s) AS seq(n)',
+    'sqlite': (
+        'WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL '
+        'SELECT n + 1 FROM seq WHERE n < %s) SELECT n FROM seq'),
+}
+
+# Rents spread round robin over the movies of the benchmark
+INSERT_RENTS = '''
+INSERT INTO core_rent (
+    rented_by_id, created_at, movie_id, returned, amount, {columns})
+SELECT %s, %s, movie.id, false, 1, {values}
+FROM ({sequence}) seq
+JOIN (
+    SELECT id, ROW_NUMBER() OVER (ORDER BY id) - 1 AS k FROM core_movie
+    WHERE title LIKE %s
+) movie ON movie.k = seq.n %% %s
+'''
+
+
+def timed(stdout, label, function, *args, **kwargs):
+    '''Run function and write how long it took and what it returned'''
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stdout.write(f'{label}: {time.perf_counter() - start:.2f}s ({result})')
+    return result
+
+
+class BenchData(object):
+    '''A user and movies titled "<name> <i>" and the rents of the user'''
+
+    def __init__(self, name, movies=1):
+        self.name = name
+        self.movies = movies
+        self.user = None
+
+    def create(self, **user_fields):
+        self.user = User.objects.create(username=self.name, **user_fields)
+        Movie.objects.bulk_create([
+            Movie(
+                title=f'{self.name} {i}', description='-', stock=0,
+                rental_price=1 + i % 5, sale_price=1)
+            for i in range(self.movies)])
+        return self
+
+    def insert_rents(self, count, columns, values, params=()):
+        '''Insert count rents, values are SQL expressions of seq.n for
+        the extra columns, returns the number of rows'''
+        ops = connection.ops
+        sql = INSERT_RENTS.format(
+            columns=', '.join(columns), values=', '.join(values),
+            sequence=SEQUENCE[connection.vendor])
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [
+                self.user.pk, ops.adapt_datetimefield_value(timezone.now()),
+                *params, count, f'{self.name} %', self.movies])
+            return cursor.rowcount
+
+    def delete(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM core_extracharge WHERE rent_id IN '
+                '(SELECT id FROM core_rent WHERE rented_by_id = %s)',
+                [self.user.pk])
+            cursor.execute(
+                'DELETE FROM core_rent WHERE rented_by_id = %s',
+                [self.user.pk])
+        Movie.objects.filter(title__startswith=f'{self.name} ').delete()
+        self.user.delete()
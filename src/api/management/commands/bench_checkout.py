@@ -0,0 +1,107 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import override_settings
+from django.urls import reverse
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import checkout
+from core.fake_stripe import FakeStripe
+from core.models import CheckoutStatus, Movie, Rent
+
+
+class Command(BaseCommand):
+    '''Compare rent_it with the checkout session created in the request
+    and in the STRIPE_CHECKOUT_ASYNC worker pool, against the local
+    Stripe stand-in with a realistic latency.
+
+    The request threads stand for web workers: synchronously each one is
+    busy for the whole Stripe round trip.
+
+    Usage: python manage.py bench_checkout [--requests 200]
+        [--threads 8] [--latency 0.3] [--workers 8]
+    '''
+    help = 'Benchmark synchronous vs asynchronous Stripe checkout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument(
+            '--threads', type=int, default=8, help='Concurrent clients')
+        parser.add_argument(
+            '--latency', type=float, default=0.3,
+            help='Seconds the fake Stripe takes per session')
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='STRIPE_CHECKOUT_WORKERS of the async run')
+
+    def handle(self, *args, **options):
+        movie = Movie.objects.create(
+            title='bench_checkout', description='-',
+            stock=2 * options['requests'], rental_price=1, sale_price=1)
+        users = [
+            User.objects.create(username=f'bench_checkout_{i}')
+            for i in range(options['threads'])]
+        tokens = [Token.objects.create(user=user).key for user in users]
+        url = reverse('movie-rent-it', args=[movie.pk])
+        data = {
+            'quantity': 1,
+            'due_date': (
+                datetime.now() + timedelta(days=2)).strftime('%d-%m-%Y'),
+        }
+
+        def rent(i):
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION='Token ' + tokens[i % len(tokens)])
+            start = time.perf_counter()
+            try:
+                code = client.post(
+                    url, data, HTTP_HOST='localhost').status_code
+            finally:
+                connections.close_all()
+            return code, time.perf_counter() - start
+
+        def run(asynchronous):
+            with override_settings(
+                    STRIPE_API_BASE=stripe.url,
+                    STRIPE_CHECKOUT_ASYNC=asynchronous,
+                    STRIPE_CHECKOUT_WORKERS=options['workers']):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(options['threads']) as pool:
+                    results = list(pool.map(rent, range(options['requests'])))
+                answered = time.perf_counter() - start
+                pending = Rent.objects.filter(
+                    movie=movie, checkout_status=CheckoutStatus.PENDING)
+                # Bounded, a job killed halfway leaves its rent pending
+                while pending.exists() and time.perf_counter() - start < 300:
+                    time.sleep(0.05)
+                done = time.perf_counter() - start
+            latencies = sorted(seconds for _, seconds in results)
+            codes = sorted({code for code, _ in results})
+            self.stdout.write(
+                f'{"async" if asynchronous else "sync ":5} '
+                f'codes {codes}: answered in {answered:.2f}s '
+                f'({options["requests"] / answered:.0f} req/s, '
+                f'p50 {statistics.median(latencies) * 1000:.0f}ms, '
+                f'p95 {latencies[int(len(latencies) * .95)] * 1000:.0f}ms),'
+                f' all sessions ready in {done:.2f}s')
+
+        try:
+            with FakeStripe(latency=options['latency']) as stripe:
+                self.stdout.write(
+                    f'{options["requests"]} rents, {options["threads"]} '
+                    f'clients, Stripe latency {options["latency"]}s')
+                run(asynchronous=False)
+                run(asynchronous=True)
+        finally:
+            checkout.get_executor().shutdown()
+            Rent.objects.filter(movie=movie).delete()
+            movie.delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from api.management.bench import BenchData, timed
+from core import late_fees
+
+# Due dates spread from 20 days ahead to 39 days late
+DUE_DATE = {
+    'postgresql': '(%s::date + 20 - (seq.n %% 60))',
+    'sqlite': "date(%s, (20 - seq.n %% 60) || ' days')",
+}
+
+
+class Command(BaseCommand):
+    '''Time core.late_fees against a large number of open rents.
+
+    Creates --rents open rents (two thirds of them overdue) with one
+    INSERT ... SELECT, accrues their fees as of today (inserts), again
+    (nothing to write) and as of tomorrow (updates), then deletes them.
+
+    Usage: python manage.py bench_late_fees [--rents 1000000]
+        [--batch-size 10000]
+    '''
+    help = 'Benchmark the late fee accrual job'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rents', type=int, default=1000000)
+        parser.add_argument(
+            '--batch-size', type=int, default=late_fees.BATCH_SIZE)
+        parser.add_argument('--movies', type=int, default=100)
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        data = BenchData('bench_late_fees', options['movies']).create()
+        today = timezone.localdate()
+
+        def create_rents():
+            created = data.insert_rents(
+                options['rents'],
+                ['due_date', 'quantity', 'is_paid'],
+                [DUE_DATE[vendor], '1 + seq.n %% 3', 'true'],
+                [connection.ops.adapt_datefield_value(today)])
+            return f'{created} rents'
+
+        def accrue(day):
+            written = late_fees.accrue(day, batch_size=options['batch_size'])
+            return f'{written} charges written'
+
+        try:
+            timed(self.stdout, 'create open rents', create_rents)
+            if vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+            timed(self.stdout, 'accrue today (insert)', accrue, today)
+            timed(
+                self.stdout, 'accrue today again (no-op)', accrue, today)
+            timed(
+                self.stdout, 'accrue tomorrow (update)', accrue,
+                today + timezone.timedelta(days=1))
+        finally:
+            data.delete()
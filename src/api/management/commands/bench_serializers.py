@@ -0,0 +1,118 @@
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from rest_framework.request import Request
+
+from api.fastpath import FieldPlan
+from api.serializers import MovieSerializer, RentSerializer, SaleSerializer
+from api.views import MovieViewSet
+from core.models import Movie, MovieImage, Rent, Sale
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    '''Compare the serializer and FieldPlan list paths.
+
+    Seeds movies, images, rents and sales inside a transaction that is
+    rolled back at the end, so it can run against any database.
+
+    Usage: python manage.py bench_serializers [--rows 1000 10000]
+    '''
+    help = 'Micro-benchmark of the fast list read path'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, rows, user):
+        movies = Movie.objects.bulk_create([
+            Movie(
+                title=f'Movie {i:06}', description='x' * 300, stock=10,
+                rental_price=Decimal('1.50'), sale_price=Decimal('20.00'))
+            for i in range(rows)])
+        if movies[0].pk is None:
+            movies = list(Movie.objects.order_by('id')[:rows])
+        MovieImage.objects.bulk_create([
+            MovieImage(movie=movie, image=f'movies/images/{movie.pk}.png')
+            for movie in movies])
+        Rent.objects.bulk_create([
+            Rent(
+                movie=movie, rented_by=user, quantity=1, amount=3,
+                due_date=date.today())
+            for movie in movies])
+        Sale.objects.bulk_create([
+            Sale(movie=movie, user=user, date=timezone.now(), amount=20)
+            for movie in movies])
+
+    def time(self, function, repeat):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    def run(self, sizes, repeat):
+        user = User.objects.create(username=f'bench-{datetime.now()}')
+        self.seed(max(sizes), user)
+        request = Request(RequestFactory().get(
+            '/api/movies/', HTTP_HOST='localhost'))
+        request.user = user
+        context = {'request': request}
+        view = MovieViewSet(request=request, format_kwarg=None)
+        cases = [
+            (MovieSerializer, Movie.objects.prefetch_related('movies'),
+             view.get_fast_overrides, view.prepare_fast_rows),
+            (RentSerializer, Rent.objects.all(), None, None),
+            (SaleSerializer, Sale.objects.select_related('user'),
+             lambda serializer: {'buyed_by': (
+                 ('user__username',),
+                 lambda row: row['user__username'])}, None),
+        ]
+        self.stdout.write(
+            f'{"serializer":<18}{"rows":>8}{"slow (s)":>12}'
+            f'{"fast (s)":>12}{"speedup":>10}')
+        for serializer_class, queryset, overrides, prepare in cases:
+            for size in sizes:
+                subset = queryset.order_by('id')[:size]
+
+                def slow():
+                    return serializer_class(
+                        subset, many=True, context=context).data
+
+                def fast():
+                    serializer = serializer_class(context=context)
+                    plan = FieldPlan(
+                        serializer, overrides(serializer) if overrides
+                        else None)
+                    rows = list(
+                        subset.prefetch_related(None).values(*plan.columns))
+                    if prepare:
+                        prepare(rows, serializer)
+                    return plan.render(rows)
+
+                slow_time = self.time(slow, repeat)
+                fast_time = self.time(fast, repeat)
+                self.stdout.write(
+                    f'{serializer_class.__name__:<18}{size:>8}'
+                    f'{slow_time:>12.4f}{fast_time:>12.4f}'
+                    f'{slow_time / fast_time:>9.1f}x')
@@ -0,0 +1,90 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core.models import Movie, Rent
+
+
+class Command(BaseCommand):
+    '''Fire concurrent rents at a few movies and report throughput.
+
+    Worker threads need committed rows, so the movies and users are
+    created for real and deleted at the end. The stock of every movie
+    must end at exactly max(0, stock - rents), never below.
+
+    Usage: python manage.py bench_stock [--requests 1000] [--threads 16]
+        [--stock 100] [--movies 1]
+    '''
+    help = 'Stress test of the atomic stock reservation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument(
+            '--stock', type=int, default=100, help='Units per movie')
+        parser.add_argument(
+            '--movies', type=int, default=1,
+            help='Spread the rents over N movies, 1 is worst contention')
+
+    def handle(self, *args, **options):
+        movies = [
+            Movie.objects.create(
+                title=f'bench_stock {i}', description='-',
+                stock=options['stock'], rental_price=1, sale_price=1)
+            for i in range(options['movies'])]
+        movie_ids = [movie.pk for movie in movies]
+        users = [
+            User.objects.create(username=f'bench_stock_{i}')
+            for i in range(options['threads'])]
+        tokens = [Token.objects.create(user=user).key for user in users]
+        due_date = (datetime.now() + timedelta(days=2)).strftime('%d-%m-%Y')
+
+        def rent(i):
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION='Token ' + tokens[i % len(tokens)])
+            try:
+                return client.post('/api/rents/', {
+                    'movie': movies[i % len(movies)].pk, 'quantity': 1,
+                    'due_date': due_date,
+                    'rented_by': users[i % len(users)].pk,
+                }, HTTP_HOST='localhost').status_code
+            finally:
+                connections.close_all()
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                codes = Counter(pool.map(rent, range(options['requests'])))
+            elapsed = time.perf_counter() - start
+            stocks = dict(Movie.objects.filter(pk__in=movie_ids).values_list(
+                'pk', 'stock'))
+            stocks = [stocks[movie.pk] for movie in movies]
+            rented = Rent.objects.filter(movie__in=movies).count()
+        finally:
+            Movie.objects.filter(pk__in=movie_ids).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        self.stdout.write(
+            f'{options["requests"]} rents, {options["threads"]} threads, '
+            f'{options["movies"]} movies x {options["stock"]} units: '
+            f'{elapsed:.2f}s, {options["requests"] / elapsed:.0f} req/s')
+        self.stdout.write(f'  status codes {dict(codes)}')
+        self.stdout.write(f'  rents {rented}, stock left {stocks}')
+        # Rents go round-robin, the first movies get one more on remainders
+        share, extra = divmod(options['requests'], len(movies))
+        expected = [
+            max(0, options['stock'] - share - (i < extra))
+            for i in range(len(movies))]
+        if stocks != expected or rented != codes[201]:
+            self.stderr.write(self.style.ERROR('Stock is inconsistent!'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Stock is consistent.'))
@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from stripe.http_client import RequestsClient
+
+from core import stripe_gateway
+from core.fake_stripe import FakeStripe
+
+
+class Command(BaseCommand):
+    '''Create checkout sessions against the local Stripe stand-in, first
+    with a new HTTP client (and connection) per call, then through
+    core.stripe_gateway, and compare.
+
+    Usage: python manage.py bench_stripe [--calls 2000] [--threads 8]
+        [--latency 0.0]
+    '''
+    help = 'Benchmark the pooled Stripe gateway offline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Seconds the fake Stripe takes per session')
+
+    def handle(self, *args, **options):
+        params = {
+            'mode': 'payment',
+            'success_url': 'http://localhost:8000/success/',
+            'cancel_url': 'http://localhost:8000/cancel/',
+            'line_items': [{'price': 'price_bench', 'quantity': 1}],
+        }
+
+        def unpooled(i):
+            # What every call costs without a shared client
+            requestor = stripe.api_requestor.APIRequestor(
+                'sk_test_bench', client=RequestsClient())
+            requestor.request('post', '/v1/checkout/sessions', params)
+
+        def pooled(i):
+            stripe_gateway.create_checkout_session(**params)
+
+        with FakeStripe(latency=options['latency']) as fake, \
+                override_settings(
+                    STRIPE_API_BASE=fake.url,
+                    STRIPE_SECRET_KEY='sk_test_bench'):
+            stripe_gateway.configure()
+            for name, call in (
+                    ('new client per call', unpooled),
+                    ('stripe_gateway', pooled)):
+                connections = fake.connections
+                start = time.perf_counter()
+                with ThreadPoolExecutor(options['threads']) as pool:
+                    list(pool.map(call, range(options['calls'])))
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f'{name:20} {options["calls"]} calls, '
+                    f'{options["threads"]} threads: {elapsed:.2f}s, '
+                    f'{options["calls"] / elapsed:.0f} calls/s, '
+                    f'{fake.connections - connections} connections')
+            calls = stripe_gateway.metrics()['POST /v1/checkout/sessions']
+            self.stdout.write(
+                f'gateway latency: mean {calls["mean"] * 1000:.1f}ms, '
+                f'p50 <= {calls["p50"] * 1000:g}ms, '
+                f'p95 <= {calls["p95"] * 1000:g}ms, '
+                f'p99 <= {calls["p99"] * 1000:g}ms, '
+                f'errors {calls["errors"]}, retries {calls["retries"]}')
@@ -0,0 +1,94 @@
+import random
+import time
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+from django.utils import timezone
+
+from api.management.bench import BenchData, timed
+from core.fake_stripe import signed_event
+from core.models import Rent
+
+
+class Command(BaseCommand):
+    '''Time the Stripe webhook against a large rents table.
+
+    Creates --rents unpaid rents with a payment reference each, then
+    posts --events signed charge.succeeded events for random ones to
+    webhooks/stripe/, first without the unique index on
+    payment_reference (--compare), then with it. Deletes the rents.
+
+    Usage: python manage.py bench_webhook [--rents 1000000]
+        [--events 200] [--compare]
+    '''
+    help = 'Benchmark the Stripe webhook payment lookup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rents', type=int, default=1000000)
+        parser.add_argument('--events', type=int, default=200)
+        parser.add_argument(
+            '--compare', action='store_true',
+            help='Time the webhook without the index first')
+
+    def post_events(self, label, rents, events):
+        client = Client()
+        url = reverse('stripe-webhook')
+        paid = random.sample(range(1, rents + 1), events)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for n in paid:
+                payload, signature = signed_event(
+                    'charge.succeeded', {'payment_intent': f'pi_bench_{n}'},
+                    'whsec_bench')
+                response = client.post(
+                    url, payload, content_type='application/json',
+                    HTTP_STRIPE_SIGNATURE=signature, HTTP_HOST='localhost')
+                assert response.status_code == 200, response
+            elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{label}: {events / elapsed:.0f} events/s, '
+            f'{elapsed / events * 1000:.2f} ms/event, '
+            f'{len(queries) / events:.0f} queries/event')
+
+    def set_unique(self, unique):
+        '''Add or drop the unique index of Rent.payment_reference'''
+        field = Rent._meta.get_field('payment_reference')
+        plain = field.clone()
+        plain._unique = False
+        plain.set_attributes_from_name(field.name)
+        plain.model = Rent
+        old, new = (plain, field) if unique else (field, plain)
+        with connection.schema_editor() as schema_editor:
+            schema_editor.alter_field(Rent, old, new)
+
+    @override_settings(
+        STRIPE_WEBHOOK_SECRET='whsec_bench',
+        EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend')
+    def handle(self, *args, **options):
+        data = BenchData('bench_webhook').create(email='bench@example.com')
+
+        def create_rents():
+            created = data.insert_rents(
+                options['rents'],
+                ['due_date', 'quantity', 'is_paid', 'payment_reference'],
+                ['%s', '1', 'false', "'pi_bench_' || seq.n"],
+                [connection.ops.adapt_datefield_value(timezone.localdate())])
+            return f'{created} rents'
+
+        try:
+            timed(self.stdout, 'create unpaid rents', create_rents)
+            if options['compare']:
+                self.set_unique(False)
+                try:
+                    self.post_events(
+                        'without index', options['rents'],
+                        options['events'])
+                finally:
+                    self.set_unique(True)
+            self.post_events(
+                'with unique index', options['rents'], options['events'])
+        finally:
+            data.delete()
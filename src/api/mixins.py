@@ -0,0 +1,204 @@
+import calendar
+import hashlib
+
+from itertools import islice
+
+from django.db.models import Count, Max
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_http_date, quote_etag
+
+from rest_framework import permissions
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+from api import cache as catalog_cache
+from api.fastpath import FieldPlan
+from api.renderers import dumps
+
+
+class ConditionalGetMixin(object):
+    '''Answer list and retrieve with 304 Not Modified when the client copy
+    is current.
+
+    The validators come from one aggregate over the filtered queryset
+    (max ``updated_at`` and row count), so a matching If-None-Match or
+    If-Modified-Since costs a single query and no serialization. Anything
+    that changes the representation must bump ``updated_at``.
+    '''
+    last_modified_field = 'updated_at'
+
+    def get_validators(self, request, queryset):
+        '''Return (etag, last_modified timestamp) or None if no rows'''
+        state = queryset.order_by().aggregate(
+            last_modified=Max(self.last_modified_field), count=Count('pk'))
+        if not state['count']:
+            return None
+        last_modified = state['last_modified']
+        key = '{}:{}:{}'.format(
+            last_modified.isoformat(), state['count'],
+            request.get_full_path())
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        return etag, calendar.timegm(last_modified.utctimetuple())
+
+    def conditional_response(self, request, queryset, handler, *args,
+                             **kwargs):
+        validators = self.get_validators(request, queryset)
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = validators
+        response = get_conditional_response(
+            request._request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            # Admins and anonymous users see different querysets,
+            # whichever way the user was authenticated
+            patch_vary_headers(response, ('Authorization', 'Cookie'))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(
+            request, queryset, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: kwargs[lookup_url_kwarg]})
+        return self.conditional_response(
+            request, queryset, super().retrieve, *args, **kwargs)
+
+
+class AnonymousCacheMixin(object):
+    '''Serve list and retrieve to anonymous users from the catalog cache.
+
+    Cached entries keep the ETag/Last-Modified of ConditionalGetMixin so
+    revalidation on a hit doesn't touch the database either. Responses
+    carry ``X-Cache: HIT`` or ``MISS``.
+    '''
+    cached_headers = ('ETag', 'Last-Modified', 'Vary')
+
+    def cached_response(self, request, key, handler, *args, **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+        cache = catalog_cache.get_cache()
+        entry = cache.get(key)
+        if entry is not None:
+            catalog_cache.stats.hit()
+            data, headers = entry
+            response = None
+            if 'ETag' in headers:
+                response = get_conditional_response(
+                    request._request, etag=headers['ETag'],
+                    last_modified=parse_http_date(headers['Last-Modified']))
+            if response is None:
+                response = Response(data)
+            for header, value in headers.items():
+                response[header] = value
+            response['X-Cache'] = 'HIT'
+            return response
+        catalog_cache.stats.miss()
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200 and hasattr(response, 'data'):
+            headers = {
+                header: response[header]
+                for header in self.cached_headers if response.has_header(
+                    header)}
+            cache.set(key, (response.data, headers))
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, catalog_cache.list_key(request), super().list,
+            *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        return self.cached_response(
+            request, catalog_cache.detail_key(request, pk),
+            super().retrieve, *args, **kwargs)
+
+
+class FastListMixin(object):
+    '''List through a FieldPlan over ``values()`` rows instead of
+    serializing model instances, see api.fastpath.
+
+    Viewsets provide overrides for nested or computed fields with
+    get_fast_overrides and can attach related rows to each page in
+    prepare_fast_rows. Set ``fast_list = False`` to use the serializer.
+    '''
+    fast_list = True
+
+    def get_fast_overrides(self, serializer):
+        return {}
+
+    def prepare_fast_rows(self, rows, serializer):
+        '''Attach related data to a page of rows, before rendering'''
+
+    def get_ordering_columns(self, queryset):
+        '''Columns the cursor paginator reads from the rows'''
+        names = set(getattr(self, 'ordering', None) or ())
+        names |= set(getattr(self, 'ordering_fields', None) or ())
+        names = {name.lstrip('-') for name in names}
+        return names | set(queryset.query.annotations)
+
+    def list(self, request, *args, **kwargs):
+        if not self.fast_list:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer()
+        plan = FieldPlan(serializer, self.get_fast_overrides(serializer))
+        columns = set(plan.columns) | self.get_ordering_columns(queryset)
+        rows = queryset.prefetch_related(None).values(*columns)
+        page = self.paginate_queryset(rows)
+        rows = list(rows) if page is None else page
+        self.prepare_fast_rows(rows, serializer)
+        if page is not None:
+            return self.get_paginated_response(plan.render(rows))
+        return Response(plan.render(rows))
+
+
+class StreamingExportMixin(object):
+    '''Admin-only ``export/`` action streaming every filtered row as one
+    JSON array.
+
+    Rows are read with a chunked ``iterator()`` and rendered through the
+    FastListMixin plan one chunk at a time, so peak memory depends on
+    export_chunk_size and not on the table size.
+    '''
+    export_chunk_size = 2000
+
+    def stream_rows(self, rows, plan, serializer):
+        yield b'['
+        separator = b''
+        while True:
+            chunk = list(islice(rows, self.export_chunk_size))
+            if not chunk:
+                break
+            self.prepare_fast_rows(chunk, serializer)
+            yield separator + b','.join(
+                dumps(item) for item in plan.render(chunk))
+            separator = b','
+        yield b']'
+
+    @action(
+        detail=False, methods=['get'],
+        permission_classes=[permissions.IsAdminUser])
+    def export(self, request, *args, **kwargs):
+        '''Stream the filtered queryset, same fields as the list
+
+        Endpoint api/<resource>/export/
+        return: StreamingHttpResponse (application/json)
+        '''
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer()
+        plan = FieldPlan(serializer, self.get_fast_overrides(serializer))
+        rows = queryset.prefetch_related(None).values(
+            *plan.columns).iterator(chunk_size=self.export_chunk_size)
+        return StreamingHttpResponse(
+            self.stream_rows(rows, plan, serializer),
+            content_type='application/json')
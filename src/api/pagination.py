@@ -0,0 +1,155 @@
+from base64 import b64decode, b64encode
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+def reverse_ordering(ordering):
+    return tuple(
+        field[1:] if field.startswith('-') else '-' + field
+        for field in ordering)
+
+
+class KeysetCursorPagination(CursorPagination):
+    '''Cursor pagination seeking on every field of the ordering.
+
+    DRF's cursor only holds the first ordering field, rows sharing its
+    value are skipped with an OFFSET capped at offset_cutoff: past 1000
+    ties (like_count = 0) pages repeat rows. Here the cursor holds the
+    whole position of the last row and the ordering ends with a unique
+    field, so the next page is
+
+        WHERE a > x OR (a = x AND id > y) ORDER BY a, id LIMIT n
+
+    an index seek whatever the number of ties.
+    '''
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.reverse)
+        position = self.cursor.position if self.cursor else None
+        ordering = (
+            reverse_ordering(self.ordering) if reverse else self.ordering)
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            if len(position) != len(ordering):
+                raise NotFound(self.invalid_cursor_message)
+            try:
+                queryset = queryset.filter(self.after(ordering, position))
+            except (TypeError, ValueError, ValidationError):
+                # Tampered with, or from another ?ordering=
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def after(self, ordering, position):
+        '''Rows following position in ordering'''
+        condition = None
+        for field, value in reversed(list(zip(ordering, position))):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            following = Q(**{f'{name}__{lookup}': value})
+            if condition is not None:
+                following |= Q(**{name: value}) & condition
+            condition = following
+        return condition
+
+    def get_position(self, item):
+        fields = [field.lstrip('-') for field in self.ordering]
+        if isinstance(item, dict):
+            return [str(item[field]) for field in fields]
+        return [str(getattr(item, field)) for field in fields]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # Nothing before a reverse cursor, the first page follows
+        position = self.get_position(self.page[-1]) if self.page else None
+        return self.encode_cursor(
+            Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.get_position(self.page[0]) if self.page else None
+        return self.encode_cursor(
+            Cursor(offset=0, reverse=True, position=position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = parse.parse_qs(
+                b64decode(encoded.encode('ascii')).decode('ascii'),
+                keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(offset=0, reverse=reverse, position=tokens.get('p'))
+
+    def encode_cursor(self, cursor):
+        tokens = {}
+        if cursor.reverse:
+            tokens['r'] = '1'
+        if cursor.position is not None:
+            tokens['p'] = cursor.position
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded)
+
+
+class MovieCursorPagination(KeysetCursorPagination):
+    '''Keyset pagination for the movie catalog.
+
+    The cursor encodes the last seen position of Movie.Meta.ordering
+    (title, then id as tie-breaker) so every page is resolved with an
+    indexed range scan, no OFFSET over the previous pages and no COUNT(*).
+    '''
+    ordering = ('title', 'id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        '''Search results keep their relevance order while paging'''
+        if 'rank' in queryset.query.annotations:
+            return ('-rank', 'id')
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        # id makes every position unique, rows sharing the other values
+        # are paged through by it
+        if 'id' not in ordering:
+            ordering += ('id',)
+        return ordering
+
+
+class RentCursorPagination(KeysetCursorPagination):
+    '''Keyset pagination of the rental history, newest first.
+
+    Seeks on (rented_by, created_at, id) with rent_history_idx, so deep
+    pages of heavy renters cost the same as the first one, and rents
+    created in the same instant (a cart) are paged by id.
+    '''
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -1,23 +1,87 @@
+from collections import Counter
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib.admin.models import LogEntry, ACTION_FLAG_CHOICES
+from django.db import transaction
+from django.utils import timezone
 
 from rest_framework import serializers
 from api.constants import Messages
 
-from core.models import Movie, MovieImage, Rent, Sale
+from core import stock
+from core.models import Movie, MovieImage, Order, Rent, Sale
+from core.thumbnails import derivative_names
+
+
+def sparse_fieldset(request, serializer_class):
+    '''Names of the fields a GET asked for with ?fields= and ?omit=.
+
+    Both take comma separated names, unknown names are ignored. Fields
+    listed in Meta.optional_fields are only rendered when asked for.
+    '''
+    meta = serializer_class.Meta
+    available = set(meta.fields)
+    optional = set(getattr(meta, 'optional_fields', ()))
+    fields = request.query_params.get('fields')
+    if fields:
+        selected = available & set(fields.split(','))
+    else:
+        selected = available - optional
+    omit = request.query_params.get('omit')
+    if omit:
+        selected -= set(omit.split(','))
+    return selected
+
+
+class SparseFieldsetMixin(object):
+    '''Drop the fields not selected by sparse_fieldset on GET requests'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is not None and request.method == 'GET':
+            selected = sparse_fieldset(request, type(self))
+            for name in set(self.fields) - selected:
+                self.fields.pop(name)
+
+
+def thumbnail_urls(name, request=None):
+    '''{size: {format: url}} of the derivatives of an image name'''
+    storage = MovieImage._meta.get_field('image').storage
+    build = request.build_absolute_uri if request else str
+    return {
+        size: {
+            extension: build(storage.url(derivative))
+            for extension, derivative in formats.items()
+        } for size, formats in derivative_names(name).items()
+    }
 
 
 class MovieImageSerializer(serializers.ModelSerializer):
+    '''thumbnails stays null until core.thumbnails has built them'''
+    thumbnails = serializers.SerializerMethodField()
+
     class Meta:
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'thumbnails']
         model = MovieImage
 
+    def get_thumbnails(self, obj):
+        if not obj.thumbnails_ready or not obj.image:
+            return None
+        return thumbnail_urls(obj.image.name, self.context.get('request'))
 
-class MovieSerializer(serializers.ModelSerializer):
-    '''Movie translate models to JSON and perform actions to CRUD op'''
+
+class MovieSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    '''Movie translate models to JSON and perform actions to CRUD op
+
+    List screens can ask for a compact representation, for example
+    ?fields=id,title,rental_price,cover
+    '''
     images = MovieImageSerializer(
-        source='movieimage_set', many=True, read_only=True)
+        source='movies', many=True, read_only=True)
+    cover = serializers.SerializerMethodField()
+    like_count = serializers.IntegerField(read_only=True)
     quantity = serializers.IntegerField(write_only=True, required=False)
 
     class Meta:
@@ -30,10 +94,49 @@ class MovieSerializer(serializers.ModelSerializer):
             'sale_price',
             'availability',
             'images',
+            'cover',
+            'like_count',
             'quantity',
         )
+        optional_fields = ('cover',)
         model = Movie
 
+    def get_cover(self, obj):
+        '''URL of the first image, uses the prefetched images'''
+        images = obj.movies.all()
+        if not images:
+            return None
+        url = images[0].image.url
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+class MovieBulkUpdateSerializer(serializers.Serializer):
+    '''Validate a bulk change of availability and prices.
+
+    The movies are picked either by ``ids`` or by ``filter``, a dict of
+    the same parameters /api/movies/ accepts (see MovieFilterSet).
+    '''
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, allow_empty=False)
+    filter = serializers.DictField(required=False, allow_empty=False)
+    availability = serializers.BooleanField(required=False)
+    rental_price = serializers.DecimalField(
+        max_digits=8, decimal_places=2, min_value=0, required=False)
+    sale_price = serializers.DecimalField(
+        max_digits=8, decimal_places=2, min_value=0, required=False)
+
+    changes = ('availability', 'rental_price', 'sale_price')
+
+    def validate(self, attrs):
+        if ('ids' in attrs) == ('filter' in attrs):
+            raise serializers.ValidationError(
+                {'ids': Messages.BULK_SELECTION_REQUIRED})
+        if not any(name in attrs for name in self.changes):
+            raise serializers.ValidationError(
+                {'availability': Messages.BULK_CHANGES_REQUIRED})
+        return attrs
+
 
 class RentSerializer(serializers.ModelSerializer):
     '''Rent translate models to JSON and perform actions to CRUD op
@@ -75,6 +178,18 @@ class RentSerializer(serializers.ModelSerializer):
         attrs['amount'] = quantity * attrs['movie'].rental_price * days
         return attrs
 
+    def create(self, validated_data):
+        '''Take the rented units from the stock with the rent insert,
+        validate() only saw a snapshot of it'''
+        with transaction.atomic():
+            try:
+                stock.reserve(
+                    validated_data['movie'].pk, validated_data['quantity'])
+            except stock.OutOfStock:
+                raise serializers.ValidationError(
+                    {'quantity': Messages.RENT_QUANTITY_NOT_AVAI})
+            return super().create(validated_data)
+
 
 class LogEntryMovieSerializer(serializers.ModelSerializer):
     '''Rent translate models to JSON and perform history view of
@@ -145,8 +260,135 @@ class SaleSerializer(serializers.ModelSerializer):
         if not quantity <= attrs['movie'].stock:
             raise serializers.ValidationError(
                 {'message': Messages.RENT_QUANTITY_NOT_AVAI})
-        del attrs['quantity']
         return attrs
 
+    def create(self, validated_data):
+        '''Take the sold units from the stock with the sale insert'''
+        with transaction.atomic():
+            try:
+                stock.reserve(
+                    validated_data['movie'].pk, validated_data['quantity'])
+            except stock.OutOfStock:
+                raise serializers.ValidationError(
+                    {'message': Messages.RENT_QUANTITY_NOT_AVAI})
+            return super().create(validated_data)
+
     def get_buyed_by(self, obj):
         return obj.user.username
+
+
+class CartLineSerializer(serializers.Serializer):
+    '''One movie of a cart, rented until due_date or bought'''
+    RENT, BUY = 'rent', 'buy'
+
+    movie = serializers.IntegerField()
+    kind = serializers.ChoiceField(choices=(RENT, BUY), default=RENT)
+    quantity = serializers.IntegerField()
+    due_date = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        if not attrs['quantity'] > 0:
+            raise serializers.ValidationError(
+                {'quantity': Messages.RENT_QUANTITY_LOW})
+        if attrs['kind'] == self.RENT:
+            if 'due_date' not in attrs:
+                raise serializers.ValidationError(
+                    {'due_date': Messages.DUE_DATE_REQUIRED})
+            if attrs['due_date'] <= datetime.now().date():
+                raise serializers.ValidationError(
+                    {'due_date': Messages.DUE_DATE_TOO_LOW})
+        return attrs
+
+
+class CartSerializer(serializers.Serializer):
+    '''Rent and buy several movies at once, paid in a single order.
+
+    Every line is checked against a snapshot of the stock loaded in one
+    query, then create() takes all the units in one UPDATE and inserts
+    the order, its rents and its sales in one transaction.
+    '''
+    lines = CartLineSerializer(many=True, allow_empty=False)
+
+    def validate_lines(self, lines):
+        if len(lines) > settings.CART_MAX_LINES:
+            raise serializers.ValidationError(
+                Messages.CART_TOO_MANY_LINES.format(settings.CART_MAX_LINES))
+        movies = Movie.objects.filter(availability=True).only(
+            'id', 'title', 'stock', 'rental_price', 'sale_price').in_bulk(
+            {line['movie'] for line in lines})
+        wanted = Counter()
+        for line in lines:
+            wanted[line['movie']] += line['quantity']
+        # One entry per line like the errors of the line fields
+        errors = []
+        for line in lines:
+            movie = movies.get(line['movie'])
+            if movie is None:
+                errors.append({'movie': Messages.MOVIE_NOT_AVAILABLE})
+            elif wanted[movie.pk] > movie.stock:
+                errors.append({'quantity': Messages.RENT_QUANTITY_NOT_AVAI})
+            else:
+                errors.append({})
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        today = datetime.now().date()
+        for line in lines:
+            line['movie'] = movie = movies[line['movie']]
+            if line['kind'] == CartLineSerializer.RENT:
+                days = (line['due_date'] - today).days
+                line['amount'] = line['quantity'] * movie.rental_price * days
+            else:
+                line['amount'] = line['quantity'] * movie.sale_price
+        return lines
+
+    def create(self, validated_data):
+        '''Order of validated_data['user'] with a rent or a sale per
+        line, the stock of every movie taken at once'''
+        lines, user = validated_data['lines'], validated_data['user']
+        quantities = Counter()
+        for line in lines:
+            quantities[line['movie'].pk] += line['quantity']
+        now = timezone.now()
+        with transaction.atomic():
+            try:
+                stock.reserve_many(quantities)
+            except stock.OutOfStock:
+                raise serializers.ValidationError(
+                    {'lines': Messages.RENT_QUANTITY_NOT_AVAI})
+            order = Order.objects.create(
+                user=user, amount=sum(line['amount'] for line in lines),
+                checkout_status=validated_data.get('checkout_status'))
+            Rent.objects.bulk_create([
+                Rent(
+                    order=order, rented_by=user, movie=line['movie'],
+                    quantity=line['quantity'], due_date=line['due_date'],
+                    amount=line['amount'])
+                for line in lines if line['kind'] == CartLineSerializer.RENT])
+            Sale.objects.bulk_create([
+                Sale(
+                    order=order, user=user, movie=line['movie'],
+                    quantity=line['quantity'], date=now,
+                    amount=line['amount'])
+                for line in lines if line['kind'] == CartLineSerializer.BUY])
+        return order
+
+
+class OrderSerializer(serializers.ModelSerializer):
+    '''Order with its rents and sales, read only'''
+    rents = RentSerializer(many=True, read_only=True)
+    sales = SaleSerializer(many=True, read_only=True)
+
+    class Meta:
+        fields = (
+            'id',
+            'user',
+            'created_at',
+            'amount',
+            'is_paid',
+            'paid_at',
+            'checkout_status',
+            'rents',
+            'sales',
+        )
+        read_only_fields = fields
+        model = Order
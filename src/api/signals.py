@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from api.cache import invalidate_movie
+from core.models import Movie, MovieImage
+from core.signals import movies_bulk_changed, movies_stock_changed
+
+
+def invalidate(pk):
+    '''Invalidate now and again on commit, so a response computed from the
+    pre-commit state by another request can't outlive the write'''
+    invalidate_movie(pk)
+    transaction.on_commit(lambda: invalidate_movie(pk))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def invalidate_movie_cache(sender, instance, **kwargs):
+    '''Covers set_available/set_unavailable, they save the movie'''
+    invalidate(instance.pk)
+
+
+@receiver(post_save, sender=MovieImage)
+@receiver(post_delete, sender=MovieImage)
+def invalidate_movie_image_cache(sender, instance, **kwargs):
+    invalidate(instance.movie_id)
+
+
+@receiver(m2m_changed, sender=Movie.likes.through)
+def invalidate_movie_likes_cache(sender, instance, reverse, **kwargs):
+    '''like_count is part of the representation'''
+    if kwargs['action'].startswith('post_'):
+        invalidate(None if reverse else instance.pk)
+
+
+@receiver(movies_bulk_changed)
+def invalidate_catalog_cache(sender, **kwargs):
+    invalidate(None)
+
+
+@receiver(movies_stock_changed)
+def invalidate_movie_stock_cache(sender, pks, **kwargs):
+    '''stock and in_stock are part of the representation, core.stock
+    changes them with UPDATEs'''
+    for pk in pks:
+        invalidate(pk)
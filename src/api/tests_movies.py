@@ -1,16 +1,46 @@
 # Create your tests here.
+import io
+import json
+import os
+from base64 import b64encode
 from datetime import datetime, timedelta
+from decimal import Decimal
+import tempfile
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.conf import settings
 
+from PIL import Image
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import PermissionDenied
+from rest_framework.renderers import JSONRenderer
 from api.constants import Messages
 
-from core.models import Movie
+from api.cache import get_cache as get_catalog_cache, stats
+from api.renderers import FastJSONRenderer
+from api.views import MovieViewSet
+from core import thumbnails
+from core.autocomplete import title_index
+from core.fake_stripe import FakeStripe
+from core.importer import MovieImporter
+from core.models import (
+    Movie, MovieImage, MoviePopularity, MovieSimilarity, Rent, Sale)
+from core.storage import image_storage
 
 
 class MovieTestCase(APITestCase):
@@ -43,6 +73,7 @@ class MovieTestCase(APITestCase):
         self.token = str(Token.objects.create(user=user))
         self.tokennotadmin = str(Token.objects.create(
             user=self.normal_user))
+        get_catalog_cache().clear()
 
     def test_create_movie_as_admin_any_images(self):
         '''Test create images as an admin without at least one image should fail.
@@ -72,12 +103,161 @@ class MovieTestCase(APITestCase):
         '''
         self.authclient = APIClient()
         self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
-        with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file:
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media), open(
+                f'{settings.STATIC_ROOT}/test.png', 'rb') as file:
             self.movie['images'] = [file]
             response = self.authclient.post(
                 self.user_create_url, self.movie, format="multipart")
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    @override_settings(MOVIE_THUMBNAIL_WORKERS=0)
+    def test_thumbnails_after_upload(self):
+        '''Derivatives are built once the upload is committed and exposed
+        by the images of the movie.
+
+        Endpoint tested:
+            api/movies/ POST
+            api/movies/<id>/ GET
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media):
+            with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file:
+                self.movie['images'] = [file]
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.authclient.post(
+                        self.user_create_url, self.movie, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.authclient.get(
+                reverse('movie-detail', args=[response.data['id']]))
+            image = response.data['images'][0]
+            self.assertEqual(set(image['thumbnails']), set(thumbnails.SIZES))
+            url = image['thumbnails']['small']['webp']
+            name = url.split(settings.MEDIA_URL, 1)[1]
+            self.assertTrue(name.endswith('_small.webp'))
+            with default_storage.open(name) as file, Image.open(file) as small:
+                self.assertEqual(small.format, 'WEBP')
+                self.assertLessEqual(small.width, thumbnails.SIZES['small'][0])
+            self.assertEqual(
+                self.authclient.get(self.user_create_url).data['results'][0][
+                    'images'], response.data['images'])
+
+            # The backfill command rebuilds them in worker processes
+            MovieImage.objects.update(thumbnails_ready=False)
+            default_storage.delete(name)
+            call_command('build_thumbnails', workers=1, stdout=StringIO())
+            self.assertTrue(MovieImage.objects.get().thumbnails_ready)
+            self.assertTrue(default_storage.exists(name))
+
+    def png_bytes(self, color):
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), color).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def test_create_movie_with_images_is_atomic(self):
+        '''Images are inserted with one INSERT and their files only land
+        in media once the movie is committed.
+
+        Endpoint tested:
+            api/movies/ POST
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media, MOVIE_THUMBNAIL_WORKERS=0):
+            images = os.path.join(media, 'movies', 'images')
+            with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file:
+                self.movie['images'] = [file, SimpleUploadedFile(
+                    'blue.png', self.png_bytes('blue'), 'image/png')]
+                with CaptureQueriesContext(connection) as queries, \
+                        self.captureOnCommitCallbacks() as callbacks:
+                    response = self.authclient.post(
+                        self.user_create_url, self.movie, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(response.data['images']), 2)
+            self.assertEqual(len([
+                query for query in queries.captured_queries
+                if query['sql'].startswith('INSERT INTO "core_movieimage"')
+            ]), 1)
+            # Only staged uploads until the transaction commits
+            self.assertTrue(all(
+                name.startswith('.upload-') for name in os.listdir(images)))
+            for callback in callbacks:
+                callback()
+            names = {
+                os.path.basename(image.image.name)
+                for image in MovieImage.objects.all()}
+            self.assertEqual(len(names), 2)
+            self.assertTrue(names <= set(os.listdir(images)))
+            self.assertFalse(any(
+                name.startswith('.upload-') for name in os.listdir(images)))
+
+            # A failing insert leaves neither rows nor files behind
+            Movie.objects.all().delete()
+            for name in os.listdir(images):
+                os.remove(os.path.join(images, name))
+            with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file, \
+                    mock.patch.object(
+                        MovieImage.objects, 'bulk_create',
+                        side_effect=DatabaseError):
+                self.movie['images'] = [file]
+                with self.assertRaises(DatabaseError):
+                    self.authclient.post(
+                        self.user_create_url, self.movie, format='multipart')
+            self.assertFalse(Movie.objects.exists())
+            self.assertEqual(os.listdir(images), [])
+
+    def test_identical_images_stored_once(self):
+        '''The same poster uploaded for two movies is one file, deleted
+        with the last image referring to it.
+
+        Endpoint tested:
+            api/movies/ POST
+            api/movies/<id>/ DELETE
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media, MOVIE_IMAGE_GC_MIN_AGE=0,
+                MOVIE_THUMBNAIL_WORKERS=0):
+            ids = []
+            for title in ('Edition 1', 'Edition 2'):
+                with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file,\
+                        self.captureOnCommitCallbacks(execute=True):
+                    data = {**self.movie, 'title': title, 'images': [file]}
+                    response = self.authclient.post(
+                        self.user_create_url, data, format='multipart')
+                ids.append(response.data['id'])
+            first, second = MovieImage.objects.order_by('id')
+            self.assertEqual(first.image.name, second.image.name)
+            name = first.image.name
+            self.assertRegex(name, r'^movies/images/[0-9a-f]{64}\.png$')
+            originals = [
+                filename for filename in os.listdir(
+                    os.path.join(media, 'movies', 'images'))
+                if '_' not in filename]
+            self.assertEqual(originals, [os.path.basename(name)])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.authclient.delete(reverse('movie-detail', args=[ids[0]]))
+            self.assertTrue(image_storage.exists(name))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.authclient.delete(reverse('movie-detail', args=[ids[1]]))
+            self.assertFalse(image_storage.exists(name))
+
+            # Orphans left by replaced images are swept by gc_images
+            movie = Movie.objects.create(**self.movie)
+            with open(f'{settings.STATIC_ROOT}/test.png', 'rb') as file:
+                live = MovieImage.objects.create(
+                    movie=movie, image=File(file, 'poster.png')).image.name
+            orphan = image_storage.save_verbatim(
+                'movies/images/orphan.png', ContentFile(b'x'))
+            call_command('gc_images', min_age=0, stdout=StringIO())
+            self.assertFalse(image_storage.exists(orphan))
+            self.assertTrue(image_storage.exists(live))
+
     def test_create_movie_as_normaluser_one_images(self):
         '''Test create images as a normal user should not be saved.
 
@@ -109,7 +289,618 @@ class MovieTestCase(APITestCase):
         Movie.objects.all().delete()
         response = self.client.get(self.user_create_url, data={})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertCountEqual(response.data, [])
+        self.assertCountEqual(response.data['results'], [])
+
+    def test_list_movies_cursor_pagination(self):
+        '''Walk the catalog with the cursor, titles repeat on purpose so the
+        id tie-breaker is exercised.
+
+        Endpoint tested:
+            api/movies/?page_size=2 GET
+        '''
+        for title in ['B', 'A', 'A', 'C', 'A']:
+            Movie.objects.create(**{**self.movie, 'title': title})
+        expected = list(Movie.objects.values_list('id', flat=True))
+        seen = []
+        url = f'{self.user_create_url}?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen += [movie['id'] for movie in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+
+    def test_cursor_pagination_through_ties(self):
+        '''More rows share a like_count than DRF's offset cutoff (1000),
+        the (like_count, id) cursor still walks each row once, both ways,
+        and never needs an OFFSET.
+
+        Endpoint tested:
+            api/movies/?ordering=-like_count&page_size=100 GET
+        '''
+        Movie.objects.bulk_create([
+            Movie(**{**self.movie, 'title': f'M{i}'}) for i in range(1100)])
+        Movie.objects.filter(title='M7').update(like_count=3)
+        expected = list(Movie.objects.order_by(
+            '-like_count', 'id').values_list('id', flat=True))
+        pages = []
+        url = f'{self.user_create_url}?ordering=-like_count&page_size=100'
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                response = self.client.get(url)
+                pages.append([
+                    movie['id'] for movie in response.data['results']])
+                url = response.data['next']
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(len(pages), 11)
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'OFFSET' in query['sql']])
+        # And back from the last page
+        url = response.data['previous']
+        for page in reversed(pages[:-1]):
+            response = self.client.get(url)
+            self.assertEqual(
+                [movie['id'] for movie in response.data['results']], page)
+            url = response.data['previous']
+        self.assertIsNone(url)
+
+    def test_cursor_pagination_invalid_cursor(self):
+        '''Cursors whose values don't fit the ordering are answered 404.
+
+        Endpoint tested:
+            api/movies/?ordering=like_count&cursor= GET
+        '''
+        for i in range(3):
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+        url = f'{self.user_create_url}?ordering=like_count'
+        tampered = b64encode(b'p=abc&p=1').decode('ascii')
+        response = self.client.get(f'{url}&cursor={tampered}')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # A (title, id) cursor reused with the (like_count, id) ordering
+        response = self.client.get(
+            self.user_create_url, data={'page_size': 1})
+        cursor = parse_qs(urlparse(response.data['next']).query)['cursor']
+        response = self.client.get(
+            self.user_create_url,
+            data={'ordering': 'like_count', 'cursor': cursor[0]})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_movies_query_count(self):
+        '''Listing movies runs the same number of queries for any page size,
+        one for the ETag validators, one for movies and one for the images.
+
+        Endpoint tested:
+            api/movies/ GET
+        '''
+        for i in range(10):
+            movie = Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            movie.likes.add(self.normal_user)
+            MovieImage.objects.bulk_create([
+                MovieImage(movie=movie, image=f'movies/images/{i}-{j}.png')
+                for j in range(2)])
+        for page_size in (2, 10):
+            with self.assertNumQueries(3):
+                response = self.client.get(
+                    self.user_create_url, data={'page_size': page_size})
+            self.assertEqual(len(response.data['results']), page_size)
+        first = response.data['results'][0]
+        self.assertEqual(len(first['images']), 2)
+        self.assertEqual(first['like_count'], 1)
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('movie-detail', args=[first['id']]))
+        self.assertEqual(len(response.data['images']), 2)
+
+    def test_search_movies(self):
+        '''Full-text search ranks title hits above description hits and
+        follows updates and deletes.
+
+        Endpoint tested:
+            api/movies/?search= GET
+        '''
+        in_title = Movie.objects.create(**{
+            **self.movie, 'title': 'The Matrix', 'description': 'Neo'})
+        in_description = Movie.objects.create(**{
+            **self.movie, 'title': 'Animatrix',
+            'description': 'Shorts set in the Matrix universe'})
+        Movie.objects.create(**{**self.movie, 'title': 'Alien'})
+        response = self.client.get(
+            self.user_create_url, data={'search': 'matrix'})
+        ids = [movie['id'] for movie in response.data['results']]
+        self.assertEqual(ids, [in_title.id, in_description.id])
+
+        in_title.title = 'Reloaded'
+        in_title.save()
+        in_description.delete()
+        response = self.client.get(
+            self.user_create_url, data={'search': 'matrix'})
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get(
+            self.user_create_url, data={'search': 'reloaded "'})
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_autocomplete_movies(self):
+        '''Typeahead returns id and title by prefix, hides unavailable
+        movies and follows saves and deletes.
+
+        Endpoint tested:
+            api/movies/autocomplete/?q= GET
+        '''
+        url = reverse('movie-autocomplete')
+        title_index.invalidate()
+        for title in ['Star Wars', 'Stardust', 'Alien']:
+            Movie.objects.create(**{**self.movie, 'title': title})
+        Movie.objects.create(
+            **{**self.movie, 'title': 'Stargate', 'availability': False})
+        response = self.client.get(url, data={'q': 'sTaR'})
+        self.assertEqual(
+            [movie['title'] for movie in response.data],
+            ['Star Wars', 'Stardust'])
+        self.assertEqual(set(response.data[0]), {'id', 'title'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Movie.objects.get(title='Alien').delete()
+            Movie.objects.create(**{**self.movie, 'title': 'Starman'})
+        response = self.client.get(url, data={'q': 'star', 'limit': 2})
+        self.assertEqual(
+            [movie['title'] for movie in response.data],
+            ['Star Wars', 'Stardust'])
+        response = self.client.get(url, data={'q': 'starm'})
+        self.assertEqual(response.data[0]['title'], 'Starman')
+        response = self.client.get(url, data={'q': 'al'})
+        self.assertEqual(response.data, [])
+
+    def test_conditional_get_movies(self):
+        '''A matching If-None-Match or If-Modified-Since gets a 304 after a
+        single query, any change to the movies gives a new ETag.
+
+        Endpoint tested:
+            api/movies/ GET
+            api/movies/<:id>/ GET
+        '''
+        # Authenticated, anonymous reads would be answered by the cache
+        self.authclient = APIClient()
+        self.authclient.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.tokennotadmin)
+        movie = Movie.objects.create(**self.movie)
+        changes = [movie.likes.add, movie.likes.remove]
+        for url, change in zip((self.user_create_url,
+                                reverse('movie-detail', args=[movie.id])),
+                               changes):
+            response = self.authclient.get(url)
+            etag = response['ETag']
+            # Token lookup and validators
+            with self.assertNumQueries(2):
+                response = self.authclient.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(
+                response.status_code, status.HTTP_304_NOT_MODIFIED)
+            response = self.authclient.get(
+                url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(
+                response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            change(self.normal_user)
+            response = self.authclient.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_anonymous_catalog_cache(self):
+        '''Anonymous reads are served from the cache until a movie changes.
+
+        Endpoint tested:
+            api/movies/ GET
+            api/movies/<:id>/ GET
+        '''
+        movie = Movie.objects.create(**self.movie)
+        detail_url = reverse('movie-detail', args=[movie.id])
+        hits = stats.hits
+        for url in (self.user_create_url, detail_url):
+            self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response['X-Cache'], 'HIT')
+            with self.assertNumQueries(0):
+                response = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(
+                response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertTrue(response['Vary'].startswith(
+                'Authorization, Cookie'))
+
+        # Authenticated users skip the cache, with or without the header
+        userclient = APIClient()
+        userclient.force_authenticate(self.normal_user)
+        response = userclient.get(self.user_create_url)
+        self.assertNotIn('X-Cache', response)
+        self.assertIn('Vary', response)
+
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.authclient.patch(
+            reverse('movie-set-unavailable', args=[movie.id]))
+        response = self.client.get(self.user_create_url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get(detail_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(stats.hits - hits, 4)
+
+    def test_list_movies_sparse_fieldset(self):
+        '''?fields= and ?omit= shrink the payload and the query.
+
+        Endpoint tested:
+            api/movies/?fields=&omit= GET
+        '''
+        movie = Movie.objects.create(**self.movie)
+        MovieImage.objects.create(movie=movie, image='movies/images/a.png')
+        # Validators and movies, no images query
+        with self.assertNumQueries(2) as context:
+            response = self.client.get(self.user_create_url, data={
+                'fields': 'id,title,rental_price,nope'})
+        self.assertEqual(
+            list(response.data['results'][0]),
+            ['id', 'title', 'rental_price'])
+        self.assertNotIn('description', context.captured_queries[1]['sql'])
+
+        response = self.client.get(self.user_create_url, data={
+            'fields': 'id,title,rental_price,cover'})
+        self.assertTrue(response.data['results'][0]['cover'].endswith(
+            '/media/movies/images/a.png'))
+        response = self.client.get(
+            self.user_create_url, data={'omit': 'description,images'})
+        first = response.data['results'][0]
+        self.assertNotIn('description', first)
+        self.assertNotIn('cover', first)
+        self.assertIn('stock', first)
+
+    def test_fast_list_matches_serializer(self):
+        '''The values() read path renders the same bytes as the serializer.
+
+        Endpoint tested:
+            api/movies/ GET
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        for i in range(3):
+            movie = Movie.objects.create(**{
+                **self.movie, 'title': f'M{i}', 'availability': i != 1})
+            MovieImage.objects.create(movie=movie, image=f'movies/{i}.png')
+        movie.likes.add(self.normal_user)
+        for params in ({}, {'fields': 'id,title,cover'}, {'omit': 'images'},
+                       {'ordering': '-like_count', 'page_size': 2}):
+            fast = self.authclient.get(self.user_create_url, data=params)
+            with mock.patch.object(MovieViewSet, 'fast_list', False):
+                slow = self.authclient.get(self.user_create_url, data=params)
+            self.assertEqual(fast.status_code, status.HTTP_200_OK)
+            self.assertEqual(fast.content, slow.content)
+
+    def test_fast_json_renderer(self):
+        '''FastJSONRenderer renders the same bytes as DRF's JSONRenderer'''
+        data = [{
+            'price': Decimal('1.50'),
+            'at': timezone.now(),
+            'on': datetime.now().date(),
+            'message': Messages.MOVIE_AVAILABLE,
+            'text': 'caf\u00e9 \u2028',
+            1: None,
+        }]
+        self.assertEqual(
+            FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_export_movies_as_staff(self):
+        '''Export streams every movie as one JSON array, staff only.
+
+        Endpoint tested:
+            api/movies/export/ GET
+        '''
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.authclient = APIClient()
+        self.authclient.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=staff)))
+        for i in range(5):
+            movie = Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            MovieImage.objects.create(movie=movie, image=f'movies/{i}.png')
+        url = reverse('movie-export')
+        with mock.patch.object(MovieViewSet, 'export_chunk_size', 2):
+            response = self.authclient.get(url, data={'omit': 'description'})
+            listed = self.authclient.get(
+                self.user_create_url,
+                data={'omit': 'description', 'page_size': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        exported = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(exported, json.loads(listed.content)['results'])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(MOVIE_IMPORT_IMAGES_DIR=settings.STATIC_ROOT)
+    def test_import_movies_as_staff(self):
+        '''CSV import creates valid rows with their images and reports the
+        invalid ones by line without aborting.
+
+        Endpoint tested:
+            api/movies/import/ POST
+        '''
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.authclient = APIClient()
+        self.authclient.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=staff)))
+        csv = (
+            'title,description,stock,rental_price,sale_price,'
+            'availability,images\n'
+            'Alien,In space,3,1.50,20,true,test.png\n'
+            'Broken,No stock,,1.50,20,,\n'
+            'Heat,Heist,2,2.00,25,no,\n'
+            'Missing,Poster,1,1,1,,nope.png\n'
+        )
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media, MOVIE_THUMBNAIL_WORKERS=0):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.authclient.post(
+                    reverse('movie-import-movies'), {
+                        'file': SimpleUploadedFile(
+                            'movies.csv', csv.encode())})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data['created'], 2)
+            self.assertEqual(
+                [error['line'] for error in response.data['errors']], [3, 5])
+            self.assertIn('stock', response.data['errors'][0]['errors'])
+            image = MovieImage.objects.get(movie__title='Alien')
+            # Placed and thumbnailed once the batch committed
+            self.assertTrue(image_storage.exists(image.image.name))
+            self.assertTrue(image.thumbnails_ready)
+        self.assertFalse(Movie.objects.get(title='Heat').availability)
+
+        response = self.client.post(reverse('movie-import-movies'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(MOVIE_IMPORT_IMAGES_DIR=settings.STATIC_ROOT)
+    def test_import_movies_rejects_outside_images(self):
+        '''Image names leading out of the images directory are row
+        errors, nothing is copied
+
+        Endpoint tested:
+            api/movies/import/ POST
+        '''
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.authclient = APIClient()
+        self.authclient.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=staff)))
+        settings_file = os.path.join(
+            settings.BASE_DIR, 'moviesapp', 'settings.py')
+        csv = (
+            'title,description,stock,rental_price,sale_price,images\n'
+            'Up,Climb,1,1,1,../src/moviesapp/settings.py\n'
+            f'Abs,Absolute,1,1,1,{settings_file}\n'
+            'Ok,Inside,1,1,1,test.png\n'
+        )
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media, MOVIE_THUMBNAIL_WORKERS=0):
+            response = self.authclient.post(reverse('movie-import-movies'), {
+                'file': SimpleUploadedFile('movies.csv', csv.encode())})
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(
+            [error['line'] for error in response.data['errors']], [2, 3])
+        for error in response.data['errors']:
+            self.assertIn('Invalid image name', error['errors']['images'][0])
+        self.assertFalse(
+            Movie.objects.filter(title__in=['Up', 'Abs']).exists())
+
+    def test_import_movies_bad_input(self):
+        '''Unknown formats and files that aren't UTF-8 are rejected as a
+        whole, images that aren't file names are row errors
+
+        Endpoint tested:
+            api/movies/import/ POST
+        '''
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.authclient = APIClient()
+        self.authclient.force_authenticate(staff)
+        url = reverse('movie-import-movies')
+        row = {
+            'title': 'Alien', 'description': 'In space', 'stock': 3,
+            'rental_price': 1, 'sale_price': 20}
+        lines = '\n'.join(json.dumps({**row, 'images': images}) for images in (
+            5, [1], {'a': 'b'}, []))
+        response = self.authclient.post(url, {
+            'file': SimpleUploadedFile('movies.jsonl', lines.encode())})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(
+            [error['line'] for error in response.data['errors']], [1, 2, 3])
+        self.assertIn('images', response.data['errors'][0]['errors'])
+
+        response = self.authclient.post(url, {
+            'file': SimpleUploadedFile('movies.csv', b'title\n'),
+            'format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('format', response.data)
+        response = self.authclient.post(url, {
+            'file': SimpleUploadedFile(
+                'movies.csv', 'title\nCaf\xe9\n'.encode('latin-1'))})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('file', response.data)
+        self.assertEqual(Movie.objects.count(), 1)
+
+    def test_import_rolled_back_batch_leaves_no_file(self):
+        '''Staged images of a batch failing in the database are discarded'''
+        rows = StringIO(
+            'title,description,stock,rental_price,sale_price,images\n'
+            'Alien,In space,3,1.50,20,test.png\n')
+        importer = MovieImporter(images_dir=settings.STATIC_ROOT)
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media), mock.patch.object(
+                MovieImage.objects, 'bulk_create',
+                side_effect=DatabaseError('boom')):
+            result = importer.run(rows)
+            leftovers = [
+                name for _, _, names in os.walk(media) for name in names]
+        self.assertEqual(result.created, 0)
+        self.assertEqual(leftovers, [])
+
+    def test_import_movies_command(self):
+        '''JSON Lines import through the management command'''
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            for i in range(5):
+                f.write(json.dumps({
+                    'title': f'M{i}', 'description': 'd', 'stock': i,
+                    'rental_price': 1, 'sale_price': 2}) + '\n')
+            f.write('{not json}\n')
+            f.flush()
+            out, err = StringIO(), StringIO()
+            call_command(
+                'import_movies', f.name, batch_size=2, stdout=out,
+                stderr=err)
+        self.assertEqual(
+            Movie.objects.filter(title__startswith='M').count(), 5)
+        self.assertIn('line 6', err.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+
+    def test_range_filters_and_facets(self):
+        '''Price/stock ranges filter the catalog, facets count the
+        filtered movies in a single aggregate.
+
+        Endpoint tested:
+            api/movies/?rental_price_max=&in_stock= GET
+            api/movies/facets/ GET
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        for i, (price, stock, available) in enumerate((
+                ('1.00', 0, True), ('3.00', 2, True),
+                ('7.50', 5, False), ('25.00', 1, True))):
+            Movie.objects.create(**{
+                **self.movie, 'title': f'M{i}', 'rental_price': price,
+                'stock': stock, 'availability': available})
+        response = self.authclient.get(self.user_create_url, {
+            'rental_price_min': '2', 'rental_price_max': '10',
+            'in_stock': 'true'})
+        self.assertEqual(
+            [movie['title'] for movie in response.data['results']],
+            ['M1', 'M2'])
+
+        url = reverse('movie-facets')
+        with self.assertNumQueries(2):
+            # token and the aggregate
+            response = self.authclient.get(url, {'stock_min': 1})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(
+            response.data['availability'], {'true': 2, 'false': 1})
+        self.assertEqual(response.data['in_stock'], {'true': 3, 'false': 0})
+        self.assertEqual(
+            [bucket['count'] for bucket in response.data['rental_price']],
+            [0, 1, 1, 0, 1])
+        self.assertEqual(response.data['rental_price'][-1], {
+            'min': '20.00', 'max': None, 'count': 1})
+        # Non admins only count available movies
+        response = self.client.get(url)
+        self.assertEqual(response.data['availability'], {
+            'true': 3, 'false': 0})
+
+    @override_settings(MOVIE_SIMILAR_ASYNC=False, MOVIE_SIMILAR_TOP_K=2)
+    def test_similar_movies(self):
+        '''Neighbours follow likes incrementally and match a rebuild.
+
+        Endpoint tested:
+            api/movies/<id>/like/ PATCH
+            api/movies/<id>/similar/ GET
+        '''
+        movies = [
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            for i in range(4)]
+        users = [User.objects.create(username=f'fan{i}') for i in range(3)]
+        likes = {0: [0, 1, 2], 1: [0, 1], 2: [0, 3]}
+        for user, liked in likes.items():
+            client = APIClient()
+            client.force_authenticate(users[user])
+            for movie in liked:
+                with self.captureOnCommitCallbacks(execute=True):
+                    client.patch(reverse('movie-like', args=[
+                        movies[movie].pk]))
+        url = reverse('movie-similar', args=[movies[0].pk])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        # cos(M0, M1) = 2 / sqrt(3 * 2), cos(M0, M2) = cos(M0, M3) = 1/sqrt3
+        self.assertEqual(response.data, [
+            {'id': movies[1].pk, 'title': 'M1', 'score': 0.8165},
+            {'id': movies[2].pk, 'title': 'M2', 'score': 0.5774},
+        ])
+        incremental = sorted(MovieSimilarity.objects.values_list(
+            'movie_id', 'similar_id', 'score'))
+        call_command('rebuild_similarities', top_k=2, stdout=StringIO())
+        rebuilt = sorted(MovieSimilarity.objects.values_list(
+            'movie_id', 'similar_id', 'score'))
+        self.assertEqual(
+            [row[:2] for row in incremental], [row[:2] for row in rebuilt])
+        for (*_, a), (*_, b) in zip(incremental, rebuilt):
+            self.assertAlmostEqual(a, b)
+
+        # Unliking drops pairs with no common fan left
+        with self.captureOnCommitCallbacks(execute=True):
+            movies[3].likes.remove(users[2])
+        self.assertNotIn(movies[3].pk, [
+            movie['id'] for movie in self.client.get(url).data])
+        self.assertEqual(
+            self.client.get(reverse('movie-similar', args=[0])).status_code,
+            status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_update_movies_as_admin(self):
+        '''Bulk changes by ids or by filter in one UPDATE.
+
+        Endpoint tested:
+            api/movies/bulk_update/ PATCH
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        movies = [
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            for i in range(4)]
+        url = reverse('movie-bulk-update')
+        before = Movie.objects.get(pk=movies[0].pk).updated_at
+        # token, savepoint, the UPDATE and the savepoint release
+        with self.assertNumQueries(4):
+            response = self.authclient.patch(url, {
+                'ids': [movies[0].pk, movies[1].pk],
+                'availability': False, 'rental_price': '0.99',
+            }, format='json')
+        self.assertEqual(response.data, {'updated': 2})
+        first = Movie.objects.get(pk=movies[0].pk)
+        self.assertFalse(first.availability)
+        self.assertEqual(first.rental_price, Decimal('0.99'))
+        self.assertGreater(first.updated_at, before)
+
+        response = self.authclient.patch(url, {
+            'filter': {'availability': False}, 'sale_price': '5.00',
+        }, format='json')
+        self.assertEqual(response.data, {'updated': 2})
+        response = self.authclient.patch(url, {
+            'ids': [movies[0].pk], 'filter': {'title': 'M0'},
+            'availability': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.authclient.patch(
+            url, {'ids': [movies[0].pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # A typo'd or empty filter doesn't select the whole catalog
+        for selection in ({'titel': 'M0'}, {'title': 'M0', 'stok_min': 1},
+                          {'title': ''}, {}):
+            response = self.authclient.patch(url, {
+                'filter': selection, 'sale_price': '1.00'}, format='json')
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Movie.objects.filter(sale_price=1).exists())
+        response = self.authclient.patch(url, {
+            'filter': {'rental_price_max': '1', 'title': 'M0'},
+            'sale_price': '2.00'}, format='json')
+        self.assertEqual(response.data, {'updated': 1})
+        response = self.client.patch(
+            url, {'ids': [movies[0].pk], 'availability': True},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
     def test_update_movie_as_admin(self):
         '''Test update movie as an admin.
@@ -255,7 +1046,9 @@ class MovieTestCase(APITestCase):
             'due_date': due_date.strftime("%d-%m-%Y"),
             'rented_by': self.normal_user,
         }
-        response = self.authclient.post(rent_url, data=data)
+        with FakeStripe() as fake, override_settings(
+                STRIPE_API_BASE=fake.url, STRIPE_CHECKOUT_ASYNC=False):
+            response = self.authclient.post(rent_url, data=data)
         days = (due_date - datetime.now().date()).days
         movie = Movie.objects.get(pk=movie.id)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
@@ -280,6 +1073,110 @@ class MovieTestCase(APITestCase):
         movie = Movie.objects.create(**self.movie)
         movie_url = reverse('movie-like', args=[movie.id])
         response = self.authclient.patch(movie_url)
+        self.authclient.patch(movie_url)
         movie.refresh_from_db()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(movie.likes.count(), 1)
+        self.assertEqual(movie.like_count, 1)
+
+    def test_order_movies_by_like_count(self):
+        '''Most liked movies first, the repair command recounts likes.
+
+        Endpoint tested:
+            api/movies/?ordering=-like_count GET
+        '''
+        movies = [
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            for i in range(3)]
+        movies[2].likes.add(self.normal_user)
+        self.normal_user.movie_set.add(movies[1])
+        movies[1].likes.add(User.objects.get(username='allex'))
+        response = self.client.get(
+            self.user_create_url, data={'ordering': '-like_count'})
+        self.assertEqual(
+            [movie['like_count'] for movie in response.data['results']],
+            [2, 1, 0])
+
+        Movie.objects.update(like_count=0)
+        detail_url = reverse('movie-detail', args=[movies[1].id])
+        self.assertEqual(self.client.get(detail_url).data['like_count'], 0)
+        untouched = Movie.objects.get(pk=movies[0].pk).updated_at
+        call_command('repair_like_counts', stdout=StringIO())
+        self.assertEqual(
+            list(Movie.objects.order_by('id').values_list(
+                'like_count', flat=True)),
+            [0, 2, 1])
+        # Repaired movies leave the cache, the others keep their ETag
+        self.assertEqual(self.client.get(detail_url).data['like_count'], 2)
+        self.assertEqual(
+            Movie.objects.get(pk=movies[0].pk).updated_at, untouched)
+
+    def test_like_count_on_clear_and_user_delete(self):
+        '''Clearing a user's likes recounts only the movies they liked,
+        deleting a user takes its likes off the counts.'''
+        liked, other = [
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            for i in range(2)]
+        allex = User.objects.get(username='allex')
+        liked.likes.add(self.normal_user, allex)
+        other.likes.add(allex)
+        Movie.objects.filter(pk=other.pk).update(updated_at=datetime(
+            2020, 1, 1, tzinfo=timezone.utc))
+        self.normal_user.movie_set.clear()
+        liked.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((liked.like_count, other.like_count), (1, 1))
+        self.assertEqual(other.updated_at.year, 2020)
+
+        allex.delete()
+        self.assertEqual(
+            list(Movie.objects.order_by('id').values_list(
+                'like_count', flat=True)),
+            [0, 0])
+
+    @override_settings(MOVIE_POPULARITY_LAG=0)
+    def test_order_movies_by_popularity(self):
+        '''Trending order from decayed rents, sales and likes, refreshed
+        incrementally.
+
+        Endpoint tested:
+            api/movies/?ordering=popularity GET
+        '''
+        movies = [
+            Movie.objects.create(**{**self.movie, 'title': f'M{i}'})
+            for i in range(4)]
+        day = timezone.now().date()
+        sale = Sale.objects.create(
+            movie=movies[0], user=self.normal_user, date=timezone.now(),
+            amount=40)
+        # An old sale weighs less than a fresh like
+        Sale.objects.filter(pk=sale.pk).update(
+            created_at=timezone.now() - timedelta(days=10))
+        for _ in range(2):
+            Rent.objects.create(
+                movie=movies[1], rented_by=self.normal_user, quantity=1,
+                due_date=day, amount=1)
+        movies[2].likes.add(self.normal_user)
+        call_command('refresh_popularity', stdout=StringIO())
+
+        def titles():
+            response = self.client.get(
+                self.user_create_url, data={'ordering': 'popularity'})
+            return [movie['title'] for movie in response.data['results']]
+        self.assertEqual(titles(), ['M1', 'M2', 'M0', 'M3'])
+
+        scores = dict(MoviePopularity.objects.values_list('movie', 'score'))
+        Sale.objects.create(
+            movie=movies[3], user=self.normal_user, date=timezone.now(),
+            amount=40)
+        call_command('refresh_popularity', stdout=StringIO())
+        self.assertEqual(titles(), ['M1', 'M3', 'M2', 'M0'])
+        # Only the new sale was added
+        for movie, score in MoviePopularity.objects.exclude(
+                movie=movies[3]).values_list('movie', 'score'):
+            self.assertEqual(score, scores[movie])
+        # Imported movies join the order with a zero score
+        MovieImporter().run(StringIO(
+            'title,description,stock,rental_price,sale_price\n'
+            'M4,Imported,3,1.50,20\n'))
+        self.assertEqual(titles(), ['M1', 'M3', 'M2', 'M0', 'M4'])
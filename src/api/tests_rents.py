@@ -1,15 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import (
+    SimpleTestCase, TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
 # from django.conf import settings
 
+import stripe
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from rest_framework.authtoken.models import Token
 # from rest_framework.exceptions import PermissionDenied
 # from api.constants import Messages
 
-from core.models import Movie, Rent
+from api.views import RentViewSet, SaleViewSet
+from core import checkout, late_fees, stock, stripe_gateway
+from core.fake_stripe import FakeStripe, signed_event
+from core.models import (
+    CheckoutStatus, ExtraCharge, Movie, Order, Rent, Sale)
 
 
 class RentTestCase(APITestCase):
@@ -62,7 +78,7 @@ class RentTestCase(APITestCase):
         self.authclient.post(self.rent_list_url, data=data)
         response = self.authclient.get(self.rent_list_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_return_movie_without_extracharge(self):
         '''Test return movie as normal user without extracharge, should succeed.
@@ -125,3 +141,609 @@ class RentTestCase(APITestCase):
         rent.refresh_from_db()
         self.assertTrue(rent.returned)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # 2 days late x 0.5 x 2 units
+        self.assertEqual(response.data['amount'], Decimal('2.00'))
+
+    def test_fast_list_matches_serializer(self):
+        '''The values() read path renders the same bytes as the serializer.
+
+        Endpoint tested:
+            api/rents/ GET
+            api/sales/ GET
+        '''
+        self.authclient = APIClient()
+        self.authclient.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.tokennotadmin)
+        movie = Movie.objects.create(**self.movie)
+        Rent.objects.create(
+            movie=movie, rented_by=self.normal_user, quantity=2,
+            due_date=datetime.now().date(), amount=Decimal('2.50'))
+        Rent.objects.create(
+            movie=movie, rented_by=self.normal_user, quantity=1,
+            due_date=datetime.now().date(), amount=1, returned=True,
+            returned_at=datetime.now().date())
+        Sale.objects.create(
+            movie=movie, user=self.normal_user, date=datetime.now(),
+            amount=Decimal('40.00'))
+        for url, viewset in ((self.rent_list_url, RentViewSet),
+                             (reverse('sale-list'), SaleViewSet)):
+            fast = self.authclient.get(url)
+            with mock.patch.object(viewset, 'fast_list', False):
+                slow = self.authclient.get(url)
+            self.assertEqual(fast.status_code, status.HTTP_200_OK)
+            self.assertTrue(fast.data)
+            self.assertEqual(fast.content, slow.content)
+
+
+class RentHistoryTestCase(APITestCase):
+    '''Paginated rental history and its summary'''
+    rent_list_url = reverse('rent-list')
+    summary_url = reverse('rent-summary')
+
+    def setUp(self):
+        self.movie = Movie.objects.create(
+            title='Demo movie', description='-', stock=3, rental_price=1,
+            sale_price=10)
+        self.user = User.objects.create(username='notadmin')
+        other = User.objects.create(username='other')
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=self.user)))
+        today = datetime.now().date()
+        self.rents = [
+            Rent.objects.create(
+                rented_by=self.user, movie=self.movie, quantity=1,
+                amount=i + 1, is_paid=i % 2 == 0, returned=i < 3,
+                due_date=today + timedelta(days=i - 4))
+            for i in range(7)]
+        Rent.objects.create(
+            rented_by=other, movie=self.movie, quantity=1, amount=100,
+            due_date=today - timedelta(days=1))
+
+    def test_history_pages(self):
+        '''Every rent of the user once, newest first
+
+        Endpoint tested:
+            api/rents/?page_size=3 GET
+        '''
+        # A cart creates its rents in the same instant
+        Rent.objects.filter(
+            pk__in=[rent.pk for rent in self.rents[2:6]]).update(
+            created_at=self.rents[2].created_at)
+        ids = []
+        url = self.rent_list_url + '?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids += [rent['id'] for rent in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, [rent.pk for rent in reversed(self.rents)])
+
+    def test_history_filters(self):
+        '''Endpoint tested:
+            api/rents/?returned=false&is_paid=true GET
+        '''
+        response = self.client.get(
+            self.rent_list_url, {'returned': 'false', 'is_paid': 'true'})
+        self.assertEqual(
+            [rent['id'] for rent in response.data['results']],
+            [self.rents[6].pk, self.rents[4].pk])
+
+    def test_summary(self):
+        '''Counts and totals from one aggregate query
+
+        Endpoint tested:
+            api/rents/summary/ GET
+        '''
+        ExtraCharge.objects.create(
+            rent=self.rents[0], amount=Decimal('1.50'), is_paid=True)
+        ExtraCharge.objects.create(
+            rent=self.rents[0], amount=Decimal('0.50'), is_paid=True)
+        ExtraCharge.objects.create(
+            rent=self.rents[0], amount=Decimal('2.00'))
+        ExtraCharge.objects.create(
+            rent=self.rents[3], amount=Decimal('3.00'))
+        # Token lookup and the aggregate
+        with self.assertNumQueries(2):
+            response = self.client.get(self.summary_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Paid rents 1 + 3 + 5 + 7 and paid fees 2
+        self.assertEqual(response.data, {
+            'open': 4, 'overdue': 1, 'total_spent': '18.00',
+            'unpaid_extra_charges': '5.00'})
+        response = self.client.get(self.summary_url, {'returned': 'true'})
+        self.assertEqual(response.data, {
+            'open': 0, 'overdue': 0, 'total_spent': '6.00',
+            'unpaid_extra_charges': '2.00'})
+
+
+class LateFeeTestCase(APITestCase):
+    '''core.late_fees keeps one growing unpaid charge per overdue rent'''
+
+    def setUp(self):
+        self.today = datetime.now().date()
+        movie = Movie.objects.create(
+            title='Demo movie', description='-', stock=10,
+            rental_price=Decimal('0.5'), sale_price=1)
+        user = User.objects.create(username='notadmin')
+        self.overdue, self.on_time, self.returned = [
+            Rent.objects.create(
+                movie=movie, rented_by=user, quantity=2, amount=1,
+                due_date=self.today + timedelta(days=days),
+                returned=returned)
+            for days, returned in ((-3, False), (1, False), (-3, True))]
+
+    def test_accrue(self):
+        '''Fees follow the days late, runs are idempotent'''
+        out = StringIO()
+        call_command('accrue_late_fees', stdout=out)
+        self.assertIn('1 rents', out.getvalue())
+        charge = ExtraCharge.objects.get()
+        self.assertEqual(charge.rent, self.overdue)
+        # 3 days x 0.5 x 2 units
+        self.assertEqual((charge.days, charge.amount), (3, Decimal('3.00')))
+        self.assertEqual(late_fees.accrue(self.today), 0)
+        self.assertEqual(
+            late_fees.accrue(self.today + timedelta(days=1)), 1)
+        charge.refresh_from_db()
+        self.assertEqual((charge.days, charge.amount), (4, Decimal('4.00')))
+        self.assertEqual(ExtraCharge.objects.count(), 1)
+
+    def test_accrue_after_partial_payment(self):
+        '''A paid charge is kept, only the rest is charged again'''
+        late_fees.accrue(self.today)
+        ExtraCharge.objects.update(is_paid=True)
+        late_fees.accrue(self.today + timedelta(days=2), batch_size=1)
+        self.assertEqual(
+            list(ExtraCharge.objects.filter(rent=self.overdue).order_by(
+                'id').values_list('is_paid', 'amount')),
+            [(True, Decimal('3.00')), (False, Decimal('2.00'))])
+
+
+class AsyncCheckoutTestCase(APITestCase):
+    '''rent_it answers 202 and a worker creates the Stripe session'''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stripe = FakeStripe().start()
+        cls.checkout_settings = override_settings(
+            STRIPE_API_BASE=cls.stripe.url, STRIPE_CHECKOUT_ASYNC=True,
+            STRIPE_CHECKOUT_WORKERS=0)
+        cls.checkout_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.checkout_settings.disable()
+        cls.stripe.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.stripe.failure_rate = 0.0
+        self.movie = Movie.objects.create(
+            title='Demo movie', description='-', stock=5,
+            rental_price=1, sale_price=1)
+        user = User.objects.create(username='notadmin')
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=user)))
+        self.data = {
+            'quantity': 2,
+            'due_date': (
+                datetime.now() + timedelta(days=2)).strftime('%d-%m-%Y'),
+        }
+
+    def rent_it(self, execute=True):
+        with self.captureOnCommitCallbacks(execute=execute):
+            response = self.client.post(
+                reverse('movie-rent-it', args=[self.movie.id]), self.data)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Location'], response.data['status_url'])
+        return response
+
+    def test_checkout_ready(self):
+        '''The status url gives the session once the worker is done
+
+        Endpoint tested:
+            api/movies/<:id>/rent-it/ POST
+            api/rents/<:id>/checkout/ GET
+        '''
+        response = self.client.get(self.rent_it().data['status_url'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], CheckoutStatus.READY)
+        self.assertTrue(response.data['session_id'].startswith('cs_test_'))
+        rent = Rent.objects.get()
+        self.assertEqual(response.data['session_url'], rent.payment_url)
+        self.assertTrue(rent.payment_reference.startswith('pi_'))
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.stock, 3)
+
+    def test_checkout_pending(self):
+        '''Until the worker runs the client is asked to retry
+
+        Endpoint tested:
+            api/rents/<:id>/checkout/ GET
+        '''
+        response = self.client.get(
+            self.rent_it(execute=False).data['status_url'])
+        self.assertEqual(response.data['status'], CheckoutStatus.PENDING)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertIsNone(response.data['session_url'])
+
+    def test_checkout_failed_releases_stock(self):
+        '''A session Stripe refused gives the reserved units back
+
+        Endpoint tested:
+            api/rents/<:id>/checkout/ GET
+        '''
+        self.stripe.failure_rate = 1.0
+        with self.assertLogs('core.checkout', 'ERROR'), \
+                self.settings(STRIPE_MAX_RETRIES=0):
+            response = self.client.get(self.rent_it().data['status_url'])
+        self.assertEqual(response.data['status'], CheckoutStatus.FAILED)
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.stock, 5)
+
+    def test_resume_lost_checkout(self):
+        '''A job lost with its worker is picked up by resume_checkouts
+        once stale
+
+        Endpoint tested:
+            api/rents/<:id>/checkout/ GET
+        '''
+        # The on_commit job never runs, like a worker restarting
+        status_url = self.rent_it(execute=False).data['status_url']
+        out = StringIO()
+        call_command('resume_checkouts', stdout=out)
+        self.assertIn('0 rents', out.getvalue())
+        self.assertEqual(
+            self.client.get(status_url).data['status'],
+            CheckoutStatus.PENDING)
+
+        call_command('resume_checkouts', older_than=0, stdout=out)
+        self.assertIn('1 rents', out.getvalue())
+        response = self.client.get(status_url)
+        self.assertEqual(response.data['status'], CheckoutStatus.READY)
+        self.assertIsNotNone(response.data['session_url'])
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.stock, 3)
+
+    def test_rent_refreshes_anonymous_catalog(self):
+        '''Cached anonymous reads show the stock left after a rent
+
+        Endpoint tested:
+            api/movies/<:id>/ GET
+        '''
+        anonymous = APIClient()
+        url = reverse('movie-detail', args=[self.movie.id])
+        self.assertEqual(anonymous.get(url).data['stock'], 5)
+        self.rent_it()
+        self.assertEqual(anonymous.get(url).data['stock'], 3)
+        response = anonymous.get(reverse('movie-list'))
+        self.assertEqual(response.data['results'][0]['stock'], 3)
+
+    def fail_checkout(self, rent):
+        self.stripe.failure_rate = 1.0
+        with self.assertLogs('core.checkout', 'ERROR'), \
+                self.settings(STRIPE_MAX_RETRIES=0):
+            checkout.process(Rent, rent.pk)
+
+    def test_return_while_checkout_pending(self):
+        '''A rent can't come back before its checkout is ready, a failing
+        checkout then gives its units back once
+
+        Endpoint tested:
+            api/rents/<:id>/return_movie/ POST
+        '''
+        self.rent_it(execute=False)
+        rent = Rent.objects.get()
+        url = reverse('rent-return-movie', args=[rent.pk])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.fail_checkout(rent)
+        rent.refresh_from_db()
+        self.assertEqual(rent.checkout_status, CheckoutStatus.FAILED)
+        self.assertFalse(rent.returned)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.stock, 5)
+
+    def test_failed_checkout_skips_returned_rent(self):
+        '''Units of a rent returned meanwhile aren't given back again'''
+        self.rent_it(execute=False)
+        rent = Rent.objects.get()
+        # Returned by an older release, which restocked it
+        Rent.objects.update(returned=True)
+        stock.release(self.movie.pk, rent.quantity)
+        self.fail_checkout(rent)
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.stock, 5)
+
+
+class OrderTestCase(APITestCase):
+    '''Cart checkout, several rents and sales in one payment'''
+    order_list_url = reverse('order-list')
+
+    def setUp(self):
+        self.movies = [
+            Movie.objects.create(
+                title=f'Movie {i}', description='-', stock=3,
+                rental_price=1, sale_price=10)
+            for i in range(3)]
+        user = User.objects.create(username='notadmin')
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + str(Token.objects.create(
+                user=user)))
+        self.due_date = (
+            datetime.now() + timedelta(days=2)).strftime('%d-%m-%Y')
+
+    def stocks(self):
+        return list(Movie.objects.filter(
+            pk__in=[movie.pk for movie in self.movies]).order_by(
+            'pk').values_list('stock', flat=True))
+
+    def test_checkout_cart(self):
+        '''Two rents and a sale, one order and one session
+
+        Endpoint tested:
+            api/orders/ POST
+        '''
+        data = {'lines': [
+            {'movie': self.movies[0].pk, 'quantity': 2,
+             'due_date': self.due_date},
+            {'movie': self.movies[1].pk, 'quantity': 1,
+             'due_date': self.due_date},
+            {'movie': self.movies[2].pk, 'kind': 'buy', 'quantity': 3},
+        ]}
+        with FakeStripe() as fake, self.settings(
+                STRIPE_API_BASE=fake.url, STRIPE_CHECKOUT_ASYNC=False), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                self.order_list_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['session_id'].startswith('cs_test_'))
+        order = response.data['order']
+        self.assertEqual(len(order['rents']), 2)
+        self.assertEqual(len(order['sales']), 1)
+        # 2 * 1 * 2 days + 1 * 1 * 2 days + 3 * 10
+        self.assertEqual(Decimal(order['amount']), 36)
+        self.assertEqual(self.stocks(), [1, 2, 0])
+        self.assertIn(
+            'line_items[2][price_data][unit_amount]', fake.last_params)
+        movie_reads = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('SELECT')
+            and 'FROM "core_movie"' in query['sql']]
+        # The stock snapshot of the validation, the session lines join
+        self.assertEqual(len(movie_reads), 1)
+
+    def test_checkout_cart_without_stock(self):
+        '''Lines of a movie add up, nothing is created when they exceed
+        its stock
+
+        Endpoint tested:
+            api/orders/ POST
+        '''
+        data = {'lines': [
+            {'movie': self.movies[0].pk, 'quantity': 2,
+             'due_date': self.due_date},
+            {'movie': self.movies[0].pk, 'kind': 'buy', 'quantity': 2},
+            {'movie': self.movies[1].pk, 'quantity': 1,
+             'due_date': self.due_date},
+        ]}
+        response = self.client.post(self.order_list_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            [bool(errors) for errors in response.data['lines']],
+            [True, True, False])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stocks(), [3, 3, 3])
+
+    def test_async_checkout_failed(self):
+        '''A session Stripe refused deletes the lines of the order and
+        gives their stock back
+
+        Endpoint tested:
+            api/orders/ POST
+            api/orders/<:id>/checkout/ GET
+        '''
+        data = {'lines': [
+            {'movie': self.movies[0].pk, 'quantity': 1,
+             'due_date': self.due_date},
+            {'movie': self.movies[1].pk, 'kind': 'buy', 'quantity': 1},
+        ]}
+        with FakeStripe(failure_rate=1.0) as fake, self.settings(
+                STRIPE_API_BASE=fake.url, STRIPE_CHECKOUT_ASYNC=True,
+                STRIPE_CHECKOUT_WORKERS=0, STRIPE_MAX_RETRIES=0), \
+                self.assertLogs('core.checkout', 'ERROR'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.order_list_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.get(response.data['status_url'])
+        self.assertEqual(response.data['status'], CheckoutStatus.FAILED)
+        self.assertFalse(Rent.objects.exists())
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(self.stocks(), [3, 3, 3])
+
+    def test_return_rent_of_pending_order(self):
+        '''The rents of an order can't come back before its checkout is
+        ready, a failing checkout gives their units back once
+
+        Endpoint tested:
+            api/rents/<:id>/return_movie/ POST
+        '''
+        data = {'lines': [
+            {'movie': self.movies[0].pk, 'quantity': 2,
+             'due_date': self.due_date}]}
+        with self.settings(STRIPE_CHECKOUT_ASYNC=True), \
+                self.captureOnCommitCallbacks(execute=False):
+            response = self.client.post(
+                self.order_list_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        rent = Rent.objects.get()
+        self.assertIsNone(rent.checkout_status)
+        response = self.client.post(
+            reverse('rent-return-movie', args=[rent.pk]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.stocks(), [1, 3, 3])
+        with FakeStripe(failure_rate=1.0) as fake, self.settings(
+                STRIPE_API_BASE=fake.url, STRIPE_MAX_RETRIES=0), \
+                self.assertLogs('core.checkout', 'ERROR'):
+            checkout.process(Order, rent.order_id)
+        self.assertFalse(Rent.objects.exists())
+        self.assertEqual(self.stocks(), [3, 3, 3])
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTestCase(APITestCase):
+    '''Payments notified by Stripe'''
+    webhook_url = reverse('stripe-webhook')
+
+    def setUp(self):
+        self.movie = Movie.objects.create(
+            title='Demo movie', description='-', stock=3, rental_price=1,
+            sale_price=10)
+        self.user = User.objects.create(
+            username='notadmin', email='notadmin@example.com')
+
+    def create_rent(self, payment_reference):
+        return Rent.objects.create(
+            rented_by=self.user, movie=self.movie, quantity=1, amount=2,
+            due_date=datetime.now() + timedelta(days=2),
+            payment_reference=payment_reference)
+
+    def notify(self, payment_intent):
+        payload, signature = signed_event(
+            'charge.succeeded', {'payment_intent': payment_intent},
+            'whsec_test')
+        return self.client.post(
+            self.webhook_url, payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=signature)
+
+    def test_rent_paid(self):
+        '''The rent is found with its user and movie in one query
+
+        Endpoint tested:
+            webhooks/stripe/ POST
+        '''
+        rent = self.create_rent('pi_paid')
+        self.create_rent('pi_other')
+        # Lookup and update, the invoice needs no other query
+        with self.assertNumQueries(2):
+            response = self.notify('pi_paid')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rent.refresh_from_db()
+        self.assertTrue(rent.is_paid)
+        self.assertFalse(
+            Rent.objects.get(payment_reference='pi_other').is_paid)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Demo movie', mail.outbox[0].subject)
+        self.assertIn('notadmin@example.com', mail.outbox[0].to)
+
+    def test_payment_without_reference(self):
+        '''An event without payment intent pays nothing
+
+        Endpoint tested:
+            webhooks/stripe/ POST
+        '''
+        rent = self.create_rent(None)
+        response = self.notify(None)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rent.refresh_from_db()
+        self.assertFalse(rent.is_paid)
+        self.assertEqual(
+            mail.outbox[0].subject,
+            'Payment succesfully but not found invoice.')
+
+    def test_bad_signature(self):
+        '''Events not signed with the endpoint secret are refused
+
+        Endpoint tested:
+            webhooks/stripe/ POST
+        '''
+        self.create_rent('pi_paid')
+        payload, signature = signed_event(
+            'charge.succeeded', {'payment_intent': 'pi_paid'}, 'whsec_other')
+        with mock.patch('builtins.print'):
+            response = self.client.post(
+                self.webhook_url, payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=signature)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Rent.objects.get().is_paid)
+
+
+class StripeGatewayTestCase(SimpleTestCase):
+    '''Timeouts, retries, keep-alive and metrics of core.stripe_gateway'''
+
+    def create_session(self):
+        return stripe_gateway.create_checkout_session(
+            mode='payment', success_url='http://testserver/success/')
+
+    def test_keep_alive_and_metrics(self):
+        with FakeStripe() as fake, self.settings(STRIPE_API_BASE=fake.url):
+            for _ in range(5):
+                self.assertTrue(self.create_session().id.startswith('cs_'))
+            metrics = stripe_gateway.metrics()
+        self.assertEqual(fake.connections, 1)
+        calls = metrics['POST /v1/checkout/sessions']
+        self.assertEqual(calls['count'], 5)
+        self.assertEqual(calls['errors'], 0)
+        self.assertEqual(calls['retries'], 0)
+        self.assertEqual(sum(calls['buckets'].values()), 5)
+
+    def test_retries_server_errors(self):
+        with FakeStripe(failure_rate=1.0) as fake, self.settings(
+                STRIPE_API_BASE=fake.url, STRIPE_MAX_RETRIES=1):
+            with self.assertRaises(stripe.error.APIError):
+                self.create_session()
+            calls = stripe_gateway.metrics()['POST /v1/checkout/sessions']
+        self.assertEqual(calls['errors'], 1)
+        self.assertEqual(calls['retries'], 1)
+
+    def test_read_timeout(self):
+        with FakeStripe(latency=0.5) as fake, self.settings(
+                STRIPE_API_BASE=fake.url, STRIPE_READ_TIMEOUT=0.05,
+                STRIPE_MAX_RETRIES=0):
+            with self.assertRaises(stripe.error.APIConnectionError):
+                self.create_session()
+
+
+class StockReservationTestCase(TransactionTestCase):
+    '''Concurrent rents never oversell, on a committed database'''
+
+    def test_concurrent_rents_never_oversell(self):
+        '''Hundreds of rents race for 50 units.
+
+        Endpoint tested:
+            api/rents/ POST
+        '''
+        movie = Movie.objects.create(
+            title='Hot movie', description='-', stock=50,
+            rental_price=1, sale_price=1)
+        users = [
+            User.objects.create(username=f'user{i}') for i in range(8)]
+        tokens = [str(Token.objects.create(user=user)) for user in users]
+        due_date = (datetime.now() + timedelta(days=2)).strftime('%d-%m-%Y')
+
+        def rent(i):
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION='Token ' + tokens[i % len(tokens)])
+            try:
+                return client.post(reverse('rent-list'), {
+                    'movie': movie.pk, 'quantity': 1, 'due_date': due_date,
+                    'rented_by': users[i % len(users)].pk,
+                }).status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            codes = list(executor.map(rent, range(300)))
+        movie.refresh_from_db()
+        self.assertEqual(codes.count(status.HTTP_201_CREATED), 50)
+        self.assertEqual(codes.count(status.HTTP_400_BAD_REQUEST), 250)
+        self.assertEqual(movie.stock, 0)
+        self.assertEqual(Rent.objects.filter(movie=movie).count(), 50)
@@ -7,7 +7,9 @@ from rest_framework.routers import DefaultRouter
 from api.views import (
     LogEntryMovieViewSet,
     MovieViewSet,
+    OrderViewSet,
     RentViewSet,
+    SaleViewSet,
     stripe_webhook,
 )
 
@@ -47,7 +49,8 @@ if settings.DEBUG:
 router = DefaultRouter()
 router.register(r'movies', MovieViewSet, basename='movie')
 router.register(r'rents', RentViewSet, basename='rent')
-router.register(r'sales', RentViewSet, basename='sale')
+router.register(r'sales', SaleViewSet, basename='sale')
+router.register(r'orders', OrderViewSet, basename='order')
 router.register(
     r'logentrymovies', LogEntryMovieViewSet, basename='logentrymovie')
 
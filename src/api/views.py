@@ -1,48 +1,138 @@
+import io
 from datetime import datetime
 from decimal import Decimal
+from operator import itemgetter
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.http import Http404, HttpResponse
 from django.contrib.admin.models import LogEntry
 from django.views.decorators.csrf import csrf_exempt
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
+from django.utils import timezone
 
 from rest_framework import viewsets, status, permissions
-from rest_framework.mixins import ListModelMixin
+from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 
-import stripe
-
-from core.models import ExtraCharge, Movie, Rent, Sale
-from api.filters import MovieFilterSet
+from django_filters.rest_framework import DjangoFilterBackend
+
+from core.autocomplete import title_index
+from core.importer import FORMATS, MovieImporter, guess_format, is_utf8
+from core import checkout, late_fees, stock, stripe_gateway, thumbnails
+from core.models import (
+    CheckoutStatus, ExtraCharge, Movie, MovieImage, MovieSimilarity, Order,
+    Rent, Sale)
+from core.signals import movies_bulk_changed
+from api.filters import (
+    MovieFilterSet, MovieOrderingFilter, RentFilterSet, facet_counts,
+    filter_params, rent_summary)
+from api import cache as catalog_cache
+from api.fastpath import FieldPlan
+from api.mixins import (
+    AnonymousCacheMixin,
+    ConditionalGetMixin,
+    FastListMixin,
+    StreamingExportMixin,
+)
+from api.pagination import MovieCursorPagination, RentCursorPagination
 from api.serializers import (
+    CartSerializer,
     LogEntryMovieSerializer,
+    MovieBulkUpdateSerializer,
     MovieImageSerializer,
     MovieSerializer,
+    OrderSerializer,
+    thumbnail_urls,
     RentSerializer,
     SaleSerializer,
+    sparse_fieldset,
 )
 from api.constants import Messages
 
 
-class MovieViewSet(viewsets.ModelViewSet):
+class MovieViewSet(
+        AnonymousCacheMixin,
+        ConditionalGetMixin,
+        FastListMixin,
+        StreamingExportMixin,
+        viewsets.ModelViewSet):
     '''Define the HTTP endpoint against the serializer mapping CRUD
         operations to HTTP verbs, (Create -> POST, Update -> PATCH ...)
     '''
     serializer_class = MovieSerializer
     queryset = Movie.objects.all()
     filter_class = MovieFilterSet
+    filter_backends = [DjangoFilterBackend, MovieOrderingFilter]
+    ordering_fields = ['like_count', 'popularity']
+    ordering = ('title', 'id')
+    pagination_class = MovieCursorPagination
 
     def get_queryset(self):
+        '''Load images with the page in a fixed number of queries
+        (movies + images) whatever the page size.
+
+        Reads only select the columns behind the fields asked for with
+        ?fields=/?omit=, and skip the images query when they aren't.
+        '''
         queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            fields = sparse_fieldset(self.request, self.get_serializer_class())
+            if fields & {'images', 'cover'}:
+                queryset = queryset.prefetch_related('movies')
+            columns = {f.name for f in Movie._meta.concrete_fields}
+            # Ordering fields stay loaded, the paginator reads them
+            queryset = queryset.only('id', *(
+                columns & (fields | set(self.ordering_fields)
+                           | set(self.ordering))))
+        else:
+            queryset = queryset.prefetch_related('movies')
         # Ensure other user not admin user will show only available movies
         if not self.request.user.is_superuser:
             queryset = queryset.filter(availability=True)
         return queryset
 
+    def get_fast_overrides(self, serializer):
+        '''images and cover read the rows attached by prepare_fast_rows'''
+        overrides = {}
+        request = self.request
+        if 'images' in serializer.fields:
+            def thumbnails(row):
+                if not row['thumbnails_ready'] or not row['image']:
+                    return None
+                return thumbnail_urls(row['image'], request)
+            image_plan = FieldPlan(serializer.fields['images'].child, {
+                'thumbnails': (('thumbnails_ready',), thumbnails)})
+            overrides['images'] = (
+                (), lambda row: image_plan.render(row['movies']))
+        if 'cover' in serializer.fields:
+            image_field = MovieImage._meta.get_field('image')
+
+            def cover(row):
+                if not row['movies']:
+                    return None
+                url = image_field.storage.url(row['movies'][0]['image'])
+                return request.build_absolute_uri(url)
+            overrides['cover'] = ((), cover)
+        return overrides
+
+    def prepare_fast_rows(self, rows, serializer):
+        '''Load the images of the whole page in one query'''
+        if not {'images', 'cover'} & set(serializer.fields):
+            return
+        images = {row['id']: [] for row in rows}
+        for image in MovieImage.objects.filter(
+                movie_id__in=images).order_by('id').values(
+                'id', 'movie_id', 'image', 'thumbnails_ready'):
+            images[image['movie_id']].append(image)
+        for row in rows:
+            row['movies'] = images[row['id']]
+
     def create(self, request, *args, **kwargs):
         ''''Perform create and take care of validation when no images
 
@@ -51,22 +141,56 @@ class MovieViewSet(viewsets.ModelViewSet):
         If is valid to our serializer we can save after save the movie
         else we return HTTP_400_BAD_REQUEST
 
+        The movie and its images are inserted in one transaction, the
+        images with a single INSERT. Uploads are staged next to their
+        final place and only moved there once the transaction commits.
+
         Return:
             Response object
         '''
         data = [{'image': i} for i in request.FILES.getlist('images')]
         many = len(data) > 0
-        serializer = MovieImageSerializer(data=data, many=many)
-        if not serializer.is_valid():
-            headers = self.get_success_headers(serializer.data)
+        images = MovieImageSerializer(data=data, many=many)
+        if not images.is_valid():
+            headers = self.get_success_headers(images.data)
             return Response(
-                serializer.data,
+                images.data,
                 status=status.HTTP_400_BAD_REQUEST,
                 headers=headers)
-        # Save Movie before, we need the id to relate with all MovieImage
-        data = super().create(request, *args, **kwargs)
-        serializer.save(movie_id=data.data.get('id'))
-        return data
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        image_field = MovieImage._meta.get_field('image')
+        staged = []
+        try:
+            with transaction.atomic():
+                self.perform_create(serializer)
+                movie = serializer.instance
+                for item in data:
+                    staged.append(image_field.storage.stage(
+                        image_field.generate_filename(
+                            None, item['image'].name), item['image']))
+                MovieImage.objects.bulk_create([
+                    MovieImage(movie=movie, image=name)
+                    for name, _ in staged])
+                transaction.on_commit(
+                    lambda: self.place_images(movie.pk, staged))
+        except BaseException:
+            for _, temp_path in staged:
+                image_field.storage.discard(temp_path)
+            raise
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def place_images(self, movie_id, staged):
+        '''Move committed uploads into place and queue their thumbnails,
+        bulk_create sent no post_save'''
+        storage = MovieImage._meta.get_field('image').storage
+        for name, temp_path in staged:
+            storage.place(name, temp_path)
+        for pk in MovieImage.objects.filter(
+                movie_id=movie_id).values_list('pk', flat=True):
+            thumbnails.schedule(pk)
 
     @action(detail=True, methods=['patch'])
     def set_available(self, request, pk=None):
@@ -92,6 +216,157 @@ class MovieViewSet(viewsets.ModelViewSet):
         movie.save()
         return Response({'message': Messages.MOVIE_UNAVAILABLE})
 
+    @action(
+        detail=False, methods=['post'], url_path='import',
+        permission_classes=[permissions.IsAdminUser])
+    def import_movies(self, request):
+        '''Bulk import movies from an uploaded CSV or JSON Lines file
+
+        Images are looked up in settings.MOVIE_IMPORT_IMAGES_DIR.
+
+        Endpoint api/movies/import/
+            file: multipart upload, format: csv|jsonl (optional)
+        return:
+            created, failed, errors [{line, errors}], rows_per_second
+        '''
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {'file': Messages.IMPORT_FILE_REQUIRED},
+                status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('format') or guess_format(upload.name)
+        if file_format not in FORMATS:
+            return Response(
+                {'format': Messages.IMPORT_FORMAT_UNKNOWN.format(
+                    ', '.join(FORMATS))},
+                status=status.HTTP_400_BAD_REQUEST)
+        # A decoding error halfway would leave the first batches imported
+        if not is_utf8(upload.chunks()):
+            return Response(
+                {'file': Messages.IMPORT_NOT_UTF8},
+                status=status.HTTP_400_BAD_REQUEST)
+        upload.seek(0)
+        importer = MovieImporter(
+            images_dir=settings.MOVIE_IMPORT_IMAGES_DIR)
+        result = importer.run(
+            io.TextIOWrapper(upload.file, encoding='utf-8', newline=''),
+            file_format)
+        return Response(result.as_dict(), status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request):
+        '''Typeahead lookup of titles served from the in-memory index
+
+        Endpoint api/movies/autocomplete/?q=<prefix>&limit=N
+        return: [{'id': int, 'title': str}] -> list
+        '''
+        prefix = request.query_params.get('q', '').strip()
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 50)
+        except ValueError:
+            limit = 10
+        if not prefix or limit < 1:
+            return Response([])
+        return Response(title_index.search(
+            prefix, limit=limit,
+            include_unavailable=request.user.is_superuser))
+
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        '''Counts of the filtered catalog per availability, stock and
+        price bucket, for filter sidebars. Same filters as the list.
+
+        Endpoint api/movies/facets/?<filters>
+        return: {'count': int, 'availability': {'true': int, 'false': int},
+                 'in_stock': {...}, 'rental_price': [{'min', 'max',
+                 'count'}], 'sale_price': [...]} -> dict
+        '''
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(facet_counts(queryset.prefetch_related(None)))
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        '''"Users who liked this also liked", precomputed by
+        core.recommendations
+
+        Endpoint api/movies/<:pk>/similar/?limit=N
+        return: [{'id': int, 'title': str, 'score': float}] -> list
+        '''
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 50)
+        except ValueError:
+            limit = 10
+        similar = MovieSimilarity.objects.filter(movie_id=pk)
+        movies = Movie.objects.filter(pk=pk)
+        if not request.user.is_superuser:
+            similar = similar.filter(
+                movie__availability=True, similar__availability=True)
+            movies = movies.filter(availability=True)
+        data = [
+            {'id': movie_id, 'title': title, 'score': round(score, 4)}
+            for movie_id, title, score in similar.order_by(
+                '-score', 'similar_id').values_list(
+                'similar_id', 'similar__title', 'score')[:max(limit, 0)]]
+        if not data and not movies.exists():
+            raise Http404
+        return Response(data)
+
+    @action(
+        detail=False, methods=['get'],
+        permission_classes=[permissions.IsAdminUser])
+    def cache_stats(self, request):
+        '''Catalog cache counters of the worker serving the request
+
+        Endpoint api/movies/cache_stats/
+        return: {'hits': int, 'misses': int, 'hit_ratio': float} -> dict
+        '''
+        return Response(catalog_cache.stats.as_dict())
+
+    @action(detail=False, methods=['patch'])
+    def bulk_update(self, request):
+        '''Change availability and/or prices of many movies in one UPDATE
+
+        Endpoint api/movies/bulk_update/
+            ids: [int] or filter: {title, availability, search...}
+            availability: bool, rental_price: decimal, sale_price: decimal
+        return: {'updated': int} -> number of movies changed
+        '''
+        serializer = MovieBulkUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        queryset = Movie.objects.all()
+        if not request.user.is_superuser:
+            queryset = queryset.filter(availability=True)
+        if 'ids' in data:
+            queryset = queryset.filter(pk__in=data['ids'])
+        else:
+            filterset = MovieFilterSet(data=data['filter'], queryset=queryset)
+            # The filterset ignores unknown and empty parameters, a typo
+            # would select the whole catalog
+            unknown = set(data['filter']) - filter_params(filterset)
+            if unknown:
+                return Response(
+                    {'filter': [Messages.BULK_FILTER_UNKNOWN.format(
+                        ', '.join(sorted(unknown)))]},
+                    status=status.HTTP_400_BAD_REQUEST)
+            if all(value in (None, '', [])
+                   for value in data['filter'].values()):
+                return Response(
+                    {'filter': [Messages.BULK_FILTER_EMPTY]},
+                    status=status.HTTP_400_BAD_REQUEST)
+            if not filterset.is_valid():
+                return Response(
+                    {'filter': filterset.errors},
+                    status=status.HTTP_400_BAD_REQUEST)
+            queryset = filterset.qs
+        changes = {
+            name: data[name] for name in serializer.changes if name in data}
+        with transaction.atomic():
+            # update() skips auto_now, ETags and caches rely on updated_at
+            updated = queryset.update(**changes, updated_at=timezone.now())
+            movies_bulk_changed.send(sender=Movie)
+        return Response({'updated': updated})
+
     @action(
         detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def rent_it(self, request, pk=None):
@@ -100,8 +375,10 @@ class MovieViewSet(viewsets.ModelViewSet):
         Endpoint api/movies/rent-it/<:pk>/
             quantity: N
         return:
-            Message.RENT_SUCCESSFULLY -> str (HTTP 200)
+            Message.RENT_SUCCESSFULLY -> str (HTTP 201)
                 And return the session.id
+            Message.RENT_CHECKOUT_PENDING -> str (HTTP 202)
+                With STRIPE_CHECKOUT_ASYNC, and the status_url to poll
             Json with validated data (HTTP 400)
         '''
         movie = self.get_object()
@@ -111,37 +388,38 @@ class MovieViewSet(viewsets.ModelViewSet):
             'quantity': request.data['quantity'],
             'rented_by': request.user.id,
         })
-        if serializer.is_valid(raise_exception=True):
-            rent = serializer.save()
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            session = stripe.checkout.Session.create(
-                # Not use reverse here 'cause we don't care about UI
-                # in this project.
-                success_url=f'{settings.YOUR_SERVER}success/',
-                cancel_url=f'{settings.YOUR_SERVER}cancel/',
-                payment_method_types=["card"],
-                # It is the Rent pk to meet session_id with rent
-                client_reference_id=rent.id,
-                line_items=[{
-                    'price_data': {
-                        'currency': 'usd',
-                        'unit_amount': int(rent.amount * 100),
-                        'product_data': {'name': rent.movie.title}
-                    },
-                    "quantity": 1,
-                }], mode="payment")
-            rent.payment_reference = session.payment_intent
-            rent.payment_url = session.url
-            rent.save()
+        if not serializer.is_valid(raise_exception=True):
+            return Response({
+                    'data': serializer.errors
+                }, status=status.HTTP_400_BAD_REQUEST)
+        if settings.STRIPE_CHECKOUT_ASYNC:
+            # Reserves the stock in its own short transaction, a worker
+            # creates the session once the rent is committed
+            rent = serializer.save(checkout_status=CheckoutStatus.PENDING)
+            transaction.on_commit(lambda: checkout.schedule(rent))
+            status_url = reverse(
+                'rent-checkout', args=[rent.pk], request=request)
             return Response({
-                    'message': Messages.RENT_SUCCESSFULLY,
-                    'session_id': session.id,
-                    'session_url': session.url,
+                    'message': Messages.RENT_CHECKOUT_PENDING,
+                    'status_url': status_url,
                     'rent': serializer.data,
-                }, status=status.HTTP_201_CREATED)
+                }, status=status.HTTP_202_ACCEPTED,
+                headers={'Location': status_url})
+        # Reserves the stock in its own short transaction, the row
+        # lock isn't held during the Stripe call
+        rent = serializer.save()
+        try:
+            session = checkout.open_session(rent)
+        except Exception:
+            # Give the units back, the rent can't be paid
+            checkout.abandon(rent)
+            raise
         return Response({
-                'data': serializer.errors
-            }, status=status.HTTP_400_BAD_REQUEST)
+                'message': Messages.RENT_SUCCESSFULLY,
+                'session_id': session.id,
+                'session_url': session.url,
+                'rent': serializer.data,
+            }, status=status.HTTP_201_CREATED)
 
     @action(
         detail=True, methods=['patch'], permission_classes=[IsAuthenticated])
@@ -180,18 +458,25 @@ class MovieViewSet(viewsets.ModelViewSet):
             response -> HTTPResponse
         '''
         movie = self.get_object()
-        movie.likes.add(request.user)
+        # like_count follows through the m2m_changed signal, in the same
+        # transaction as the new like
+        with transaction.atomic():
+            movie.likes.add(request.user)
         return Response(
             {'data': 'Liked'}, status=status.HTTP_200_OK)
 
 
-class RentViewSet(viewsets.ModelViewSet):
+class RentViewSet(
+        FastListMixin, StreamingExportMixin, viewsets.ModelViewSet):
     '''Define the HTTP endpoint against the serializer mapping CRUD
         operations to HTTP verbs, (Create -> POST, Update -> PATCH ...)
     '''
     serializer_class = RentSerializer
     queryset = Rent.objects.all()
     permission_classes = [IsAuthenticated]
+    filter_class = RentFilterSet
+    ordering = ('-created_at', '-id')
+    pagination_class = RentCursorPagination
 
     def get_queryset(self):
         '''Filter data by user if not superadmin'''
@@ -200,6 +485,18 @@ class RentViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(rented_by=self.request.user)
         return queryset
 
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
+        '''Totals of the user's rents (every rent for admins), same
+        filters as the list
+
+        Endpoint api/rents/summary/?<filters>
+        return: {'open': int, 'overdue': int, 'total_spent': str,
+                 'unpaid_extra_charges': str} -> dict
+        '''
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(rent_summary(queryset))
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -208,6 +505,29 @@ class RentViewSet(viewsets.ModelViewSet):
         return Response(
             serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    @action(
+        detail=False, methods=['get'],
+        permission_classes=[permissions.IsAdminUser])
+    def stripe_stats(self, request):
+        '''Latency histograms of the Stripe calls of the worker serving
+        the request
+
+        Endpoint api/rents/stripe_stats/
+        return: {'<METHOD> <path>': {'count': int, 'p95': float, ...}}
+        '''
+        return Response(stripe_gateway.metrics())
+
+    @action(detail=True, methods=['get'])
+    def checkout(self, request, pk=None):
+        '''Progress of the checkout session of a rent
+
+        Endpoint api/rents/<:pk>/checkout/
+        return:
+            status, session_id and session_url -> Json (HTTP 200)
+                With a Retry-After header while the status is pending
+        '''
+        return checkout_status(self.get_object())
+
     @action(
         detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def return_movie(self, request, pk=None):
@@ -218,21 +538,126 @@ class RentViewSet(viewsets.ModelViewSet):
         return:
             Message.MOVIE_RETURNED -> str (HTTP 200)
             Message.EXTRA_PAYMENT_GENERATED (HTTP 201)
+            Message.RENT_CHECKOUT_NOT_READY (HTTP 409) while its
+                checkout (or its order's) is pending
         '''
         rent = self.get_object()
-        rent.returned = True
-        rent.returned_at = datetime.now()
-        rent.save()
-        days = (rent.due_date - datetime.now().date()).days
-        if days < 0:
-            amount = days * rent.movie.rental_price * rent.quantity
-            ExtraCharge.objects.create(rent=rent, amount=amount)
+        # A rent of an order is paid by the order's checkout
+        pending = (
+            Q(checkout_status=CheckoutStatus.PENDING)
+            | Q(order__checkout_status=CheckoutStatus.PENDING))
+        if Rent.objects.filter(pending, pk=rent.pk).exists():
             return Response(
-                {'message': "Extra charges"}, status=status.HTTP_201_CREATED)
+                {'message': Messages.RENT_CHECKOUT_NOT_READY},
+                status=status.HTTP_409_CONFLICT)
+        with transaction.atomic():
+            # The late fee up to today, while the rent is still open
+            late_fees.accrue_rents(rent.pk, rent.pk)
+            # Conditional, returning twice doesn't restock twice. Only
+            # rents handed over (checkout ready or none) can come back: a
+            # failed checkout gave the units back already, a pending one
+            # may still fail and give them back
+            returned = Rent.objects.filter(
+                Q(checkout_status__isnull=True)
+                | Q(checkout_status=CheckoutStatus.READY),
+                pk=rent.pk, returned=False).exclude(
+                order__checkout_status=CheckoutStatus.PENDING).update(
+                returned=True, returned_at=datetime.now())
+            if not returned:
+                return Response(
+                    {'data': "Returned"}, status=status.HTTP_200_OK)
+            stock.release(rent.movie_id, rent.quantity)
+        charge = ExtraCharge.objects.filter(rent=rent, is_paid=False).first()
+        if charge is not None:
+            return Response(
+                {'message': "Extra charges", 'amount': charge.amount},
+                status=status.HTTP_201_CREATED)
         return Response(
             {'data': "Returned"}, status=status.HTTP_200_OK)
 
 
+def checkout_status(target):
+    '''Progress of the checkout session of a rent or an order'''
+    headers = {}
+    if target.checkout_status == CheckoutStatus.PENDING:
+        headers['Retry-After'] = '1'
+    return Response({
+            'status': target.checkout_status,
+            'session_id': target.checkout_session,
+            'session_url': target.payment_url,
+        }, status=status.HTTP_200_OK, headers=headers)
+
+
+class OrderViewSet(
+        ListModelMixin, RetrieveModelMixin, viewsets.GenericViewSet):
+    '''Carts checked out at once, their rents and sales paid together'''
+    serializer_class = OrderSerializer
+    queryset = Order.objects.prefetch_related(
+        'rents', Prefetch('sales', Sale.objects.select_related('user')))
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        '''Filter data by user if not superadmin'''
+        queryset = super().get_queryset()
+        if not self.request.user.is_superuser:
+            queryset = queryset.filter(user=self.request.user)
+        return queryset
+
+    def create(self, request, *args, **kwargs):
+        '''Rent and buy several movies in one request and one payment
+
+        Endpoint api/orders/
+            lines: [{movie: int, kind: 'rent'|'buy', quantity: N,
+                     due_date: DD-MM-YYYY (rents)}]
+        return:
+            Message.ORDER_SUCCESSFULLY -> str (HTTP 201)
+                And the session_id and session_url
+            Message.RENT_CHECKOUT_PENDING -> str (HTTP 202)
+                With STRIPE_CHECKOUT_ASYNC, and the status_url to poll
+            Json with the errors of each line (HTTP 400)
+        '''
+        serializer = CartSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if settings.STRIPE_CHECKOUT_ASYNC:
+            order = serializer.save(
+                user=request.user, checkout_status=CheckoutStatus.PENDING)
+            transaction.on_commit(lambda: checkout.schedule(order))
+            status_url = reverse(
+                'order-checkout', args=[order.pk], request=request)
+            order = self.queryset.get(pk=order.pk)
+            return Response({
+                    'message': Messages.RENT_CHECKOUT_PENDING,
+                    'status_url': status_url,
+                    'order': OrderSerializer(order).data,
+                }, status=status.HTTP_202_ACCEPTED,
+                headers={'Location': status_url})
+        order = serializer.save(user=request.user)
+        try:
+            session = checkout.open_session(order)
+        except Exception:
+            # Give the units back, the order can't be paid
+            checkout.abandon(order)
+            raise
+        order = self.queryset.get(pk=order.pk)
+        return Response({
+                'message': Messages.ORDER_SUCCESSFULLY,
+                'session_id': session.id,
+                'session_url': session.url,
+                'order': OrderSerializer(order).data,
+            }, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def checkout(self, request, pk=None):
+        '''Progress of the checkout session of an order
+
+        Endpoint api/orders/<:pk>/checkout/
+        return:
+            status, session_id and session_url -> Json (HTTP 200)
+                With a Retry-After header while the status is pending
+        '''
+        return checkout_status(self.get_object())
+
+
 class LogEntryMovieViewSet(ListModelMixin, viewsets.GenericViewSet):
     '''Define the HTTP endpoint against the serializer mapping CRUD
         operations to HTTP verbs, (Create -> POST, Update -> PATCH ...)
@@ -242,21 +667,26 @@ class LogEntryMovieViewSet(ListModelMixin, viewsets.GenericViewSet):
     queryset = LogEntry.objects.filter(content_type__model='movie')
 
 
-class SaleViewSet(viewsets.ModelViewSet):
+class SaleViewSet(
+        FastListMixin, StreamingExportMixin, viewsets.ModelViewSet):
     '''Define the HTTP endpoint against the serializer mapping CRUD
         operations to HTTP verbs, (Create -> POST, Update -> PATCH ...)
     '''
     serializer_class = SaleSerializer
-    queryset = Sale.objects.all()
+    queryset = Sale.objects.select_related('user')
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         '''Filter data by user if not superadmin'''
         queryset = super().get_queryset()
         if not self.request.user.is_superuser:
-            queryset = queryset.filter(rented_by=self.request.user)
+            queryset = queryset.filter(user=self.request.user)
         return queryset
 
+    def get_fast_overrides(self, serializer):
+        return {'buyed_by': (
+            ('user__username',), itemgetter('user__username'))}
+
 
 @csrf_exempt
 def stripe_webhook(request):
@@ -266,13 +696,11 @@ def stripe_webhook(request):
     event = None
 
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-        )
+        event = stripe_gateway.construct_event(payload, sig_header)
     except ValueError as e:
         print(e)
         return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError as e:
+    except stripe_gateway.SignatureVerificationError as e:
         print(e)
         return HttpResponse(status=400)
 
@@ -280,15 +708,38 @@ def stripe_webhook(request):
     if event['type'] == 'charge.succeeded':
         session = event['data']['object']
         id = session['payment_intent']
-        rent = Rent.objects.filter(payment_reference=id).first()
+        # One indexed lookup that brings the user and movie along,
+        # a missing intent must not match the rents without reference
+        rent = order = None
+        if id:
+            rent = Rent.objects.select_related('rented_by', 'movie').filter(
+                payment_reference=id).first()
+            if rent is None:
+                order = Order.objects.select_related('user').filter(
+                    payment_reference=id).first()
         send_to = [settings.EMAIL_ADMINISTRATOR]
         title = 'Payment succesfully but not found invoice.'
-        if rent is not None:
+        if order is not None:
+            send_to.append(order.user.email)
+            title = f'Payment successfully: order {order.pk}'
+            order.is_paid = True
+            order.paid_at = timezone.now()
+            order.save(update_fields=['is_paid', 'paid_at'])
+            # Its rents are paid with it
+            order.rents.update(is_paid=True, paid_at=order.paid_at)
+            context = {
+                'order': order,
+                'rents': order.rents.select_related('movie'),
+                'sales': order.sales.select_related('movie'),
+            }
+            template_txt = 'email/order_invoice_email.txt'
+            template_html = 'email/order_invoice_email.html'
+        elif rent is not None:
             send_to.append(rent.rented_by.email)
             title = f'Payment successfully: {rent.movie.title}'
             rent.is_paid = True
-            rent.paid_at = datetime.now()
-            rent.save()
+            rent.paid_at = timezone.now()
+            rent.save(update_fields=['is_paid', 'paid_at'])
             context = {'movie': rent.movie, 'rent': rent}
             template_txt = 'email/invoice_email.txt'
             template_html = 'email/invoice_email.html'
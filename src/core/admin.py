@@ -7,7 +7,7 @@ from django.contrib import admin
 from django.contrib.admin.models import LogEntry,  DELETION
 from django.forms.models import BaseInlineFormSet
 
-from core.models import Movie, MovieImage, Rent, Sale
+from core.models import Movie, MovieImage, Order, Rent, Sale
 
 
 if settings.DEBUG:
@@ -64,3 +64,4 @@ if settings.DEBUG:
     admin.site.register(LogEntry, LogEntryAdmin)
     admin.site.register(Rent)
     admin.site.register(Sale)
+    admin.site.register(Order)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        import core.signals  # noqa: F401
+        from core.search import install_sqlite
+        post_migrate.connect(install_sqlite, sender=self)
@@ -0,0 +1,96 @@
+'''Per-process prefix index of movie titles for typeahead lookups.
+
+The index is a sorted array of ``(casefolded title, id)`` searched with
+bisect, so a lookup costs O(log n + limit) and never touches the database.
+It is built lazily on first use, kept current from Movie save/delete
+signals (see core.signals) and fully rebuilt after
+``MOVIE_AUTOCOMPLETE_MAX_AGE`` seconds to pick up writes done by other
+worker processes or by bulk queries that skip signals.
+'''
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+
+
+class TitleIndex(object):
+    '''Sorted in-memory title index, safe to share between threads'''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._entries = {}
+        self._built_at = None
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'MOVIE_AUTOCOMPLETE_MAX_AGE', 300)
+
+    def _is_stale(self):
+        return (
+            self._built_at is None
+            or time.monotonic() - self._built_at > self.max_age)
+
+    def rebuild(self):
+        '''Load every movie title in one query'''
+        from core.models import Movie
+        rows = Movie.objects.order_by().values_list(
+            'id', 'title', 'availability')
+        entries = {
+            pk: (title.casefold(), title, available)
+            for pk, title, available in rows}
+        keys = sorted((key, pk) for pk, (key, _, _) in entries.items())
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        '''Drop the index, next lookup rebuilds it'''
+        with self._lock:
+            self._built_at = None
+
+    def update(self, pk, title, available):
+        '''Insert or replace one movie, a no-op until the index is built'''
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._discard(pk)
+            key = title.casefold()
+            self._entries[pk] = (key, title, available)
+            insort(self._keys, (key, pk))
+
+    def remove(self, pk):
+        with self._lock:
+            if self._built_at is not None:
+                self._discard(pk)
+
+    def _discard(self, pk):
+        entry = self._entries.pop(pk, None)
+        if entry is not None:
+            index = bisect_left(self._keys, (entry[0], pk))
+            del self._keys[index]
+
+    def search(self, prefix, limit=10, include_unavailable=False):
+        '''Return up to limit ``{'id', 'title'}`` dicts starting with prefix
+        (case-insensitive), in title order.
+        '''
+        if self._is_stale():
+            self.rebuild()
+        prefix = prefix.casefold()
+        results = []
+        with self._lock:
+            index = bisect_left(self._keys, (prefix,))
+            while len(results) < limit and index < len(self._keys):
+                key, pk = self._keys[index]
+                if not key.startswith(prefix):
+                    break
+                _, title, available = self._entries[pk]
+                if available or include_unavailable:
+                    results.append({'id': pk, 'title': title})
+                index += 1
+        return results
+
+
+title_index = TitleIndex()
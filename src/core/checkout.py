@@ -0,0 +1,194 @@
+'''Stripe checkout sessions of rents and orders.
+
+A rent from rent_it, or an order from a cart (several rents and sales),
+is paid through one checkout session. Creating it is a round trip to
+Stripe that can take a second or more. With STRIPE_CHECKOUT_ASYNC the
+request doesn't wait for it: the rent or order is saved with
+checkout_status "pending" and answered with 202, and once the
+transaction commits schedule() hands it to a pool of
+STRIPE_CHECKOUT_WORKERS threads. The client polls the status url,
+api/rents/<pk>/checkout/ or api/orders/<pk>/checkout/, until it is
+"ready" (payment url available) or "failed" (the reserved stock was
+given back).
+
+The pool lives in the web process, a job queued by a worker that
+restarts before running it is lost. ``python manage.py resume_checkouts``
+runs from cron and picks up what has been pending for longer than
+STRIPE_CHECKOUT_STALE_AFTER seconds, the idempotency key hands back the
+session of a job that did reach Stripe.
+
+Calls go through core.stripe_gateway; STRIPE_API_BASE points it at
+another server, like the stand-in of ``python manage.py fake_stripe``
+for offline load tests.
+'''
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from core import stock, stripe_gateway
+from core.models import CheckoutStatus, Order, Rent
+
+logger = logging.getLogger(__name__)
+
+
+def items(target):
+    '''Rents and sales paid by the session of a rent or an order'''
+    if isinstance(target, Order):
+        return [
+            *target.rents.select_related('movie'),
+            *target.sales.select_related('movie')]
+    return [target]
+
+
+def create_session(target, rows=None):
+    '''Stripe checkout of a rent or an order, the webhook marks it paid'''
+    if rows is None:
+        rows = items(target)
+    return stripe_gateway.create_checkout_session(
+        # Not use reverse here 'cause we don't care about UI
+        # in this project.
+        success_url=f'{settings.YOUR_SERVER}success/',
+        cancel_url=f'{settings.YOUR_SERVER}cancel/',
+        payment_method_types=["card"],
+        # It is the Rent pk (order-<pk> for orders) to meet session_id
+        # with what it pays
+        client_reference_id=(
+            f'order-{target.pk}' if isinstance(target, Order)
+            else target.pk),
+        line_items=[{
+            'price_data': {
+                'currency': 'usd',
+                'unit_amount': int(row.amount * 100),
+                'product_data': {'name': row.movie.title}
+            },
+            "quantity": 1,
+        } for row in rows], mode="payment",
+        # A retried job gets the same session back
+        idempotency_key=f'{target._meta.model_name}-{target.pk}-checkout')
+
+
+def open_session(target, rows=None):
+    '''Create the session of a rent or an order and store it, returns
+    the session'''
+    session = create_session(target, rows)
+    target.payment_reference = session.payment_intent
+    target.payment_url = session.url
+    target.checkout_session = session.id
+    target.checkout_status = CheckoutStatus.READY
+    target.save(update_fields=[
+        'payment_reference', 'payment_url', 'checkout_session',
+        'checkout_status'])
+    return session
+
+
+def release(rows):
+    '''Give back the units of sales and of the rents not returned yet,
+    one UPDATE. Runs in the caller's transaction'''
+    # return_movie already gave back the units of returned rents, read
+    # it from the locked rows rather than from the caller's copies
+    out = set(Rent.objects.select_for_update().filter(
+        pk__in=[row.pk for row in rows if isinstance(row, Rent)],
+        returned=False).values_list('pk', flat=True))
+    quantities = Counter()
+    for row in rows:
+        if not isinstance(row, Rent) or row.pk in out:
+            quantities[row.movie_id] += row.quantity
+    stock.release_many(quantities)
+
+
+def abandon(target):
+    '''Delete a rent or an order whose session couldn't be created and
+    give its stock back'''
+    with transaction.atomic():
+        release(items(target))
+        if isinstance(target, Order):
+            target.rents.all().delete()
+            target.sales.all().delete()
+        target.delete()
+
+
+def process(model, pk):
+    '''Open the session of a pending rent or order, a failure releases
+    its stock'''
+    target = model.objects.filter(
+        pk=pk, checkout_status=CheckoutStatus.PENDING).first()
+    if target is None:
+        return
+    rows = items(target)
+    try:
+        open_session(target, rows)
+    except Exception:
+        logger.exception(
+            'Could not create the checkout of %s %s',
+            model._meta.model_name, pk)
+        with transaction.atomic():
+            # Conditional, the units are given back once. The row stays
+            # for the status url, the rents of an order go
+            if model.objects.filter(
+                    pk=pk, checkout_status=CheckoutStatus.PENDING,
+            ).update(checkout_status=CheckoutStatus.FAILED):
+                release(rows)
+                if isinstance(target, Order):
+                    target.rents.all().delete()
+                    target.sales.all().delete()
+
+
+def resume(older_than=None, now=None):
+    '''Run the checkout of the rents and orders pending for longer than
+    older_than seconds (STRIPE_CHECKOUT_STALE_AFTER), whose job was lost.
+    Returns their number'''
+    if older_than is None:
+        older_than = settings.STRIPE_CHECKOUT_STALE_AFTER
+    cutoff = (now or timezone.now()) - timedelta(seconds=older_than)
+    resumed = 0
+    for model in (Rent, Order):
+        for pk in model.objects.filter(
+                checkout_status=CheckoutStatus.PENDING,
+                created_at__lt=cutoff).values_list('pk', flat=True):
+            _run(model, pk)
+            resumed += 1
+    return resumed
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.STRIPE_CHECKOUT_WORKERS,
+                thread_name_prefix='checkout')
+        return _executor
+
+
+def _run(model, pk):
+    try:
+        process(model, pk)
+    except Exception:
+        logger.exception(
+            'Checkout job of %s %s crashed', model._meta.model_name, pk)
+
+
+def _run_in_thread(model, pk):
+    try:
+        _run(model, pk)
+    finally:
+        connections.close_all()
+
+
+def schedule(target):
+    '''Queue the checkout of a pending rent or order,
+    STRIPE_CHECKOUT_WORKERS = 0 runs it in the caller'''
+    if not settings.STRIPE_CHECKOUT_WORKERS:
+        _run(type(target), target.pk)
+        return
+    get_executor().submit(_run_in_thread, type(target), target.pk)
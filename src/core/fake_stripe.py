@@ -0,0 +1,146 @@
+'''Local stand-in for the part of the Stripe API the checkout uses.
+
+Answers ``POST /v1/checkout/sessions`` like Stripe does, after an
+optional delay, so rent_it can be tested and load-tested offline. Point
+STRIPE_API_BASE at FakeStripe.url, or run ``python manage.py
+fake_stripe`` and export STRIPE_API_BASE=http://127.0.0.1:12111.
+signed_event() builds the webhook calls Stripe would send back.
+'''
+import hashlib
+import hmac
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def signed_event(event_type, data, secret):
+    '''Body and Stripe-Signature header of a webhook event, signed with
+    the endpoint secret like Stripe does'''
+    payload = json.dumps({
+        'id': 'evt_' + uuid.uuid4().hex[:24],
+        'object': 'event',
+        'type': event_type,
+        'data': {'object': data},
+    })
+    timestamp = int(time.time())
+    signature = hmac.new(
+        secret.encode(), f'{timestamp}.{payload}'.encode(),
+        hashlib.sha256).hexdigest()
+    return payload, f't={timestamp},v1={signature}'
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle would hold the body
+    # back for the client's delayed ACK on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_qs(self.rfile.read(length).decode())
+        if self.path != '/v1/checkout/sessions':
+            return self.reply(404, {'error': {
+                'type': 'invalid_request_error',
+                'message': f'Unrecognized request URL (POST: {self.path})'}})
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            return self.reply(500, {'error': {
+                'type': 'api_error', 'message': 'Fake Stripe failure'}})
+        key = self.headers.get('Idempotency-Key')
+        with self.server.lock:
+            self.server.last_params = params
+            session = self.server.sessions.get(key)
+            if session is None:
+                session = self.server.new_session(params)
+                if key:
+                    self.server.sessions[key] = session
+        self.reply(200, session)
+
+    def reply(self, code, body):
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Request-Id', 'req_' + uuid.uuid4().hex[:14])
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeStripe(ThreadingHTTPServer):
+    '''Threaded HTTP server, use as a context manager or start()/stop()
+
+    latency: seconds each session takes, like a real round trip
+    failure_rate: share of requests answered with a 500
+    '''
+    daemon_threads = True
+
+    def __init__(
+            self, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0,
+            verbose=False):
+        super().__init__((host, port), FakeStripeHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        # TCP connections accepted, stays low while clients keep them alive
+        self.connections = 0
+        # Idempotency-Key -> session, replays answer the same session
+        self.sessions = {}
+        # Form fields of the last session request, for tests
+        self.last_params = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def new_session(self, params):
+        session_id = 'cs_test_' + uuid.uuid4().hex
+        return {
+            'id': session_id,
+            'object': 'checkout.session',
+            'client_reference_id': params.get(
+                'client_reference_id', [None])[0],
+            'mode': params.get('mode', ['payment'])[0],
+            'payment_intent': 'pi_' + uuid.uuid4().hex[:24],
+            'payment_status': 'unpaid',
+            'url': f'{self.url}/pay/{session_id}',
+        }
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out hang up before the reply, that's fine
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name='fake-stripe', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
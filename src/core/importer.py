@@ -0,0 +1,270 @@
+'''Bulk movie import from CSV or JSON Lines.
+
+Rows are parsed one at a time from the stream, validated with the Movie
+model fields and inserted with ``bulk_create`` one batch per transaction.
+A bad row is reported with its line number and skipped, it never aborts
+the run. Columns: title, description, stock, rental_price, sale_price,
+availability (optional) and images (optional, file names relative to the
+images directory, ``;`` separated in CSV or a list in JSONL). Names
+leading outside of the images directory are rejected.
+
+Image files are staged while their batch is inserted and only moved into
+the storage once it commits, their thumbnails are then queued.
+'''
+import codecs
+import csv
+import json
+import os
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import DatabaseError, connection, transaction
+
+from core import thumbnails
+from core.models import Movie, MovieImage, MoviePopularity
+from core.signals import movies_bulk_changed
+
+IMPORT_FIELDS = (
+    'title', 'description', 'stock', 'rental_price', 'sale_price',
+    'availability')
+FORMATS = ('csv', 'jsonl')
+BOOLEANS = {
+    'true': True, 'yes': True, '1': True, 't': True,
+    'false': False, 'no': False, '0': False, 'f': False,
+}
+
+
+def guess_format(file_name):
+    extension = os.path.splitext(file_name)[1].lstrip('.').lower()
+    return 'jsonl' if extension in ('jsonl', 'ndjson', 'json') else 'csv'
+
+
+def is_utf8(chunks):
+    '''Whether the byte chunks of a file decode as UTF-8, checked before
+    any batch is inserted'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in chunks:
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class ImportResult(object):
+
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows(self):
+        return self.created + len(self.errors)
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.elapsed, 1) if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'failed': len(self.errors),
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': self.rows_per_second,
+        }
+
+
+class MovieImporter(object):
+    '''Import movies in batches, see the module docstring for the format'''
+
+    def __init__(self, batch_size=1000, images_dir=None, on_batch=None):
+        self.batch_size = batch_size
+        self.images_dir = images_dir
+        self.on_batch = on_batch
+        self.model_fields = [
+            Movie._meta.get_field(name) for name in IMPORT_FIELDS]
+        self.image_field = MovieImage._meta.get_field('image')
+
+    def read_rows(self, stream, file_format):
+        '''Yield (line number, dict or parse error) without loading the
+        whole file'''
+        if file_format == 'csv':
+            reader = csv.DictReader(stream)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValidationError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(row, dict):
+                row = ValidationError('Expected a JSON object.')
+            yield line_number, row
+
+    def clean_row(self, row):
+        '''Return (Movie, image paths) or raise ValidationError'''
+        values, errors = {}, {}
+        for field in self.model_fields:
+            value = row.get(field.name)
+            if value in (None, '') and field.has_default():
+                continue
+            if isinstance(value, str) and field.get_internal_type() == (
+                    'BooleanField'):
+                value = BOOLEANS.get(value.strip().lower(), value)
+            try:
+                values[field.name] = field.clean(value, None)
+            except ValidationError as e:
+                errors[field.name] = e.messages
+        images = row.get('images') or []
+        if isinstance(images, str):
+            images = [name for name in images.split(';') if name.strip()]
+        elif not isinstance(images, list) or not all(
+                isinstance(name, str) for name in images):
+            errors['images'] = ['Expected a list of file names.']
+            images = []
+        paths = []
+        for name in images:
+            path = self.image_path(name.strip())
+            if path is None:
+                errors.setdefault('images', []).append(
+                    f'Invalid image name: {name}')
+            elif not os.path.isfile(path):
+                errors.setdefault('images', []).append(
+                    f'Image not found: {name}')
+            paths.append(path)
+        if errors:
+            raise ValidationError(errors)
+        return Movie(**values), paths
+
+    def image_path(self, name):
+        '''Real path of an image name under images_dir, None for names
+        that are absolute, contain ".." or resolve (through links)
+        outside of it'''
+        if not self.images_dir or not name or os.path.isabs(name):
+            return None
+        if '..' in name.replace('\\', '/').split('/'):
+            return None
+        root = os.path.realpath(self.images_dir)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != root:
+            return None
+        return path
+
+    def stage_image(self, path):
+        '''Copy a local file next to its place in the MovieImage
+        storage, returns (name, temporary path)'''
+        name = self.image_field.generate_filename(
+            None, os.path.basename(path))
+        with open(path, 'rb') as image:
+            return self.image_field.storage.stage(name, File(image))
+
+    def place_images(self, staged, movie_ids):
+        '''Move committed images into place and queue their thumbnails,
+        bulk_create sent no post_save'''
+        storage = self.image_field.storage
+        for name, temp_path in staged:
+            storage.place(name, temp_path)
+        for pk in MovieImage.objects.filter(
+                movie_id__in=movie_ids).values_list('pk', flat=True):
+            thumbnails.schedule(pk)
+
+    def insert(self, batch, result):
+        '''Insert one batch of (line, Movie, image paths) atomically,
+        rows failing in the database are retried one by one'''
+        try:
+            self.insert_batch(batch)
+            result.created += len(batch)
+            return
+        except DatabaseError:
+            pass
+        for line, movie, paths in batch:
+            movie.pk = None
+            try:
+                self.insert_batch([(line, movie, paths)])
+                result.created += 1
+            except DatabaseError as e:
+                result.errors.append({'line': line, 'errors': str(e)})
+
+    def insert_batch(self, batch):
+        with_images = [item for item in batch if item[2]]
+        plain = [movie for _, movie, paths in batch if not paths]
+        staged = []
+        try:
+            with transaction.atomic():
+                if connection.features.can_return_rows_from_bulk_insert:
+                    Movie.objects.bulk_create(
+                        [movie for _, movie, _ in batch])
+                    movie_ids = [movie.pk for _, movie, _ in batch]
+                else:
+                    last_id = Movie.objects.order_by('-pk').values_list(
+                        'pk', flat=True).first() or 0
+                    # Without RETURNING ids, movies owning images are
+                    # saved one by one to know which id the images
+                    # belong to
+                    Movie.objects.bulk_create(plain)
+                    for _, movie, _ in with_images:
+                        movie.save()
+                    movie_ids = Movie.objects.filter(
+                        pk__gt=last_id, popularity__isnull=True,
+                    ).values_list('pk', flat=True)
+                # No post_save either, give the movies their zero score
+                # row for ?ordering=popularity in the same batch
+                MoviePopularity.objects.bulk_create([
+                    MoviePopularity(movie_id=pk) for pk in movie_ids],
+                    ignore_conflicts=True)
+                images = []
+                for _, movie, paths in with_images:
+                    for path in paths:
+                        staged.append(self.stage_image(path))
+                        images.append(
+                            MovieImage(movie=movie, image=staged[-1][0]))
+                MovieImage.objects.bulk_create(images)
+                if staged:
+                    image_movie_ids = [
+                        movie.pk for _, movie, _ in with_images]
+                    transaction.on_commit(lambda: self.place_images(
+                        staged, image_movie_ids))
+        except BaseException:
+            # A rolled back batch leaves no file behind
+            for _, temp_path in staged:
+                self.image_field.storage.discard(temp_path)
+            raise
+
+    def run(self, stream, file_format='csv'):
+        result = ImportResult()
+        batch = []
+        for line, row in self.read_rows(stream, file_format):
+            try:
+                if isinstance(row, ValidationError):
+                    raise row
+                movie, paths = self.clean_row(row)
+            except ValidationError as e:
+                errors = e.message_dict if hasattr(
+                    e, 'error_dict') else e.messages
+                result.errors.append({'line': line, 'errors': errors})
+                continue
+            batch.append((line, movie, paths))
+            if len(batch) >= self.batch_size:
+                self.flush(batch, result)
+                batch = []
+        if batch:
+            self.flush(batch, result)
+        result.elapsed = time.perf_counter() - result.started
+        # bulk_create skips post_save, tell the indexes and caches once
+        movies_bulk_changed.send(sender=Movie)
+        return result
+
+    def flush(self, batch, result):
+        self.insert(batch, result)
+        result.elapsed = time.perf_counter() - result.started
+        if self.on_batch:
+            self.on_batch(result)
@@ -0,0 +1,86 @@
+'''Late fees of the rents kept past their due date.
+
+A rent owes days late x rental_price x quantity. accrue() keeps that
+amount current for every open overdue rent with one upsert per batch of
+rent ids, the database computes every fee:
+
+    INSERT INTO core_extracharge (...)
+    SELECT ... FROM core_rent JOIN core_movie
+    WHERE NOT returned AND due_date < today AND id BETWEEN a AND b
+    ON CONFLICT (rent_id) WHERE NOT is_paid DO UPDATE ...
+
+The partial unique index extracharge_one_unpaid_per_rent is the conflict
+target: a rent has at most one unpaid charge, which grows every day it
+stays out. Fees already paid are subtracted, so paying mid-way and
+keeping the movie opens a new charge for the rest only. Open overdue
+rents are found with the (returned, due_date) index.
+
+Run it daily with ``python manage.py accrue_late_fees``. return_movie
+runs it for the one rent being returned, whose charge then stays as is.
+'''
+from django.db import connection
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from core.models import Rent
+
+BATCH_SIZE = 10000
+
+# Whole days from due_date to the accrual date, per database
+DAYS_LATE = {
+    'postgresql': '(%s::date - rent.due_date)',
+    'sqlite': 'CAST(julianday(%s) - julianday(rent.due_date) AS INTEGER)',
+}
+
+ACCRUE_SQL = '''
+INSERT INTO core_extracharge
+    (rent_id, amount, days, is_paid, created_at, updated_at)
+SELECT id, ROUND(days * rental_price * quantity - paid, 2), days, false,
+    %s, %s
+FROM (
+    SELECT rent.id, {days_late} AS days, movie.rental_price,
+        rent.quantity, COALESCE((
+            SELECT SUM(charge.amount) FROM core_extracharge charge
+            WHERE charge.rent_id = rent.id AND charge.is_paid), 0) AS paid
+    FROM core_rent rent
+    JOIN core_movie movie ON movie.id = rent.movie_id
+    WHERE NOT rent.returned AND rent.due_date < %s
+        AND rent.id BETWEEN %s AND %s
+        -- Rents whose checkout failed were never handed over
+        AND COALESCE(rent.checkout_status, '') <> 'failed'
+) overdue
+WHERE days * rental_price * quantity > paid
+ON CONFLICT (rent_id) WHERE NOT is_paid DO UPDATE SET
+    amount = excluded.amount,
+    days = excluded.days,
+    updated_at = excluded.updated_at
+WHERE core_extracharge.amount <> excluded.amount
+'''
+
+
+def accrue_rents(first_id, last_id, today=None):
+    '''Upsert the fees of the open overdue rents with ids in
+    [first_id, last_id], returns the number of charges written'''
+    today = today or timezone.localdate()
+    ops = connection.ops
+    date = ops.adapt_datefield_value(today)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            ACCRUE_SQL.format(days_late=DAYS_LATE[connection.vendor]), [
+                date, ops.adapt_datetimefield_value(timezone.now()),
+                date, date, first_id, last_id])
+        return cursor.rowcount
+
+
+def accrue(today=None, batch_size=BATCH_SIZE):
+    '''Bring the fees of every open overdue rent up to today, one
+    statement per batch_size ids, returns the number of charges written'''
+    today = today or timezone.localdate()
+    bounds = Rent.objects.filter(returned=False, due_date__lt=today).aggregate(
+        first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return 0
+    written = 0
+    for first_id in range(bounds['first'], bounds['last'] + 1, batch_size):
+        written += accrue_rents(first_id, first_id + batch_size - 1, today)
+    return written
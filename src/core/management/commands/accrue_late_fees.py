@@ -0,0 +1,32 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from core import late_fees
+
+
+class Command(BaseCommand):
+    '''Bring the late fee of every rent still out past its due date up to
+    date, see core.late_fees.
+
+    Meant to run daily from cron or the scheduler, running it twice is
+    harmless.
+
+    Usage: python manage.py accrue_late_fees [--date 2024-01-31]
+        [--batch-size 10000]
+    '''
+    help = 'Accrue the late fees of the overdue rents'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date', type=date.fromisoformat, default=None,
+            help='Accrue as of this day (YYYY-MM-DD), today by default')
+        parser.add_argument(
+            '--batch-size', type=int, default=late_fees.BATCH_SIZE,
+            help='Rent ids per statement')
+
+    def handle(self, *args, **options):
+        written = late_fees.accrue(
+            today=options['date'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Accrued the late fees of {written} rents.'))
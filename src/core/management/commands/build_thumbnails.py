@@ -0,0 +1,85 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core import thumbnails
+from core.models import Movie, MovieImage
+from core.signals import movies_bulk_changed
+
+
+def _generate(name):
+    '''Runs in a worker process, only touches files'''
+    try:
+        thumbnails.generate(name)
+    except Exception as exc:
+        return name, str(exc)
+    return name, None
+
+
+class Command(BaseCommand):
+    '''Backfill the derivatives of existing movie images.
+
+    Decoding and encoding is CPU bound, so the images are spread over a
+    pool of processes. The parent process keeps the database work and
+    flags each batch ready with one UPDATE.
+
+    Usage: python manage.py build_thumbnails [--all] [--workers N]
+    '''
+    help = 'Generate thumbnails of movie images in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Rebuild images that already have thumbnails')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Worker processes (default: one per CPU)')
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help='Images flagged ready per UPDATE')
+
+    def handle(self, *args, **options):
+        images = MovieImage.objects.exclude(image='')
+        if not options['all']:
+            images = images.filter(thumbnails_ready=False)
+        # Rows sharing a file are built once
+        pending = defaultdict(list)
+        for name, pk in images.values_list('image', 'pk'):
+            pending[name].append(pk)
+        built = failed = 0
+        with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                initializer=django.setup) as executor:
+            results = executor.map(
+                _generate, pending, chunksize=max(
+                    1, len(pending) // (options['workers'] * 4)))
+            batch = []
+            for name, error in results:
+                if error:
+                    failed += 1
+                    self.stderr.write(f'{name}: {error}')
+                    continue
+                batch.extend(pending[name])
+                if len(batch) >= options['batch_size']:
+                    built += self.mark_ready(batch)
+                    batch = []
+            built += self.mark_ready(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Built thumbnails of {built} images, {failed} failed.'))
+
+    def mark_ready(self, pks):
+        if not pks:
+            return 0
+        with transaction.atomic():
+            updated = MovieImage.objects.filter(pk__in=pks).update(
+                thumbnails_ready=True)
+            # update() skips signals, move the ETags and drop caches
+            Movie.objects.filter(movies__pk__in=pks).update(
+                updated_at=timezone.now())
+            movies_bulk_changed.send(sender=Movie)
+        return updated
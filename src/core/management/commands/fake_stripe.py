@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from core.fake_stripe import FakeStripe
+
+
+class Command(BaseCommand):
+    '''Serve the local Stripe stand-in until interrupted.
+
+    Run the app with STRIPE_API_BASE set to the printed url to rent
+    movies without reaching Stripe, e.g. for load tests.
+
+    Usage: python manage.py fake_stripe [--port 12111] [--latency 0.3]
+        [--failure-rate 0.01]
+    '''
+    help = 'Run a local stand-in for the Stripe checkout API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Seconds each checkout session takes')
+        parser.add_argument(
+            '--failure-rate', type=float, default=0.0,
+            help='Share of requests answered with an error')
+
+    def handle(self, *args, **options):
+        server = FakeStripe(
+            options['host'], options['port'], latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            verbose=options['verbosity'] > 1)
+        self.stdout.write(self.style.SUCCESS(
+            f'Fake Stripe listening on {server.url}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
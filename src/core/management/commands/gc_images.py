@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import MovieImage
+from core.storage import image_storage
+from core.thumbnails import derivative_names
+
+
+class Command(BaseCommand):
+    '''Delete movie image files no MovieImage refers to.
+
+    Thumbnails of referenced images are kept. Files younger than
+    --min-age are skipped, an upload in flight may own them.
+
+    Usage: python manage.py gc_images [--dry-run] [--min-age SECONDS]
+    '''
+    help = 'Remove orphaned movie images and thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='List the orphans without deleting them')
+        parser.add_argument(
+            '--min-age', type=int, default=settings.MOVIE_IMAGE_GC_MIN_AGE,
+            help='Keep files written in the last SECONDS')
+
+    def handle(self, *args, **options):
+        directory = MovieImage._meta.get_field('image').upload_to
+        live = set()
+        for name in MovieImage.objects.values_list(
+                'image', flat=True).iterator():
+            live.add(name)
+            for formats in derivative_names(name).values():
+                live.update(formats.values())
+        try:
+            _, files = image_storage.listdir(directory)
+        except FileNotFoundError:
+            files = []
+        removed = size = 0
+        for filename in sorted(files):
+            name = directory + filename
+            if name in live or image_storage.age(name) < options['min_age']:
+                continue
+            removed += 1
+            size += image_storage.size(name)
+            self.stdout.write(name)
+            if not options['dry_run']:
+                image_storage.delete(name)
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {removed} files ({size} bytes).'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.importer import FORMATS, MovieImporter, guess_format
+
+
+class Command(BaseCommand):
+    '''Bulk import movies from a CSV or JSON Lines file.
+
+    Usage: python manage.py import_movies movies.csv --images-dir posters/
+    '''
+    help = 'Stream-parse and bulk insert movies, reporting per-row errors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument(
+            '--images-dir', help='Directory the images column refers to')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or guess_format(options['path'])
+        importer = MovieImporter(
+            batch_size=options['batch_size'],
+            images_dir=options['images_dir'],
+            on_batch=self.report_progress)
+        try:
+            with open(options['path'], newline='', encoding='utf-8') as f:
+                result = importer.run(f, file_format)
+        except (OSError, UnicodeDecodeError) as e:
+            raise CommandError(e)
+        for error in result.errors:
+            self.stderr.write(f"line {error['line']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result.created} movies, {len(result.errors)} rows '
+            f'rejected in {result.elapsed:.1f}s '
+            f'({result.rows_per_second} rows/s).'))
+
+    def report_progress(self, result):
+        self.stdout.write(
+            f'{result.rows} rows, {result.rows_per_second} rows/s')
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import recommendations
+
+
+class Command(BaseCommand):
+    '''Recompute every "also liked" neighbour list from the likes.
+
+    Likes update the lists incrementally, run this periodically (or
+    after bulk changes to likes) to restore exact top-K lists.
+
+    Usage: python manage.py rebuild_similarities [--top-k N]
+    '''
+    help = 'Rebuild the similar movies of the whole catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top-k', type=int, default=settings.MOVIE_SIMILAR_TOP_K,
+            help='Neighbours kept per movie')
+
+    def handle(self, *args, **options):
+        rows = recommendations.rebuild(k=options['top_k'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {rows} similar movie pairs.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core import popularity
+
+
+class Command(BaseCommand):
+    '''Add the rents, sales and likes since the previous run to the
+    trending scores behind ?ordering=popularity.
+
+    Cheap enough to run every few minutes from cron or the scheduler.
+
+    Usage: python manage.py refresh_popularity
+    '''
+    help = 'Incrementally refresh the movie popularity ranking'
+
+    def handle(self, *args, **options):
+        changed = popularity.refresh()
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed the popularity of {changed} movies.'))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Movie
+from core.signals import like_count_subquery, movies_bulk_changed
+
+
+class Command(BaseCommand):
+    '''Recompute Movie.like_count from the likes join table.
+
+    Usage: python manage.py repair_like_counts [--batch-size N]
+    '''
+    help = 'Backfill or repair the denormalized Movie.like_count column'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Movies updated per UPDATE statement (id range)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = Movie.objects.order_by('-id').values_list(
+            'id', flat=True).first() or 0
+        updated = 0
+        # One set-based UPDATE per id range keeps row locks short
+        for start in range(0, last_id + 1, batch_size):
+            # Only wrong counts are written, the others keep their ETags
+            updated += Movie.objects.filter(
+                id__gte=start, id__lt=start + batch_size,
+            ).annotate(actual=like_count_subquery()).exclude(
+                like_count=F('actual'),
+            ).update(
+                like_count=like_count_subquery(), updated_at=timezone.now())
+        if updated:
+            # ETags follow updated_at, the catalog cache this signal
+            movies_bulk_changed.send(sender=Movie)
+        self.stdout.write(self.style.SUCCESS(
+            f'Repaired the like count of {updated} movies.'))
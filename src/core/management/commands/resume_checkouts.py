@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core import checkout
+
+
+class Command(BaseCommand):
+    '''Create the Stripe sessions of rents and orders still pending,
+    whose job was lost with the process that queued it, see
+    core.checkout.
+
+    Meant to run every few minutes from cron or the scheduler, a session
+    already created is only fetched again.
+
+    Usage: python manage.py resume_checkouts [--older-than SECONDS]
+    '''
+    help = 'Retry the checkouts left pending by a lost job'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=None,
+            help='Pending for at least this many seconds, '
+                 'STRIPE_CHECKOUT_STALE_AFTER by default')
+
+    def handle(self, *args, **options):
+        resumed = checkout.resume(older_than=options['older_than'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Resumed the checkout of {resumed} rents and orders.'))
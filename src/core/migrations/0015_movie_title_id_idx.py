@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_extracharge_rent'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='movie',
+            options={
+                'ordering': ('title', 'id'),
+                'verbose_name': 'Movie',
+                'verbose_name_plural': 'Movies'},
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                fields=['title', 'id'], name='movie_title_id_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:24
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+import core.search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_movie_title_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True),
+        ),
+        # SQLite gets its FTS5 mirror from a post_migrate handler instead,
+        # see core.search.install_sqlite
+        migrations.RunPython(
+            core.search.install_postgres, core.search.uninstall_postgres),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:25
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_like_count(apps, schema_editor):
+    Movie = apps.get_model('core', 'Movie')
+    likes = Movie.likes.through.objects.filter(
+        movie_id=OuterRef('pk')).order_by().values('movie_id')
+    Movie.objects.update(like_count=Coalesce(Subquery(
+        likes.annotate(total=Count('*')).values('total')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_movie_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='like_count',
+            field=models.PositiveIntegerField(
+                default=0, verbose_name='Like count'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                fields=['-like_count', 'id'], name='movie_like_count_idx'),
+        ),
+        migrations.RunPython(backfill_like_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_movie_like_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movieimage',
+            name='thumbnails_ready',
+            field=models.BooleanField(
+                default=False, editable=False,
+                verbose_name='Thumbnails ready'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:39
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_movieimage_thumbnails_ready'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='movieimage',
+            name='image',
+            field=models.ImageField(
+                storage=core.storage.ContentAddressedStorage(),
+                upload_to='movies/images/', verbose_name='Image'),
+        ),
+    ]
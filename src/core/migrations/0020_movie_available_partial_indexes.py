@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_movieimage_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                condition=models.Q(('availability', True)),
+                fields=['title', 'id'], name='movie_available_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                condition=models.Q(('availability', True)),
+                fields=['rental_price', 'id'],
+                name='movie_available_rental_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                condition=models.Q(('availability', True)),
+                fields=['sale_price', 'id'], name='movie_available_sale_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_movie_available_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovieSimilarity',
+            fields=[
+                ('id', models.BigAutoField(
+                    auto_created=True, primary_key=True,
+                    serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='Score')),
+                ('movie', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='similarities', to='core.movie')),
+                ('similar', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='+', to='core.movie')),
+            ],
+            options={
+                'verbose_name': 'Movie Similarity',
+                'verbose_name_plural': 'Movie Similarities',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='moviesimilarity',
+            index=models.Index(
+                fields=['movie', '-score'], name='movie_similarity_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='moviesimilarity',
+            constraint=models.UniqueConstraint(
+                fields=('movie', 'similar'), name='movie_similar_unique'),
+        ),
+    ]
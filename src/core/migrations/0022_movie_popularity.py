@@ -0,0 +1,73 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_popularity_rows(apps, schema_editor):
+    '''Every movie joins ?ordering=popularity, the first refresh counts
+    their likes'''
+    Movie = apps.get_model('core', 'Movie')
+    MoviePopularity = apps.get_model('core', 'MoviePopularity')
+    MoviePopularity.objects.bulk_create([
+        MoviePopularity(movie_id=pk)
+        for pk in Movie.objects.values_list('pk', flat=True).iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_moviesimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MoviePopularity',
+            fields=[
+                ('movie', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    primary_key=True, related_name='popularity',
+                    serialize=False, to='core.movie')),
+                ('score', models.FloatField(
+                    default=0, verbose_name='Score')),
+                ('like_count', models.PositiveIntegerField(
+                    default=0, verbose_name='Like count')),
+            ],
+            options={
+                'verbose_name': 'Movie Popularity',
+                'verbose_name_plural': 'Movie Popularities',
+            },
+        ),
+        migrations.CreateModel(
+            name='PopularityCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(
+                    auto_created=True, primary_key=True,
+                    serialize=False, verbose_name='ID')),
+                ('epoch', models.DateTimeField(verbose_name='Epoch')),
+                ('last_rent_id', models.BigIntegerField(
+                    default=0, verbose_name='Last rent')),
+                ('last_sale_id', models.BigIntegerField(
+                    default=0, verbose_name='Last sale')),
+                ('refreshed_at', models.DateTimeField(
+                    null=True, verbose_name='Refreshed at')),
+            ],
+            options={
+                'verbose_name': 'Popularity checkpoint',
+                'verbose_name_plural': 'Popularity checkpoints',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(
+                fields=['updated_at'], name='movie_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moviepopularity',
+            index=models.Index(
+                fields=['-score', 'movie'], name='movie_popularity_idx'),
+        ),
+        migrations.RunPython(
+            create_popularity_rows, migrations.RunPython.noop),
+    ]
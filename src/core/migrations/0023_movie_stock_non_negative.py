@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:47
+
+from django.db import migrations, models
+
+
+def clamp_negative_stock(apps, schema_editor):
+    Movie = apps.get_model('core', 'Movie')
+    Movie.objects.filter(stock__lt=0).update(stock=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_movie_popularity'),
+    ]
+
+    operations = [
+        migrations.RunPython(clamp_negative_stock, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='movie',
+            constraint=models.CheckConstraint(
+                check=models.Q(('stock__gte', 0)),
+                name='movie_stock_non_negative'),
+        ),
+    ]
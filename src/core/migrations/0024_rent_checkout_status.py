@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:51
+
+from django.db import migrations, models
+
+
+def mark_ready_checkouts(apps, schema_editor):
+    '''Rents that already have a payment url went through rent_it'''
+    Rent = apps.get_model('core', 'Rent')
+    Rent.objects.filter(payment_url__isnull=False).update(
+        checkout_status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_movie_stock_non_negative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rent',
+            name='checkout_session',
+            field=models.CharField(
+                blank=True, max_length=255, null=True,
+                verbose_name='Checkout session'),
+        ),
+        migrations.AddField(
+            model_name='rent',
+            name='checkout_status',
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ('pending', 'Pending'),
+                    ('ready', 'Ready'),
+                    ('failed', 'Failed'),
+                ],
+                max_length=10, null=True, verbose_name='Checkout status'),
+        ),
+        migrations.RunPython(
+            mark_ready_checkouts, migrations.RunPython.noop),
+    ]
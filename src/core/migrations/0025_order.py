@@ -0,0 +1,77 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0024_rent_checkout_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('created_at', models.DateTimeField(
+                    auto_now_add=True, verbose_name='Created At')),
+                ('amount', models.DecimalField(
+                    decimal_places=2, max_digits=10, verbose_name='Amount')),
+                ('is_paid', models.BooleanField(
+                    default=False, verbose_name='Is paid?')),
+                ('paid_at', models.DateTimeField(
+                    blank=True, null=True, verbose_name='Paid at')),
+                ('payment_reference', models.CharField(
+                    blank=True, max_length=100, null=True,
+                    verbose_name='Payment reference')),
+                ('payment_url', models.URLField(
+                    blank=True, null=True, verbose_name='Payment url')),
+                ('checkout_session', models.CharField(
+                    blank=True, max_length=255, null=True,
+                    verbose_name='Checkout session')),
+                ('checkout_status', models.CharField(
+                    blank=True,
+                    choices=[
+                        ('pending', 'Pending'),
+                        ('ready', 'Ready'),
+                        ('failed', 'Failed'),
+                    ],
+                    max_length=10, null=True,
+                    verbose_name='Checkout status')),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Order',
+                'verbose_name_plural': 'Orders',
+            },
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='quantity',
+            field=models.IntegerField(default=1, verbose_name='Quantity'),
+        ),
+        migrations.AddField(
+            model_name='rent',
+            name='order',
+            field=models.ForeignKey(
+                blank=True, null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='rents', to='core.order'),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='order',
+            field=models.ForeignKey(
+                blank=True, null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='sales', to='core.order'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:03
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def fix_extra_charges(apps, schema_editor):
+    '''return_movie stored late fees negated, and nothing prevented two
+    unpaid charges for a rent: keep the latest one, positive'''
+    ExtraCharge = apps.get_model('core', 'ExtraCharge')
+    ExtraCharge.objects.filter(amount__lt=0).update(amount=-F('amount'))
+    latest = ExtraCharge.objects.filter(is_paid=False).values(
+        'rent').annotate(latest=Max('id')).values_list('latest', flat=True)
+    ExtraCharge.objects.filter(is_paid=False).exclude(
+        id__in=list(latest)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0025_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extracharge',
+            name='days',
+            field=models.IntegerField(default=0, verbose_name='Overdue days'),
+        ),
+        migrations.AddField(
+            model_name='extracharge',
+            name='updated_at',
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name='Updated at'),
+        ),
+        migrations.AddIndex(
+            model_name='rent',
+            index=models.Index(
+                fields=['returned', 'due_date'],
+                name='rent_returned_due_date_idx'),
+        ),
+        migrations.RunPython(fix_extra_charges, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='extracharge',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('is_paid', False)), fields=('rent',),
+                name='extracharge_one_unpaid_per_rent'),
+        ),
+    ]
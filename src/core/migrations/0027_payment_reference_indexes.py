@@ -0,0 +1,57 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:07
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def clear_payment_references(apps, schema_editor):
+    '''Empty references and all but the latest row of a reference
+    become NULL, so that the references can be made unique'''
+    for model_name in ('Rent', 'Order'):
+        model = apps.get_model('core', model_name)
+        model.objects.filter(payment_reference='').update(
+            payment_reference=None)
+        duplicates = model.objects.exclude(
+            payment_reference=None).values('payment_reference').annotate(
+            rows=Count('id'), latest=Max('id')).filter(rows__gt=1)
+        for duplicate in duplicates:
+            model.objects.filter(
+                payment_reference=duplicate['payment_reference']).exclude(
+                id=duplicate['latest']).update(payment_reference=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_late_fees'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            clear_payment_references, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='payment_reference',
+            field=models.CharField(
+                blank=True, max_length=100, null=True, unique=True,
+                verbose_name='Payment reference'),
+        ),
+        migrations.AlterField(
+            model_name='rent',
+            name='payment_reference',
+            field=models.CharField(
+                blank=True, max_length=100, null=True, unique=True,
+                verbose_name='Payment reference'),
+        ),
+        migrations.AddIndex(
+            model_name='rent',
+            index=models.Index(
+                fields=['rented_by', 'returned'],
+                name='rent_rented_by_returned_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(
+                fields=['user', 'date'], name='sale_user_date_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_payment_reference_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rent',
+            index=models.Index(
+                fields=['rented_by', '-created_at', '-id'],
+                name='rent_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rent',
+            index=models.Index(
+                fields=['-created_at', '-id'], name='rent_created_at_idx'),
+        ),
+    ]
@@ -1,9 +1,12 @@
 from datetime import datetime, timedelta
 
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils.translation import gettext as _
 from django.contrib.auth.models import User
 
+from core.storage import image_storage
+
 
 class Movie(models.Model):
     '''Define de base structure of the Movie entity'''
@@ -18,11 +21,41 @@ class Movie(models.Model):
     created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
     updated_at = models.DateTimeField(_("Created At"), auto_now=True)
     likes = models.ManyToManyField(User, verbose_name=_('Likes'))
+    # Denormalized len(likes), kept by core.signals.count_movie_likes
+    like_count = models.PositiveIntegerField(_("Like count"), default=0)
+    # Maintained by a database trigger, see core.search
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         verbose_name = _("Movie")
         verbose_name_plural = _("Movies")
-        ordering = ('title',)
+        ordering = ('title', 'id')
+        constraints = [
+            # Backs the conditional UPDATE of core.stock.reserve
+            models.CheckConstraint(
+                check=models.Q(stock__gte=0),
+                name='movie_stock_non_negative'),
+        ]
+        indexes = [
+            # Keyset pagination seeks on (title, id), see MovieCursorPagination
+            models.Index(fields=['title', 'id'], name='movie_title_id_idx'),
+            models.Index(
+                fields=['-like_count', 'id'], name='movie_like_count_idx'),
+            # Non-admin reads always filter availability=True, partial
+            # indexes only hold those rows
+            models.Index(
+                fields=['title', 'id'], name='movie_available_title_idx',
+                condition=models.Q(availability=True)),
+            models.Index(
+                fields=['rental_price', 'id'],
+                name='movie_available_rental_idx',
+                condition=models.Q(availability=True)),
+            models.Index(
+                fields=['sale_price', 'id'], name='movie_available_sale_idx',
+                condition=models.Q(availability=True)),
+            # Catalog ETags (Max) and popularity refreshes read it
+            models.Index(fields=['updated_at'], name='movie_updated_at_idx'),
+        ]
 
     def __str__(self) -> str:
         '''Return the representation of each row'''
@@ -33,7 +66,12 @@ class MovieImage(models.Model):
     '''Manage as many images per movie as required'''
     movie = models.ForeignKey(
         Movie, related_name='movies', on_delete=models.CASCADE)
-    image = models.ImageField(_("Image"), upload_to='movies/images/')
+    # One file per distinct content, see core.storage
+    image = models.ImageField(
+        _("Image"), upload_to='movies/images/', storage=image_storage)
+    # Set once core.thumbnails has written every derivative
+    thumbnails_ready = models.BooleanField(
+        _("Thumbnails ready"), default=False, editable=False)
 
     class Meta:
         verbose_name = _("Movie Image")
@@ -44,11 +82,73 @@ class MovieImage(models.Model):
         return f'{self.pk} - {self.movie.title}'
 
 
+class MovieSimilarity(models.Model):
+    '''Top-K "users who liked this also liked" neighbours of a movie,
+    maintained by core.recommendations'''
+    movie = models.ForeignKey(
+        Movie, related_name='similarities', on_delete=models.CASCADE)
+    similar = models.ForeignKey(
+        Movie, related_name='+', on_delete=models.CASCADE)
+    # Cosine similarity of both movies' likes, in (0, 1]
+    score = models.FloatField(_("Score"))
+
+    class Meta:
+        verbose_name = _("Movie Similarity")
+        verbose_name_plural = _("Movie Similarities")
+        constraints = [
+            models.UniqueConstraint(
+                fields=['movie', 'similar'], name='movie_similar_unique'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['movie', '-score'], name='movie_similarity_idx'),
+        ]
+
+    def __str__(self) -> str:
+        '''Return the representation of each row'''
+        return f'{self.movie_id} - {self.similar_id}: {self.score:.3f}'
+
+
 def get_due_date(days=7) -> datetime:
     '''Return the due day which will be 7 later from now'''
     return (datetime.now()+timedelta(days=days)).date
 
 
+class CheckoutStatus(models.TextChoices):
+    '''Progress of the Stripe checkout session of a rent'''
+    PENDING = 'pending', _("Pending")
+    READY = 'ready', _("Ready")
+    FAILED = 'failed', _("Failed")
+
+
+class Order(models.Model):
+    '''Rents and sales checked out together and paid in one session'''
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
+    amount = models.DecimalField(_("Amount"), max_digits=10, decimal_places=2)
+    is_paid = models.BooleanField(_("Is paid?"), default=False)
+    paid_at = models.DateTimeField(_("Paid at"), blank=True, null=True)
+    # Stripe payment intent, the webhook finds the payment by it
+    payment_reference = models.CharField(
+        _("Payment reference"), max_length=100, blank=True, null=True,
+        unique=True)
+    payment_url = models.URLField(
+        _("Payment url"), blank=True, null=True)
+    checkout_session = models.CharField(
+        _("Checkout session"), max_length=255, blank=True, null=True)
+    checkout_status = models.CharField(
+        _("Checkout status"), max_length=10, blank=True, null=True,
+        choices=CheckoutStatus.choices)
+
+    class Meta:
+        verbose_name = _("Order")
+        verbose_name_plural = _("Orders")
+
+    def __str__(self) -> str:
+        '''Return the representation of each row'''
+        return f'{self.pk} - {self.amount}'
+
+
 class Rent(models.Model):
     '''Manage Rent entity and its fields'''
 
@@ -63,14 +163,42 @@ class Rent(models.Model):
     is_paid = models.BooleanField(_("Is paid?"), default=False)
     paid_at = models.DateTimeField(_("Paid at"), blank=True, null=True)
     amount = models.DecimalField(_("Amount"), max_digits=8, decimal_places=2)
+    # Stripe payment intent, the webhook finds the payment by it
     payment_reference = models.CharField(
-        _("Payment reference"), max_length=100, blank=True, null=True)
+        _("Payment reference"), max_length=100, blank=True, null=True,
+        unique=True)
     payment_url = models.URLField(
         _("Payment url"), blank=True, null=True)
+    # Stripe checkout session of rents paid online, see core.checkout
+    checkout_session = models.CharField(
+        _("Checkout session"), max_length=255, blank=True, null=True)
+    checkout_status = models.CharField(
+        _("Checkout status"), max_length=10, blank=True, null=True,
+        choices=CheckoutStatus.choices)
+    # Rents checked out from a cart are paid through their order
+    order = models.ForeignKey(
+        Order, related_name='rents', on_delete=models.SET_NULL,
+        blank=True, null=True)
 
     class Meta:
         verbose_name = _("Rent")
         verbose_name_plural = _("Rents")
+        indexes = [
+            # Open rents past their due date, see core.late_fees
+            models.Index(
+                fields=['returned', 'due_date'],
+                name='rent_returned_due_date_idx'),
+            # Rents a user still has out
+            models.Index(
+                fields=['rented_by', 'returned'],
+                name='rent_rented_by_returned_idx'),
+            # Rental history pages, see RentCursorPagination
+            models.Index(
+                fields=['rented_by', '-created_at', '-id'],
+                name='rent_history_idx'),
+            models.Index(
+                fields=['-created_at', '-id'], name='rent_created_at_idx'),
+        ]
 
     def __str__(self) -> str:
         '''Return the representation of each row'''
@@ -78,10 +206,13 @@ class Rent(models.Model):
 
 
 class ExtraCharge(models.Model):
-    '''Manage extra charges when returning movies'''
+    '''Late fee of a rent kept past its due date, see core.late_fees'''
     created_at = models.DateField(auto_now_add=True)
+    # Refreshed by the accrual job while the rent stays out
+    updated_at = models.DateTimeField(_("Updated at"), null=True, blank=True)
     amount = models.DecimalField(
         _("Amount"), max_digits=8, decimal_places=2, default=0.0)
+    days = models.IntegerField(_("Overdue days"), default=0)
     is_paid = models.BooleanField(_("Is paid?"), default=False)
     paid_at = models.DateTimeField(_("Paid at"), null=True, blank=True)
     rent = models.ForeignKey(
@@ -90,6 +221,12 @@ class ExtraCharge(models.Model):
     class Meta:
         verbose_name = _("Extra charge")
         verbose_name_plural = _("Extra charges")
+        constraints = [
+            # The ON CONFLICT target of the accrual upsert
+            models.UniqueConstraint(
+                fields=['rent'], condition=models.Q(is_paid=False),
+                name='extracharge_one_unpaid_per_rent'),
+        ]
 
     def __str__(self) -> str:
         '''Return the representation of each row'''
@@ -103,11 +240,58 @@ class Sale(models.Model):
     created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
     date = models.DateTimeField(_("Date"))
     amount = models.DecimalField(_("Amount"), max_digits=8, decimal_places=2)
+    quantity = models.IntegerField(_("Quantity"), default=1)
+    order = models.ForeignKey(
+        Order, related_name='sales', on_delete=models.SET_NULL,
+        blank=True, null=True)
 
     class Meta:
         verbose_name = _("Sale")
         verbose_name_plural = _("Sales")
+        indexes = [
+            # A user's purchases by date
+            models.Index(fields=['user', 'date'], name='sale_user_date_idx'),
+        ]
 
     def __str__(self) -> str:
         '''Return the representation of each row'''
         return f'{self.movie} - {self.amount}'
+
+
+class MoviePopularity(models.Model):
+    '''Time-decayed trending score of a movie, see core.popularity'''
+    movie = models.OneToOneField(
+        Movie, primary_key=True, related_name='popularity',
+        on_delete=models.CASCADE)
+    # Relative to PopularityCheckpoint.epoch, only the order is meaningful
+    score = models.FloatField(_("Score"), default=0)
+    # Movie.like_count already counted in score
+    like_count = models.PositiveIntegerField(_("Like count"), default=0)
+
+    class Meta:
+        verbose_name = _("Movie Popularity")
+        verbose_name_plural = _("Movie Popularities")
+        indexes = [
+            models.Index(
+                fields=['-score', 'movie'], name='movie_popularity_idx'),
+        ]
+
+    def __str__(self) -> str:
+        '''Return the representation of each row'''
+        return f'{self.movie_id} - {self.score:.3f}'
+
+
+class PopularityCheckpoint(models.Model):
+    '''Progress of core.popularity.refresh, a single row'''
+    epoch = models.DateTimeField(_("Epoch"))
+    last_rent_id = models.BigIntegerField(_("Last rent"), default=0)
+    last_sale_id = models.BigIntegerField(_("Last sale"), default=0)
+    refreshed_at = models.DateTimeField(_("Refreshed at"), null=True)
+
+    class Meta:
+        verbose_name = _("Popularity checkpoint")
+        verbose_name_plural = _("Popularity checkpoints")
+
+    def __str__(self) -> str:
+        '''Return the representation of each row'''
+        return f'{self.refreshed_at}'
@@ -0,0 +1,144 @@
+'''Trending score of movies from recent rents, sales and likes.
+
+Scores use forward exponential decay: an event at time t adds
+
+    weight * 2 ** ((t - epoch) / half_life)
+
+so a rent today is worth twice a rent one half-life ago. Every score is
+expressed relative to the same epoch, old contributions never need to
+be rewritten and the ranking at any moment is the ranking of the stored
+scores. refresh() therefore only reads the Rent and Sale rows created
+since the previous run and the movies whose likes changed (their
+updated_at moved), and adds their contributions to MoviePopularity.
+
+When the epoch gets too far behind, scores are scaled down once and the
+epoch moved forward, which keeps the floats in range.
+'''
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import (
+    Movie, MoviePopularity, PopularityCheckpoint, Rent, Sale)
+from core.signals import movies_bulk_changed
+
+WEIGHTS = {
+    'rent': 3.0,
+    'sale': 5.0,
+    'like': 1.0,
+}
+# Half-lives between the epoch and now before rebasing (2 ** 64 max)
+REBASE_AFTER = 64
+
+
+def decay(times, epoch, half_life):
+    '''Forward-decay factor of each datetime in times'''
+    seconds = np.array(
+        [(time - epoch).total_seconds() for time in times], dtype=np.float64)
+    return np.exp2(seconds / half_life.total_seconds())
+
+
+def add_events(scores, events, weight, epoch, half_life):
+    '''Add the decayed weight of (movie id, created_at) events'''
+    if not events:
+        return
+    movies = np.array([movie for movie, _ in events], dtype=np.int64)
+    values = weight * decay([time for _, time in events], epoch, half_life)
+    ids, index = np.unique(movies, return_inverse=True)
+    for movie, value in zip(
+            ids.tolist(), np.bincount(index, weights=values).tolist()):
+        scores[movie] = scores.get(movie, 0.0) + value
+
+
+def rebase(checkpoint, now, half_life):
+    '''Move the epoch forward by whole half-lives, scaling the scores'''
+    shift = int((now - checkpoint.epoch) / half_life)
+    if shift < REBASE_AFTER:
+        return
+    MoviePopularity.objects.update(score=F('score') * 2.0 ** -shift)
+    checkpoint.epoch += shift * half_life
+
+
+def new_events(model, last_id, cutoff):
+    '''(movie id, created_at) of rows past last_id, and the new last id'''
+    rows = list(model.objects.filter(
+        id__gt=last_id, created_at__lt=cutoff).order_by('id').values_list(
+        'id', 'movie_id', 'created_at'))
+    if not rows:
+        return [], last_id
+    return [(movie, time) for _, movie, time in rows], rows[-1][0]
+
+
+def refresh(now=None):
+    '''Add what happened since the previous refresh, returns the number
+    of movies whose score changed.
+
+    Rows younger than MOVIE_POPULARITY_LAG are left for the next run so
+    transactions still open when their id was allocated aren't skipped.
+    '''
+    now = now or timezone.now()
+    half_life = timedelta(hours=settings.MOVIE_POPULARITY_HALF_LIFE)
+    lag = timedelta(seconds=settings.MOVIE_POPULARITY_LAG)
+    cutoff = now - lag
+    with transaction.atomic():
+        checkpoint, _ = PopularityCheckpoint.objects.select_for_update(
+        ).get_or_create(pk=1, defaults={'epoch': now})
+        rebase(checkpoint, now, half_life)
+        epoch = checkpoint.epoch
+        scores = {}
+        rents, checkpoint.last_rent_id = new_events(
+            Rent, checkpoint.last_rent_id, cutoff)
+        add_events(scores, rents, WEIGHTS['rent'], epoch, half_life)
+        sales, checkpoint.last_sale_id = new_events(
+            Sale, checkpoint.last_sale_id, cutoff)
+        add_events(scores, sales, WEIGHTS['sale'], epoch, half_life)
+
+        # Likes have no timestamp, changes count from when they're seen.
+        # Movies without a row yet (bulk imports) are created here.
+        like_counts = dict(Movie.objects.filter(
+            popularity__isnull=True).values_list('id', 'like_count'))
+        missing = set(like_counts)
+        # Re-reading a movie is harmless, only like deltas count
+        touched = Movie.objects.all()
+        if checkpoint.refreshed_at:
+            touched = touched.filter(
+                updated_at__gte=checkpoint.refreshed_at - lag)
+        like_counts.update(touched.values_list('id', 'like_count'))
+        rows = MoviePopularity.objects.in_bulk(
+            (set(scores) | set(like_counts)) - missing)
+        like_weight = WEIGHTS['like'] * float(
+            decay([now], epoch, half_life)[0])
+        for movie, like_count in like_counts.items():
+            seen = rows[movie].like_count if movie in rows else 0
+            if like_count != seen:
+                scores[movie] = scores.get(movie, 0.0) + (
+                    like_count - seen) * like_weight
+
+        changed, created = [], []
+        for movie in missing:
+            created.append(MoviePopularity(
+                movie_id=movie, score=scores.get(movie, 0.0),
+                like_count=like_counts[movie]))
+        # Events of movies deleted meanwhile have no row and are dropped
+        for movie, row in rows.items():
+            if movie in scores:
+                row.score += scores[movie]
+                row.like_count = like_counts.get(movie, row.like_count)
+                changed.append(row)
+        MoviePopularity.objects.bulk_update(
+            changed, ['score', 'like_count'], batch_size=1000)
+        MoviePopularity.objects.bulk_create(created, batch_size=1000)
+        if changed or created:
+            # Their position in ?ordering=popularity moved, ETags and the
+            # catalog cache follow updated_at and movies_bulk_changed
+            Movie.objects.filter(pk__in=[
+                row.movie_id for row in changed + created]).update(
+                updated_at=now)
+            movies_bulk_changed.send(sender=Movie)
+        checkpoint.refreshed_at = now
+        checkpoint.save()
+    return len(changed) + len(created)
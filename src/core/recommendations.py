@@ -0,0 +1,194 @@
+'''"Users who liked this also liked" from the Movie.likes matrix.
+
+The likes join table is a binary users x movies matrix X. The item-item
+cosine similarity of two movies is
+
+    cos(i, j) = co(i, j) / sqrt(n(i) * n(j))
+
+where co = X.T @ X counts the users who liked both and n the likes of
+each movie. rebuild() computes it for the whole catalog with sparse
+SciPy products and stores the top MOVIE_SIMILAR_TOP_K neighbours of each
+movie in MovieSimilarity, so reads are a single indexed query.
+
+A like or unlike of movie m only changes n(m) and co(m, j), so
+update_movie() recomputes the pairs of m incrementally. Neighbour lists
+trimmed to K can miss a pair that climbs back after an unlike, the
+periodic ``rebuild_similarities`` command restores exact lists.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count
+from scipy import sparse
+
+from core.models import Movie, MovieSimilarity
+
+logger = logging.getLogger(__name__)
+
+Likes = Movie.likes.through
+
+
+def likes_matrix():
+    '''(users x movies CSR matrix, movie id of each column)'''
+    pairs = np.array(
+        Likes.objects.values_list('user_id', 'movie_id'), dtype=np.int64)
+    if not len(pairs):
+        return sparse.csr_matrix((0, 0)), np.array([], dtype=np.int64)
+    users, rows = np.unique(pairs[:, 0], return_inverse=True)
+    movies, columns = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float64), (rows, columns)),
+        shape=(len(users), len(movies)))
+    return matrix, movies
+
+
+def cosine_similarity(matrix):
+    '''Sparse movies x movies cosine similarity, without the diagonal'''
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    scale = sparse.diags(1 / np.sqrt(counts))
+    similarity = (scale @ (matrix.T @ matrix) @ scale).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    return similarity
+
+
+def top_k(ids, scores, k):
+    '''Indexes of the k best scores, best first, ties by id'''
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+    else:
+        keep = np.arange(len(scores))
+    return keep[np.lexsort((ids[keep], -scores[keep]))]
+
+
+def rebuild(k=None, batch_size=5000):
+    '''Recompute every neighbour list, returns the number of rows'''
+    k = k or settings.MOVIE_SIMILAR_TOP_K
+    matrix, movies = likes_matrix()
+    similarity = cosine_similarity(matrix) if len(movies) else None
+    rows = []
+    for i, movie_id in enumerate(movies):
+        start, end = similarity.indptr[i], similarity.indptr[i + 1]
+        columns = similarity.indices[start:end]
+        scores = similarity.data[start:end]
+        for best in top_k(movies[columns], scores, k):
+            rows.append(MovieSimilarity(
+                movie_id=int(movie_id),
+                similar_id=int(movies[columns[best]]),
+                score=float(scores[best])))
+    with transaction.atomic():
+        MovieSimilarity.objects.all().delete()
+        MovieSimilarity.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def neighbours(movie_id):
+    '''(movie ids, cosine scores) of every movie sharing a like with
+    movie_id, from one GROUP BY over the likes of its fans'''
+    fans = Likes.objects.filter(movie_id=movie_id).values('user_id')
+    co = np.array(Likes.objects.filter(user_id__in=fans).values(
+        'movie_id').annotate(co=Count('user_id')).values_list(
+        'movie_id', 'co').order_by(), dtype=np.int64).reshape(-1, 2)
+    ids = co[:, 0]
+    counts = dict(Movie.objects.filter(pk__in=ids.tolist()).values_list(
+        'id', 'like_count'))
+    likes = np.array(
+        [counts.get(int(i), 0) for i in ids], dtype=np.float64)
+    own = likes[ids == movie_id]
+    mask = (ids != movie_id) & (likes > 0)
+    if not len(own) or not own[0]:
+        return ids[:0], likes[:0]
+    scores = co[mask, 1] / np.sqrt(own[0] * likes[mask])
+    return ids[mask], scores
+
+
+def update_movie(movie_id, k=None):
+    '''Refresh the pairs of one movie after its likes changed'''
+    k = k or settings.MOVIE_SIMILAR_TOP_K
+    ids, scores = neighbours(movie_id)
+    best = top_k(ids, scores, k)
+    with transaction.atomic():
+        # Its own list is exact
+        MovieSimilarity.objects.filter(movie_id=movie_id).delete()
+        MovieSimilarity.objects.bulk_create([
+            MovieSimilarity(
+                movie_id=movie_id, similar_id=int(ids[i]),
+                score=float(scores[i]))
+            for i in best])
+        # Lists of movies no longer sharing a like with it forget it
+        MovieSimilarity.objects.filter(similar_id=movie_id).exclude(
+            movie_id__in=ids.tolist()).delete()
+        if not len(ids):
+            return
+        # Its score in the neighbours' lists changed, and it may enter
+        # lists it wasn't in, evicting their weakest neighbour
+        score_of = dict(zip(ids.tolist(), scores.tolist()))
+        lists = {}
+        for pk, movie, similar, score in MovieSimilarity.objects.filter(
+                movie_id__in=score_of).values_list(
+                'id', 'movie_id', 'similar_id', 'score'):
+            lists.setdefault(movie, []).append((score, -similar, pk))
+        changed, entering, evicted = [], [], []
+        for movie, score in score_of.items():
+            rows = lists.get(movie, [])
+            mine = [pk for _, similar, pk in rows if -similar == movie_id]
+            if mine:
+                changed.append(MovieSimilarity(pk=mine[0], score=score))
+            elif len(rows) < k:
+                entering.append(movie)
+            else:
+                # Lowest score, last by similar_id on ties
+                weakest = min(rows)
+                if score > weakest[0]:
+                    entering.append(movie)
+                    evicted.append(weakest[2])
+        MovieSimilarity.objects.bulk_update(changed, ['score'])
+        MovieSimilarity.objects.filter(pk__in=evicted).delete()
+        MovieSimilarity.objects.bulk_create([
+            MovieSimilarity(
+                movie_id=movie, similar_id=movie_id, score=score_of[movie])
+            for movie in entering])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # One worker, updates of the same lists never interleave
+            _executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='similarities')
+        return _executor
+
+
+def _run(movie_ids):
+    for movie_id in movie_ids:
+        try:
+            update_movie(movie_id)
+        except Exception:
+            logger.exception(
+                'Could not update similar movies of %s', movie_id)
+
+
+def _run_in_thread(movie_ids):
+    try:
+        _run(movie_ids)
+    finally:
+        connections.close_all()
+
+
+def schedule(movie_ids):
+    '''Queue incremental updates, MOVIE_SIMILAR_ASYNC = False runs them
+    in the caller'''
+    movie_ids = sorted(set(movie_ids))
+    if not settings.MOVIE_SIMILAR_ASYNC:
+        _run(movie_ids)
+        return
+    get_executor().submit(_run_in_thread, movie_ids)
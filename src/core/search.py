@@ -0,0 +1,152 @@
+'''Full-text search over Movie.title and Movie.description.
+
+Postgres keeps ``Movie.search_vector`` up to date with a trigger and serves
+queries from a GIN index. SQLite (used by the test suite and CI) has no
+tsvector, so an FTS5 external-content table mirrors the same columns and is
+maintained by triggers as well. Both backends annotate a ``rank`` where
+higher means more relevant.
+'''
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+
+SEARCH_CONFIG = 'pg_catalog.english'
+FTS_TABLE = 'core_movie_fts'
+
+POSTGRES_INSTALL = [
+    f'''
+    CREATE OR REPLACE FUNCTION core_movie_search_vector_update()
+    RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector(
+                '{SEARCH_CONFIG}', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector(
+                '{SEARCH_CONFIG}', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    ''',
+    '''
+    CREATE TRIGGER core_movie_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON core_movie
+    FOR EACH ROW EXECUTE PROCEDURE core_movie_search_vector_update();
+    ''',
+    # Fire the trigger once for the rows that already exist
+    'UPDATE core_movie SET title = title;',
+    '''
+    CREATE INDEX core_movie_search_vector_gin
+    ON core_movie USING gin (search_vector);
+    ''',
+]
+
+POSTGRES_UNINSTALL = [
+    'DROP INDEX IF EXISTS core_movie_search_vector_gin;',
+    'DROP TRIGGER IF EXISTS core_movie_search_vector_trigger ON core_movie;',
+    'DROP FUNCTION IF EXISTS core_movie_search_vector_update();',
+]
+
+SQLITE_INSTALL = [
+    f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, description, content='core_movie', content_rowid='id');
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON core_movie
+    BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END;
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON core_movie
+    BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END;
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+    AFTER UPDATE OF title, description ON core_movie
+    BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END;
+    ''',
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild');",
+]
+
+
+def install_postgres(apps, schema_editor):
+    '''Migration step: trigger and GIN index for Movie.search_vector'''
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_INSTALL:
+            schema_editor.execute(statement)
+
+
+def uninstall_postgres(apps, schema_editor):
+    '''Reverse of install_postgres'''
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_UNINSTALL:
+            schema_editor.execute(statement)
+
+
+def install_sqlite(using='default', **kwargs):
+    '''post_migrate handler: (re)create the FTS5 mirror on SQLite.
+
+    SQLite migrations rebuild core_movie whenever a column changes, which
+    drops its triggers, so this runs after every migrate and only rebuilds
+    the index when the triggers were missing.
+    '''
+    from django.db import connections
+    conn = connections[using]
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE type = 'trigger' AND name LIKE %s",
+            [f'{FTS_TABLE}_a%'])
+        if cursor.fetchone()[0] == 3:
+            return
+        for statement in SQLITE_INSTALL:
+            cursor.execute(statement)
+
+
+def fts5_query(terms):
+    '''Quote every word so user input can't inject FTS5 syntax'''
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', terms))
+
+
+def search_movies(queryset, terms):
+    '''Filter a Movie queryset by relevance to terms.
+
+    Return:
+        queryset annotated with ``rank`` and ordered by it (desc)
+    '''
+    if connection.vendor == 'postgresql':
+        query = SearchQuery(terms, config=SEARCH_CONFIG)
+        queryset = queryset.filter(search_vector=query).annotate(
+            rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+    else:
+        match = fts5_query(terms)
+        if not match:
+            return queryset.none()
+        queryset = queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            (match,),
+        )).annotate(rank=RawSQL(
+            # bm25 is lower-is-better, title hits weigh 10x description hits
+            f'SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = core_movie.id',
+            (match,),
+            output_field=FloatField(),
+        ))
+    return queryset.order_by('-rank', 'id')
@@ -0,0 +1,135 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.contrib.auth.models import User
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete)
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from core import recommendations, thumbnails
+from core.autocomplete import title_index
+from core.models import Movie, MovieImage, MoviePopularity
+from core.storage import release
+
+# Sent after writes that bypass model signals (bulk_create, update())
+movies_bulk_changed = Signal()
+# Sent with the ``pks`` of the movies whose stock core.stock updated
+movies_stock_changed = Signal()
+
+
+@receiver(post_save, sender=Movie)
+def index_movie_title(sender, instance, **kwargs):
+    '''Keep the autocomplete index in sync once the write is committed'''
+    transaction.on_commit(lambda: title_index.update(
+        instance.pk, instance.title, instance.availability))
+
+
+@receiver(post_save, sender=Movie)
+def create_movie_popularity(sender, instance, created, **kwargs):
+    '''New movies join the trending order with a zero score'''
+    if created:
+        MoviePopularity.objects.create(movie=instance)
+
+
+@receiver(post_delete, sender=Movie)
+def unindex_movie_title(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: title_index.remove(pk))
+
+
+@receiver(movies_bulk_changed)
+def reindex_movie_titles(sender, **kwargs):
+    transaction.on_commit(title_index.invalidate)
+
+
+def like_count_subquery():
+    '''Current number of likes of the outer Movie row'''
+    likes = Movie.likes.through.objects.filter(
+        movie_id=OuterRef('pk')).order_by().values('movie_id')
+    return Coalesce(Subquery(
+        likes.annotate(total=Count('*')).values('total')), 0)
+
+
+def recount_likes(movie_ids):
+    '''Recount like_count of the given movies from the join table'''
+    if movie_ids:
+        Movie.objects.filter(pk__in=movie_ids).update(
+            like_count=like_count_subquery(), updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Movie.likes.through)
+def count_movie_likes(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Apply likes added/removed from either side of Movie.likes to
+    Movie.like_count with an atomic F() update.
+
+    Django only reports the ids that were really added or removed, so
+    liking twice doesn't count twice. A clear reports no ids, the movies
+    a user liked are read before it so only those are recounted.
+    '''
+    if action in ('post_add', 'post_remove') and pk_set:
+        step = len(pk_set) if action == 'post_add' else -len(pk_set)
+        if reverse:
+            # instance is a User, pk_set holds movie ids
+            Movie.objects.filter(pk__in=pk_set).update(
+                like_count=F('like_count') + (1 if step > 0 else -1),
+                updated_at=timezone.now())
+        else:
+            Movie.objects.filter(pk=instance.pk).update(
+                like_count=F('like_count') + step,
+                updated_at=timezone.now())
+    elif action == 'pre_clear' and reverse:
+        instance._cleared_movie_ids = list(
+            instance.movie_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        if reverse:
+            recount_likes(instance.__dict__.pop('_cleared_movie_ids', []))
+        else:
+            recount_likes([instance.pk])
+
+
+@receiver(pre_delete, sender=User)
+def remember_liked_movies(sender, instance, **kwargs):
+    '''Deleting a user cascades its likes without m2m_changed, keep the
+    movies it liked for uncount_user_likes'''
+    instance._liked_movie_ids = list(
+        instance.movie_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=User)
+def uncount_user_likes(sender, instance, **kwargs):
+    recount_likes(instance.__dict__.pop('_liked_movie_ids', []))
+
+
+@receiver(post_save, sender=MovieImage)
+@receiver(post_delete, sender=MovieImage)
+def touch_movie(sender, instance, **kwargs):
+    '''Images are part of the movie representation, bump updated_at so
+    ETags and caches see the change'''
+    Movie.objects.filter(pk=instance.movie_id).update(
+        updated_at=timezone.now())
+
+
+@receiver(post_save, sender=MovieImage)
+def schedule_thumbnails(sender, instance, update_fields=None, **kwargs):
+    '''Build the image derivatives once the upload is committed'''
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: thumbnails.schedule(pk))
+
+
+@receiver(post_delete, sender=MovieImage)
+def release_image_file(sender, instance, **kwargs):
+    '''Drop the file with the last row referring to it'''
+    name = instance.image.name
+    transaction.on_commit(lambda: release(name))
+
+
+@receiver(m2m_changed, sender=Movie.likes.through)
+def update_similar_movies(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Refresh the neighbours of movies whose likes changed'''
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    movie_ids = set(pk_set) if reverse else {instance.pk}
+    transaction.on_commit(lambda: recommendations.schedule(movie_ids))
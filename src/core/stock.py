@@ -0,0 +1,79 @@
+'''Race-free stock bookkeeping for rents and sales.
+
+A reservation is a single conditional UPDATE:
+
+    UPDATE core_movie SET stock = stock - n WHERE id = %s AND stock >= n
+
+The database evaluates the condition and the decrement on the locked
+row, so concurrent requests can't both take the last units, and the
+movie_stock_non_negative constraint backs it. Callers run it in the
+same transaction as the Rent/Sale insert and keep that transaction
+short, the row stays locked until commit.
+
+A cart takes units of many movies at once with reserve_many(): one
+UPDATE with a CASE per movie, which the constraint rejects as a whole if
+any of them would go negative.
+
+Being UPDATEs they send no post_save, movies_stock_changed tells the
+catalog caches instead.
+'''
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from core.models import Movie
+from core.signals import movies_stock_changed
+
+
+class OutOfStock(Exception):
+    '''Fewer units left than requested'''
+
+
+def reserve(movie_id, quantity):
+    '''Take quantity units of a movie or raise OutOfStock'''
+    if not Movie.objects.filter(pk=movie_id, stock__gte=quantity).update(
+            stock=F('stock') - quantity, updated_at=timezone.now()):
+        raise OutOfStock(movie_id)
+    movies_stock_changed.send(sender=Movie, pks=[movie_id])
+
+
+def release(movie_id, quantity):
+    '''Give back units of a movie, e.g. when a rent is returned'''
+    Movie.objects.filter(pk=movie_id).update(
+        stock=F('stock') + quantity, updated_at=timezone.now())
+    movies_stock_changed.send(sender=Movie, pks=[movie_id])
+
+
+def _per_movie(quantities):
+    '''CASE expression giving the quantity of each movie'''
+    return Case(
+        *[When(pk=movie_id, then=Value(quantity))
+          for movie_id, quantity in quantities.items()],
+        default=Value(0), output_field=IntegerField())
+
+
+def reserve_many(quantities):
+    '''Take {movie id: quantity} units in a single UPDATE, all or none
+    of them, or raise OutOfStock'''
+    try:
+        # Savepoint, a rejected UPDATE leaves the caller's transaction
+        # usable
+        with transaction.atomic():
+            updated = Movie.objects.filter(pk__in=quantities).update(
+                stock=F('stock') - _per_movie(quantities),
+                updated_at=timezone.now())
+            if updated != len(quantities):
+                # A movie was deleted since validation
+                raise OutOfStock(*sorted(quantities))
+    except IntegrityError:
+        raise OutOfStock(*sorted(quantities))
+    movies_stock_changed.send(sender=Movie, pks=list(quantities))
+
+
+def release_many(quantities):
+    '''Give back {movie id: quantity} units in a single UPDATE'''
+    if quantities:
+        Movie.objects.filter(pk__in=quantities).update(
+            stock=F('stock') + _per_movie(quantities),
+            updated_at=timezone.now())
+        movies_stock_changed.send(sender=Movie, pks=list(quantities))
@@ -0,0 +1,118 @@
+'''Content-addressed storage of movie images.
+
+Distributors send the same poster for many editions of a title. Uploads
+are hashed while they are streamed to disk and kept once, under
+``<upload_to>/<sha256><ext>``; every MovieImage with the same content
+points at that file. The rows are the reference count: release() drops
+a file (and its thumbnails) with its last row and ``gc_images`` sweeps
+whatever is left unreferenced.
+'''
+import hashlib
+import os
+import posixpath
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    '''FileSystemStorage naming each file after the digest of its
+    content, saving an existing content again returns the stored name.'''
+    hash_name = 'sha256'
+    temp_prefix = '.upload-'
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content is hashed
+        return name
+
+    def stage(self, name, content):
+        '''Stream ``content`` to a temporary file next to its final
+        place, hashing it on the way.
+
+        Return the final name and the temporary path, for place() or
+        discard() once the caller knows whether it keeps the file.
+        '''
+        name = self.generate_filename(name)
+        directory = posixpath.dirname(name)
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+        digest = hashlib.new(self.hash_name)
+        # Same directory as the target, so the final rename is atomic
+        fd, temp_path = tempfile.mkstemp(
+            dir=full_directory, prefix=self.temp_prefix)
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp.write(chunk)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        extension = posixpath.splitext(name)[1].lower()
+        return (
+            posixpath.join(directory, digest.hexdigest() + extension),
+            temp_path)
+
+    def place(self, name, temp_path):
+        '''Move a staged file to ``name``, unless that content is
+        already stored'''
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            # Known content, refresh mtime so release()/gc keep it
+            os.utime(full_path)
+            self.discard(temp_path)
+            return
+        if self.file_permissions_mode is not None:
+            os.chmod(temp_path, self.file_permissions_mode)
+        os.replace(temp_path, full_path)
+
+    def discard(self, temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def _save(self, name, content):
+        name, temp_path = self.stage(name, content)
+        try:
+            self.place(name, temp_path)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        return name
+
+    def save_verbatim(self, name, content):
+        '''Save under ``name`` itself, for files derived from a stored
+        one like thumbnails'''
+        return super()._save(name, content).replace('\\', '/')
+
+    def age(self, name):
+        '''Seconds since the file was written or last deduplicated'''
+        return time.time() - os.path.getmtime(self.path(name))
+
+
+image_storage = ContentAddressedStorage()
+
+
+def release(name, min_age=None):
+    '''Delete the file ``name`` and its thumbnails when no MovieImage
+    refers to it anymore.
+
+    Files written in the last ``min_age`` seconds are left to gc_images:
+    an upload in flight may have just deduplicated against them.
+    '''
+    from core.models import MovieImage
+    from core.thumbnails import derivative_names
+    if min_age is None:
+        min_age = settings.MOVIE_IMAGE_GC_MIN_AGE
+    if not name or MovieImage.objects.filter(image=name).exists():
+        return False
+    if not image_storage.exists(name) or image_storage.age(name) < min_age:
+        return False
+    image_storage.delete(name)
+    for formats in derivative_names(name).values():
+        for derivative in formats.values():
+            image_storage.delete(derivative)
+    return True
@@ -0,0 +1,189 @@
+'''The one Stripe client of a worker process.
+
+stripe-python sends every call through ``stripe.default_http_client``.
+configure() installs a GatewayClient there, built from the settings:
+
+- each thread keeps its own keep-alive ``requests.Session`` (sessions
+  aren't thread-safe), reset in forked children so a preloaded master
+  never shares sockets with its workers;
+- connect and read timeouts are bounded by STRIPE_CONNECT_TIMEOUT and
+  STRIPE_READ_TIMEOUT instead of the library's 80 seconds;
+- connection errors, timeouts, 409 and 5xx answers are retried up to
+  STRIPE_MAX_RETRIES times with jittered exponential backoff. POSTs
+  carry an Idempotency-Key, so a retry never creates twice;
+- the latency of every call, retries included, goes to a histogram per
+  endpoint, see metrics().
+
+API key and base come from the settings once, not on every call, and are
+applied again when the settings change (tests).
+'''
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from stripe.http_client import RequestsClient
+
+# Upper bounds in seconds of the latency buckets, the last one is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SignatureVerificationError = stripe.error.SignatureVerificationError
+
+# Object ids in paths, /v1/checkout/sessions/cs_test_a1 -> .../{id}
+OBJECT_ID = re.compile(r'/[a-z]+_[A-Za-z0-9_]+')
+
+
+class LatencyHistogram(object):
+    '''Call durations counted in fixed latency buckets'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.attempts = 0
+        self.total = 0.0
+
+    def observe(self, seconds, attempts=1, ok=True):
+        index = next(
+            (i for i, bound in enumerate(BUCKETS) if seconds <= bound),
+            len(BUCKETS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.errors += not ok
+            self.attempts += attempts
+            self.total += seconds
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q quantile'''
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        with self._lock:
+            labels = [str(bound) for bound in BUCKETS] + ['+Inf']
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'retries': self.attempts - self.count,
+                'mean': round(self.total / self.count, 4)
+                if self.count else None,
+                'p50': self.quantile(.5) if self.count else None,
+                'p95': self.quantile(.95) if self.count else None,
+                'p99': self.quantile(.99) if self.count else None,
+                'buckets': dict(zip(labels, self.counts)),
+            }
+
+
+class GatewayClient(RequestsClient):
+    '''RequestsClient with bounded timeouts and retries, timing every
+    call it makes'''
+
+    def __init__(
+            self, connect_timeout, read_timeout, max_retries, **kwargs):
+        super().__init__(timeout=(connect_timeout, read_timeout), **kwargs)
+        self.max_retries = max_retries
+        self._histograms = {}
+        self._histograms_lock = threading.Lock()
+
+    def _max_network_retries(self):
+        return self.max_retries
+
+    def histogram(self, endpoint):
+        with self._histograms_lock:
+            return self._histograms.setdefault(endpoint, LatencyHistogram())
+
+    def request(self, method, url, headers, post_data=None):
+        local = self._thread_local
+        local.attempts = getattr(local, 'attempts', 0) + 1
+        return super().request(method, url, headers, post_data)
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        path = OBJECT_ID.sub('/{id}', urlsplit(url).path)
+        endpoint = f'{method.upper()} {path}'
+        self._thread_local.attempts = 0
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = super().request_with_retries(
+                method, url, headers, post_data)
+            ok = response[1] < 500
+            return response
+        finally:
+            self.histogram(endpoint).observe(
+                time.perf_counter() - start,
+                attempts=self._thread_local.attempts, ok=ok)
+
+    def metrics(self):
+        with self._histograms_lock:
+            histograms = dict(self._histograms)
+        return {
+            endpoint: histogram.as_dict()
+            for endpoint, histogram in sorted(histograms.items())}
+
+    def reset_sessions(self):
+        '''Forget the per-thread sessions, e.g. after a fork'''
+        self._thread_local = threading.local()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure():
+    '''Install a client built from the settings, returns it'''
+    global _client
+    with _client_lock:
+        _client = GatewayClient(
+            settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT,
+            settings.STRIPE_MAX_RETRIES)
+        stripe.default_http_client = _client
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        stripe.api_base = settings.STRIPE_API_BASE
+        return _client
+
+
+def get_client():
+    return _client or configure()
+
+
+def metrics():
+    '''Latency histograms per endpoint of this worker process'''
+    return get_client().metrics()
+
+
+def create_checkout_session(**params):
+    get_client()
+    return stripe.checkout.Session.create(**params)
+
+
+def construct_event(payload, sig_header):
+    '''Webhook event, raises ValueError or SignatureVerificationError'''
+    return stripe.Webhook.construct_event(
+        payload, sig_header, settings.STRIPE_WEBHOOK_SECRET)
+
+
+@receiver(setting_changed)
+def reconfigure(setting, **kwargs):
+    if setting.startswith('STRIPE_') and _client is not None:
+        configure()
+
+
+def _after_fork():
+    if _client is not None:
+        _client.reset_sessions()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,131 @@
+'''Fixed-size derivatives of MovieImage uploads.
+
+Every original ``movies/images/<name>.<ext>`` gets one file per size and
+format stored next to it, ``movies/images/<name>_<size>.<format>``, so
+clients can download a small WebP (or JPEG where WebP isn't supported)
+instead of the full upload.
+
+Derivatives are built after the upload is committed, in a thread pool of
+MOVIE_THUMBNAIL_WORKERS threads: Pillow releases the GIL while decoding,
+resizing and encoding, and the request doesn't wait for any of it.
+MovieImage.thumbnails_ready turns True once all files exist.
+'''
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+from PIL import Image, ImageOps
+
+from core.storage import image_storage
+
+logger = logging.getLogger(__name__)
+
+# name -> bounding box, derivatives keep the aspect ratio
+SIZES = {
+    'small': (160, 240),
+    'medium': (320, 480),
+}
+# extension -> Pillow format and encoder options
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+
+def derivative_name(name, size, extension):
+    '''Storage name of one derivative of the original ``name``'''
+    return f'{os.path.splitext(name)[0]}_{size}.{extension}'
+
+
+def derivative_names(name):
+    '''{size: {extension: storage name}} of every derivative'''
+    return {
+        size: {
+            extension: derivative_name(name, size, extension)
+            for extension in FORMATS
+        } for size in SIZES
+    }
+
+
+def generate(name, storage=None):
+    '''Write every derivative of the original ``name``, replacing stale
+    ones, and return their names.'''
+    storage = storage or image_storage
+    # Content-addressed storages would rename the derivatives
+    save = getattr(storage, 'save_verbatim', storage.save)
+    written = []
+    with storage.open(name) as file, Image.open(file) as original:
+        # Let JPEG decode at a reduced scale, the largest box is enough
+        original.draft('RGB', max(SIZES.values()))
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    # Largest first, each size is resized from the previous one
+    for size, box in sorted(
+            SIZES.items(), key=lambda item: item[1], reverse=True):
+        image.thumbnail(box, Image.LANCZOS)
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, image_format, **options)
+            target = derivative_name(name, size, extension)
+            if storage.exists(target):
+                storage.delete(target)
+            written.append(save(target, ContentFile(buffer.getvalue())))
+    return written
+
+
+def build(pk):
+    '''Generate the derivatives of one MovieImage and flag it ready'''
+    from core.models import MovieImage
+    image = MovieImage.objects.filter(pk=pk).first()
+    if image is None or not image.image:
+        return
+    name = image.image.name
+    # Rows sharing a content-addressed file share its thumbnails
+    if not MovieImage.objects.filter(
+            image=name, thumbnails_ready=True).exists():
+        generate(name, image.image.storage)
+    # Saving (not update()) lets the movie's ETag and caches follow
+    image.thumbnails_ready = True
+    image.save(update_fields=['thumbnails_ready'])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MOVIE_THUMBNAIL_WORKERS,
+                thread_name_prefix='thumbnails')
+        return _executor
+
+
+def _run(pk):
+    try:
+        build(pk)
+    except Exception:
+        logger.exception('Could not build thumbnails of MovieImage %s', pk)
+
+
+def _run_in_thread(pk):
+    try:
+        _run(pk)
+    finally:
+        # Worker threads open their own connections
+        connections.close_all()
+
+
+def schedule(pk):
+    '''Queue the derivatives of a MovieImage, MOVIE_THUMBNAIL_WORKERS = 0
+    builds them synchronously.'''
+    if not settings.MOVIE_THUMBNAIL_WORKERS:
+        _run(pk)
+        return
+    get_executor().submit(_run_in_thread, pk)
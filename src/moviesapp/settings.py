@@ -111,6 +111,11 @@ if os.environ.get('CI', False) or TESTING:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Writers wait for each other instead of failing at once
+            'OPTIONS': {'timeout': 30},
+            # On disk rather than shared-cache memory, whose table locks
+            # fail immediately, so threaded tests can write concurrently
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
             }
         }
 else:
@@ -125,6 +130,32 @@ else:
         }
     }
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+'''The catalog cache holds anonymous /api/movies/ responses, see api.cache.
+CATALOG_CACHE_BACKEND is locmem (per process) or file (shared by every
+worker on the host, CATALOG_CACHE_LOCATION is then a directory).
+'''
+CATALOG_CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+}
+CATALOG_CACHE_BACKEND = os.getenv('CATALOG_CACHE_BACKEND', 'locmem')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': CATALOG_CACHE_BACKENDS[CATALOG_CACHE_BACKEND],
+        'LOCATION': os.getenv(
+            'CATALOG_CACHE_LOCATION',
+            os.path.join(BASE_DIR.parent, '.cache', 'catalog')),
+        'TIMEOUT': int(os.getenv('CATALOG_CACHE_TIMEOUT', 300)),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -168,6 +199,10 @@ REST_FRAMEWORK = {
     "DATE_INPUT_FORMATS": ["%d-%m-%Y"],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 DJOSER = {
@@ -221,6 +256,52 @@ if not DEBUG and not CI:
 STRIPE_PUBLIC_KEY = env('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET')
+# Stripe API the checkout talks to, e.g. the `fake_stripe` stand-in
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+# Seconds to connect to and wait for Stripe, and retries of failed calls
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3.05))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 20))
+STRIPE_MAX_RETRIES = int(os.getenv('STRIPE_MAX_RETRIES', 2))
+# Answer rent_it with 202 and create the checkout session after the
+# response, on this many threads per process (0 runs it inline)
+STRIPE_CHECKOUT_ASYNC = os.getenv('STRIPE_CHECKOUT_ASYNC', 'false') == 'true'
+STRIPE_CHECKOUT_WORKERS = int(os.getenv('STRIPE_CHECKOUT_WORKERS', 8))
+# Seconds after which resume_checkouts retries a checkout still pending
+STRIPE_CHECKOUT_STALE_AFTER = int(
+    os.getenv('STRIPE_CHECKOUT_STALE_AFTER', 300))
+
+# Seconds before each worker rebuilds its in-memory title autocomplete index
+MOVIE_AUTOCOMPLETE_MAX_AGE = int(
+    os.getenv('MOVIE_AUTOCOMPLETE_MAX_AGE', 300))
+
+# Local directory the images column of /api/movies/import/ refers to
+MOVIE_IMPORT_IMAGES_DIR = os.getenv(
+    'MOVIE_IMPORT_IMAGES_DIR', os.path.join(BASE_DIR.parent, 'imports'))
+
+# Edges of the price buckets counted by /api/movies/facets/
+MOVIE_PRICE_BUCKETS = os.getenv(
+    'MOVIE_PRICE_BUCKETS', '0,2,5,10,20').split(',')
+
+# Neighbours kept per movie by core.recommendations, and whether likes
+# update them in a background thread
+MOVIE_SIMILAR_TOP_K = int(os.getenv('MOVIE_SIMILAR_TOP_K', 20))
+MOVIE_SIMILAR_ASYNC = os.getenv('MOVIE_SIMILAR_ASYNC', 'true') == 'true'
+
+# Hours for a rent/sale/like to lose half its weight in ?ordering=popularity
+# and seconds refresh_popularity waits before reading new rows
+MOVIE_POPULARITY_HALF_LIFE = float(
+    os.getenv('MOVIE_POPULARITY_HALF_LIFE', 72))
+MOVIE_POPULARITY_LAG = int(os.getenv('MOVIE_POPULARITY_LAG', 60))
+
+# Threads per process building image derivatives, 0 builds them inline
+MOVIE_THUMBNAIL_WORKERS = int(os.getenv('MOVIE_THUMBNAIL_WORKERS', 2))
+
+# Unreferenced movie images younger than this (seconds) are kept, an
+# upload may be reusing them, see core.storage
+MOVIE_IMAGE_GC_MIN_AGE = int(os.getenv('MOVIE_IMAGE_GC_MIN_AGE', 600))
+
+# Lines a cart checked out at api/orders/ may hold
+CART_MAX_LINES = int(os.getenv('CART_MAX_LINES', 50))
 
 YOUR_SERVER = 'http://localhost:8000/'
 EMAIL_ADMINISTRATOR = 'admin@test.com'